@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Python 2.7.X
+
+# Compare le chargement des résultats d'un service dans PostgreSQL par ogr2ogr (deux appels : table + CSV des erreurs) et par COPY (pgload.PgLoader)
+# Aide : python benchmarks/bench_pg_load.py --help
+
+import argparse, os, sys, csv, time, random, tempfile, shutil, subprocess
+from dotenv import load_dotenv
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pgload import PgLoader
+load_dotenv()
+
+COLUMNS = ['id', 'geoc_name', 'loc_name', 'status', 'score', 'match_type', 'match_addr', 'adresse', 'c_postal', 'l_com', 'pays', 'x', 'y']
+
+def write_rows(path, nb_rows):
+    with open(path, 'wb') as file_obj:
+        writer = csv.writer(file_obj, delimiter=',')
+        writer.writerow(COLUMNS)
+        for index in range(nb_rows):
+            status = 'U' if random.random() < 0.1 else 'M'
+            writer.writerow([index, 'Esri', 'World', status, random.randint(60, 100), 'PointAddress', '{0} RUE DE RIVOLI, 75001, PARIS'.format(index % 200), '{0} rue de Rivoli'.format(index % 200), '75001', 'Paris', 'France', 2.33 + random.random() / 100, 48.86 + random.random() / 100])
+
+def bench_ogr2ogr(config, pathIn, pathOut, table):
+    pg = "PG:host={0} port={1} dbname={2} user={3} password={4}".format(config["PGHOST"], config["PGPORT"], config["PGDBNAME"], config["PGUSER"], config["PGPWD"])
+    layer = os.path.basename(pathIn).split('.')[0]
+    start = time.time()
+    subprocess.check_call(['ogr2ogr', '-f', 'PostgreSQL', pg, pathIn, '-overwrite', '-dialect', 'sqlite', '-sql', "SELECT {0} FROM {1} where status <> 'U'".format(', '.join(COLUMNS), layer), '-nln', table])
+    subprocess.check_call(['ogr2ogr', '-f', 'CSV', os.path.join(pathOut, 'erreurs_ogr2ogr.csv'), pathIn, '-dialect', 'sqlite', '-sql', "SELECT {0} FROM {1} where status = 'U'".format(', '.join(COLUMNS), layer)])
+    return time.time() - start
+
+def bench_copy(config, pathIn, pathOut, table):
+    start = time.time()
+    loader = PgLoader(config, table, COLUMNS)
+    loader.create_table(overwrite=True)
+    with open(pathIn, 'rb') as input_obj, open(os.path.join(pathOut, 'erreurs_copy.csv'), 'wb') as errors_obj:
+        errors = csv.DictWriter(errors_obj, fieldnames=COLUMNS, delimiter=',')
+        errors.writeheader()
+        loader.load(csv.DictReader(input_obj, delimiter=','), lambda row: row['status'] != 'U', errors)
+    loader.close()
+    return time.time() - start
+
+parser = argparse.ArgumentParser(description='Comparaison ogr2ogr / COPY pour le chargement des résultats de géocodage')
+parser.add_argument("-n", "--rows", required=False, default=1000000, type=int, help="Nombre de lignes générées (1 000 000 par défaut)")
+parser.add_argument("-s", "--schema", required=False, default=os.getenv('PGSCHEMA') or 'public', help="Schéma PostgreSQL des tables de test")
+args = parser.parse_args()
+
+config = {
+    "PGHOST": os.getenv('PGHOST'),
+    "PGPORT": os.getenv('PGPORT'),
+    "PGDBNAME": os.getenv('PGDBNAME'),
+    "PGUSER": os.getenv('PGUSER'),
+    "PGPWD": os.getenv('PGPWD')
+}
+
+workspace = tempfile.mkdtemp()
+try:
+    pathIn = os.path.join(workspace, 'bench_resultats.csv')
+    write_rows(pathIn, args.rows)
+    if os.getenv('QGISBINPATH'):
+        os.environ['PATH'] = os.getenv('QGISBINPATH') + os.pathsep + os.environ['PATH']
+    durationOgr = bench_ogr2ogr(config, pathIn, workspace, '{0}.bench_ogr2ogr'.format(args.schema))
+    durationCopy = bench_copy(config, pathIn, workspace, '{0}.bench_copy'.format(args.schema))
+    sys.stdout.write('ogr2ogr : {0:.1f} s ({1:.0f} lignes/s)\n'.format(durationOgr, args.rows / durationOgr))
+    sys.stdout.write('COPY    : {0:.1f} s ({1:.0f} lignes/s)\n'.format(durationCopy, args.rows / durationCopy))
+finally:
+    shutil.rmtree(workspace)
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Python 2.7.X
+
+# Mesure la chaîne de géocodage complète (Geocoding.chain_geocoding) sur des adresses synthétiques, avec les services Esri et BAN simulés en local (mock_services.py)
+# et la base PostgreSQL des variables du fichier .env (une instance locale suffit, ex. : docker run -p 5432:5432 -e POSTGRES_PASSWORD=postgres postgres)
+# Pour chaque taille, la chaîne est lancée dans un processus séparé afin de mesurer sa mémoire maximale (peak RSS)
+# Aide : python benchmarks/bench_pipeline.py --help
+
+import argparse, json, os, shutil, subprocess, sys, tempfile, time
+from dotenv import load_dotenv
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+load_dotenv()
+
+# Méthodes de Geocoding chronométrées, dans l'ordre d'exécution
+STAGES = ['prepare_input', 'cache_lookup', 'geocoding_local', 'geocoding_esri', 'geocoding_ban', 'cache_load_hits', 'export_results', 'cache_store']
+
+def peak_rss_mb():
+    """
+    Mémoire maximale utilisée par le processus, en Mo
+    """
+    try:
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage / (1024.0 * 1024.0) if sys.platform == 'darwin' else usage / 1024.0
+    except ImportError:
+        import ctypes
+        from ctypes import wintypes
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + [(name, ctypes.c_size_t) for name in ('PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb)
+        return counters.PeakWorkingSetSize / (1024.0 * 1024.0)
+
+def timed(timings, name, method):
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            timings[name] = timings.get(name, 0.0) + time.time() - start
+    return wrapper
+
+def run_single(args):
+    """
+    Lance la chaîne sur un jeu synthétique de args.single lignes et écrit le résultat en JSON sur une ligne
+    """
+    import geocoding
+    from synthetic import write_addresses
+    from mock_services import start_mock_server, ESRI_PATH, BAN_PATH
+    workspace = tempfile.mkdtemp(prefix='bench_pipeline_')
+    server = start_mock_server(latency=args.latency, error_rate=args.errors, unmatched_rate=args.unmatched)
+    pathCsv = write_addresses(os.path.join(workspace, 'adresses_a_geocoder.csv'), args.single, args.duplicates)
+    config = {
+        "PGHOST": os.getenv('PGHOST'),
+        "PGPORT": os.getenv('PGPORT'),
+        "PGDBNAME": os.getenv('PGDBNAME'),
+        "PGUSER": os.getenv('PGUSER'),
+        "PGPWD": os.getenv('PGPWD'),
+        "PGSCHEMA": os.getenv('PGSCHEMA') or 'public',
+        "GEOCODINGSERVICES": args.services,
+        "ESRI_MAX_ROWS": args.single + 1,
+        "ESRIAPIKEY": 'bench',
+        "ESRI_URL": server.url(ESRI_PATH),
+        "ESRI_WORKERS": args.workers,
+        "BAN_URL": server.url(BAN_PATH),
+        "BAN_CHUNK_ROWS": args.ban_chunk,
+        "BAN_WORKERS": args.workers,
+        "LOCAL_INDEX": args.local_index,
+        "WORKSPACE": workspace,
+        "INPUT_A_GEOCODER": pathCsv,
+        "GEOCODAGE_OUTPUT": 'bench_pipeline.csv',
+        "GEOCODAGE_ERROR": 'adresses_err.csv',
+        "ID": 'id',
+        "ADRESSE": 'adresse',
+        "CODE_POSTAL": 'c_postal',
+        "COMMUNE": 'l_com',
+        "PAYS": 'pays'
+    }
+    ExecGeoc = geocoding.Geocoding(config)
+    timings = {}
+    for name in STAGES:
+        setattr(ExecGeoc, name, timed(timings, name, getattr(ExecGeoc, name)))
+    stdout = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')
+    start = time.time()
+    try:
+        ExecGeoc.chain_geocoding()
+    finally:
+        if not args.verbose:
+            sys.stdout.close()
+        sys.stdout = stdout
+    duration = time.time() - start
+    server.shutdown()
+    shutil.rmtree(workspace, ignore_errors=True)
+    result = {'rows': args.single, 'services': args.services, 'seconds': duration, 'rows_per_s': args.single / max(duration, 0.001), 'stages': dict((name, timings[name]) for name in STAGES if name in timings), 'peak_rss_mb': peak_rss_mb(), 'requests': server.nb_requests, 'errors_injected': server.nb_errors}
+    sys.stdout.write(json.dumps(result) + '\n')
+
+def run_sizes(args):
+    """
+    Lance un processus par taille de jeu et affiche un tableau des résultats
+    """
+    results = []
+    for size in args.sizes:
+        command = [sys.executable, os.path.abspath(__file__), '--single', str(size), '--services'] + args.services + ['--duplicates', str(args.duplicates), '--latency', str(args.latency), '--errors', str(args.errors), '--unmatched', str(args.unmatched), '--workers', str(args.workers), '--ban_chunk', str(args.ban_chunk)]
+        if args.local_index:
+            command += ['--local_index', args.local_index]
+        if args.verbose:
+            command += ['--verbose']
+        output = subprocess.check_output(command)
+        results.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+        result = results[-1]
+        sys.stdout.write('{0:>9} lignes : {1:8.1f} s, {2:8.0f} lignes/s, {3:7.0f} Mo max. | {4}\n'.format(result['rows'], result['seconds'], result['rows_per_s'], result['peak_rss_mb'], ', '.join('{0} {1:.1f} s'.format(name, result['stages'][name]) for name in STAGES if name in result['stages'])))
+        sys.stdout.flush()
+    if args.output:
+        with open(args.output, 'a') as file_obj:
+            for result in results:
+                result['date'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+                file_obj.write(json.dumps(result) + '\n')
+
+parser = argparse.ArgumentParser(description='Débit, durée par étape et mémoire maximale de la chaîne de géocodage sur des services simulés')
+parser.add_argument("-n", "--sizes", required=False, default=[10000, 100000, 1000000], type=int, nargs='+', help="Nombres de lignes testés (10 000, 100 000 et 1 000 000 par défaut)")
+parser.add_argument("-g", "--services", required=False, default=['esri', 'ban'], nargs='+', help="Services enchaînés (esri ban par défaut ; local si --local_index est renseigné ; interne nécessite ArcPy)")
+parser.add_argument("-d", "--duplicates", required=False, default=0.2, type=float, help="Part des lignes en double, de 0 à 1 (0.2 par défaut)")
+parser.add_argument("--latency", required=False, default=0.05, type=float, help="Latence des services simulés par requête, en secondes (0.05 par défaut)")
+parser.add_argument("--errors", required=False, default=0.0, type=float, help="Part des requêtes en erreur 503, de 0 à 1 (0 par défaut)")
+parser.add_argument("--unmatched", required=False, default=0.1, type=float, help="Part des adresses non géocodées par chaque service, de 0 à 1 (0.1 par défaut)")
+parser.add_argument("--workers", required=False, default=4, type=int, help="Lots envoyés simultanément à chaque service (4 par défaut)")
+parser.add_argument("--ban_chunk", required=False, default=10000, type=int, help="Nombre de lignes par lot envoyé à la BAN (10 000 par défaut)")
+parser.add_argument("--local_index", required=False, default=None, help="Dossier de l'index du géocodeur local (service local)")
+parser.add_argument("-o", "--output", required=False, default=None, help="Fichier JSON lines auquel ajouter les résultats, pour suivre les régressions")
+parser.add_argument("-v", "--verbose", required=False, action='store_true', help="Affiche les messages de la chaîne de géocodage")
+parser.add_argument("--single", required=False, default=None, type=int, help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+if args.single:
+    run_single(args)
+else:
+    run_sizes(args)
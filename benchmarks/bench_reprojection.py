@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Python 2.7.X
+
+# Compare la reprojection en Lambert-93 par lots NumPy (projection.py) et par la requête UPDATE PostGIS utilisée auparavant
+# La partie PostGIS n'est lancée que si les variables PostgreSQL du fichier .env sont renseignées
+# Aide : python benchmarks/bench_reprojection.py --help
+
+import argparse, os, sys, time
+import numpy as np
+from dotenv import load_dotenv
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from projection import to_lambert93
+load_dotenv()
+
+SQLUPDATECOORD = "UPDATE {0} SET x=st_x(st_transform(ST_setsrid(cast(st_makepoint(x::numeric, y::numeric) as geometry), 4326), 2154)), y=st_y(st_transform(ST_setsrid(cast(st_makepoint(x::numeric, y::numeric) as geometry), 4326), 2154))"
+
+def bench_numpy(lon, lat, batch_size):
+    start = time.time()
+    x, y = np.empty_like(lon), np.empty_like(lat)
+    for index in range(0, len(lon), batch_size):
+        x[index:index + batch_size], y[index:index + batch_size] = to_lambert93(lon[index:index + batch_size], lat[index:index + batch_size], '4326')
+    return time.time() - start, x, y
+
+def bench_postgis(lon, lat, table):
+    import io, psycopg2
+    connection = psycopg2.connect(host=os.getenv('PGHOST'), port=os.getenv('PGPORT'), dbname=os.getenv('PGDBNAME'), user=os.getenv('PGUSER'), password=os.getenv('PGPWD'))
+    with connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS {0}".format(table))
+        cursor.execute("CREATE TABLE {0} (id integer, x double precision, y double precision)".format(table))
+        cursor.copy_expert("COPY {0} FROM STDIN WITH (FORMAT csv)".format(table), io.BytesIO(''.join('{0},{1!r},{2!r}\n'.format(index, x, y) for index, (x, y) in enumerate(zip(lon, lat)))))
+        connection.commit()
+        start = time.time()
+        cursor.execute(SQLUPDATECOORD.format(table))
+        connection.commit()
+        duration = time.time() - start
+        cursor.execute("SELECT x, y FROM {0} ORDER BY id".format(table))
+        result = np.array(cursor.fetchall())
+        cursor.execute("DROP TABLE {0}".format(table))
+    connection.commit()
+    connection.close()
+    return duration, result[:, 0], result[:, 1]
+
+parser = argparse.ArgumentParser(description='Comparaison NumPy / PostGIS pour la reprojection en Lambert-93')
+parser.add_argument("-n", "--rows", required=False, default=1000000, type=int, help="Nombre de points générés (1 000 000 par défaut)")
+parser.add_argument("-b", "--batch", required=False, default=10000, type=int, help="Taille des lots NumPy (10 000 par défaut)")
+parser.add_argument("-s", "--schema", required=False, default=os.getenv('PGSCHEMA') or 'public', help="Schéma PostgreSQL de la table de test")
+args = parser.parse_args()
+
+# Points répartis sur la France métropolitaine
+lon = np.random.uniform(-4.8, 8.2, args.rows)
+lat = np.random.uniform(42.3, 51.1, args.rows)
+
+durationNumpy, x, y = bench_numpy(lon, lat, args.batch)
+sys.stdout.write('NumPy   : {0:.2f} s ({1:.0f} points/s)\n'.format(durationNumpy, args.rows / durationNumpy))
+if os.getenv('PGHOST'):
+    durationSql, xSql, ySql = bench_postgis(lon, lat, '{0}.bench_reprojection'.format(args.schema))
+    sys.stdout.write('PostGIS : {0:.2f} s ({1:.0f} points/s)\n'.format(durationSql, args.rows / durationSql))
+    sys.stdout.write('Écart maximal : {0:.4f} m\n'.format(max(np.abs(x - xSql).max(), np.abs(y - ySql).max())))
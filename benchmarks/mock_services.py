@@ -0,0 +1,170 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Python 2.7.X
+
+# Serveur local simulant les services geocodeAddresses (Esri) et /search/csv/ (BAN), pour mesurer la chaîne sans clé Esri ni appel à l'API publique
+# La latence de chaque requête et la part de réponses en erreur 503 sont réglables
+# Aide : python benchmarks/mock_services.py --help
+
+import argparse, cgi, csv, hashlib, io, json, math, os, random, re, sys, threading, time
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from projection import to_lambert93
+
+ESRI_PATH = '/geocodeAddresses'
+BAN_PATH = '/search/csv/'
+POSTCODE = re.compile(r'\b(\d{5})\b')
+
+def _digest(value):
+    return hashlib.md5(value if isinstance(value, bytes) else value.encode('utf-8')).hexdigest()
+
+def _text_io(content=None):
+    # CSV en octets sous Python 2, en texte sous Python 3
+    if str is bytes:
+        return io.BytesIO(content or b'')
+    return io.StringIO(content.decode('utf-8') if content else u'')
+
+def fake_point(value, srid):
+    """
+    Point déterministe en France métropolitaine pour une adresse, dans le système demandé
+    """
+    digest = int(_digest(value)[:12], 16)
+    lon, lat = -4.5 + (digest % 12000) / 1000.0, 42.5 + (digest // 12000 % 8500) / 1000.0
+    if str(srid) in ('102110', '2154'):
+        x, y = to_lambert93([lon], [lat], '4326')
+        return float(x[0]), float(y[0])
+    if str(srid) in ('102100', '3857', '900913'):
+        return lon * 6378137.0 * math.pi / 180, 6378137.0 * math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+    return lon, lat
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    """
+    Serveur HTTP multi-thread des services simulés
+
+    Attributs
+    ---------
+    latency: float
+        Durée d'attente ajoutée à chaque requête, en secondes
+    error_rate: float
+        Part des requêtes rejetées en erreur 503 (0 à 1)
+    unmatched_rate: float
+        Part des adresses rendues non géocodées (0 à 1)
+    """
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, error_rate=0.0, unmatched_rate=0.1):
+        HTTPServer.__init__(self, address, MockHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.unmatched_rate = unmatched_rate
+        self.nb_requests = 0
+        self.nb_errors = 0
+        self.lock = threading.Lock()
+
+    def url(self, path):
+        return 'http://{0}:{1}{2}'.format(self.server_address[0], self.server_address[1], path)
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def unmatched(self, value):
+        return int(_digest(value)[12:16], 16) < self.server.unmatched_rate * 65536
+
+    def do_POST(self):
+        with self.server.lock:
+            self.server.nb_requests += 1
+        time.sleep(self.server.latency)
+        if random.random() < self.server.error_rate:
+            with self.server.lock:
+                self.server.nb_errors += 1
+            self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            return self.reply(503, 'text/plain', b'Service Unavailable')
+        if self.path.startswith(ESRI_PATH):
+            return self.esri()
+        if self.path.startswith(BAN_PATH):
+            return self.ban()
+        self.reply(404, 'text/plain', b'Not Found')
+
+    def esri(self):
+        form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8'))
+        srid = form.get('outSR', ['4326'])[0]
+        locations = []
+        for record in json.loads(form['addresses'][0])['records']:
+            address = record['attributes']['address']
+            postcode = POSTCODE.search(address)
+            if self.unmatched(address):
+                x, y, status, score, addr_type = None, None, 'U', 0, ''
+            else:
+                (x, y), status, score, addr_type = fake_point(address, srid), 'M', 100, 'PointAddress'
+            locations.append({'attributes': {'ResultID': record['attributes']['objectid'], 'Loc_name': 'World', 'Status': status, 'Score': score, 'Addr_type': addr_type, 'Match_addr': address, 'Place_addr': address, 'Postal': postcode.group(1) if postcode else '', 'City': '', 'CntryName': 'France', 'X': x, 'Y': y}})
+        self.reply(200, 'application/json', json.dumps({'spatialReference': {'wkid': int(srid)}, 'locations': locations}).encode('utf-8'))
+
+    def ban(self):
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers, environ={'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': self.headers.get('Content-Type')})
+        columns = form.getlist('columns')
+        reader = csv.DictReader(_text_io(form['data'].value), delimiter=',')
+        output = _text_io()
+        writer = csv.DictWriter(output, fieldnames=reader.fieldnames + ['latitude', 'longitude', 'result_label', 'result_score', 'result_type'], delimiter=',')
+        writer.writeheader()
+        for row in reader:
+            label = ' '.join(row.get(column) or '' for column in columns)
+            if self.unmatched(label):
+                row.update({'latitude': '', 'longitude': '', 'result_label': '', 'result_score': '', 'result_type': ''})
+            else:
+                lon, lat = fake_point(label, '4326')
+                row.update({'latitude': lat, 'longitude': lon, 'result_label': label, 'result_score': 0.6 + (int(_digest(label)[:4], 16) % 40) / 100.0, 'result_type': 'housenumber'})
+            writer.writerow(row)
+        body = output.getvalue()
+        self.reply(200, 'text/csv; charset=utf-8', body if isinstance(body, bytes) else body.encode('utf-8'))
+
+def start_mock_server(host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, unmatched_rate=0.1):
+    """
+    Démarre les services simulés dans un thread et retourne le serveur (server.url(ESRI_PATH), server.url(BAN_PATH))
+
+    Paramètres
+    ----------
+    host: str
+        Adresse d'écoute
+    port: int
+        Port d'écoute (0 : port libre choisi par le système)
+    latency: float
+        Durée d'attente ajoutée à chaque requête, en secondes
+    error_rate: float
+        Part des requêtes rejetées en erreur 503 (0 à 1)
+    unmatched_rate: float
+        Part des adresses rendues non géocodées (0 à 1)
+    """
+    server = MockServer((host, port), latency, error_rate, unmatched_rate)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Services Esri et BAN simulés en local')
+    parser.add_argument("--host", required=False, default='127.0.0.1', help="Adresse d'écoute (127.0.0.1 par défaut)")
+    parser.add_argument("--port", required=False, default=8800, type=int, help="Port d'écoute (8800 par défaut)")
+    parser.add_argument("--latency", required=False, default=0.0, type=float, help="Latence ajoutée à chaque requête, en secondes (0 par défaut)")
+    parser.add_argument("--errors", required=False, default=0.0, type=float, help="Part des requêtes en erreur 503, de 0 à 1 (0 par défaut)")
+    parser.add_argument("--unmatched", required=False, default=0.1, type=float, help="Part des adresses non géocodées, de 0 à 1 (0.1 par défaut)")
+    args = parser.parse_args()
+    server = MockServer((args.host, args.port), args.latency, args.errors, args.unmatched)
+    sys.stdout.write('ESRIURL={0}\nBANURL={1}\n'.format(server.url(ESRI_PATH), server.url(BAN_PATH)))
+    sys.stdout.flush()
+    server.serve_forever()
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Python 2.7.X
+
+# Générateur d'adresses françaises synthétiques au format du CSV d'entrée (id, adresse, c_postal, l_com, pays)
+# Les doublons reprennent une adresse déjà générée avec une autre écriture (casse, abréviation du type de voie, ponctuation)
+# Aide : python benchmarks/synthetic.py --help
+
+import argparse, csv, random
+
+COLUMNS = ['id', 'adresse', 'c_postal', 'l_com', 'pays']
+
+STREET_TYPES = [('Rue', 'R'), ('Avenue', 'Av'), ('Boulevard', 'Bd'), ('Place', 'Pl'), ('Impasse', 'Imp'), ('Allée', 'All'), ('Chemin', 'Ch'), ('Quai', 'Qu'), ('Route', 'Rte'), ('Passage', 'Pass')]
+STREET_NAMES = ['de la République', 'Victor Hugo', 'Jean Jaurès', 'de la Gare', 'du Général de Gaulle', 'Pasteur', 'de l\'Église', 'des Écoles', 'du Moulin', 'Gambetta',
+                'de Paris', 'Voltaire', 'Émile Zola', 'de la Liberté', 'des Lilas', 'du Château', 'Jules Ferry', 'Saint-Martin', 'de Verdun', 'des Acacias',
+                'de Rivoli', 'Foch', 'de la Paix', 'Carnot', 'Anatole France', 'des Tilleuls', 'du Stade', 'de la Mairie', 'Lafayette', 'des Peupliers']
+COMMUNES = [('75001', 'Paris'), ('75011', 'Paris'), ('75015', 'Paris'), ('75020', 'Paris'), ('69002', 'Lyon'), ('13001', 'Marseille'), ('31000', 'Toulouse'), ('33000', 'Bordeaux'),
+            ('44000', 'Nantes'), ('59000', 'Lille'), ('67000', 'Strasbourg'), ('06000', 'Nice'), ('35000', 'Rennes'), ('34000', 'Montpellier'), ('93200', 'Saint-Denis'),
+            ('92100', 'Boulogne-Billancourt'), ('94200', 'Ivry-sur-Seine'), ('76000', 'Rouen'), ('21000', 'Dijon'), ('63000', 'Clermont-Ferrand')]
+SUFFIXES = ['', '', '', '', ' bis', ' ter']
+
+def random_address(rng):
+    number = rng.randint(1, 250)
+    street_type, abbreviation = rng.choice(STREET_TYPES)
+    postcode, commune = rng.choice(COMMUNES)
+    return number, rng.choice(SUFFIXES), street_type, abbreviation, rng.choice(STREET_NAMES), postcode, commune
+
+def variant(rng, address):
+    """
+    Autre écriture d'une même adresse, ramenée à la même clé par normalize.address_keys()
+    """
+    number, suffix, street_type, abbreviation, name, postcode, commune = address
+    label = '{0}{1} {2} {3}'.format(number, suffix, rng.choice([street_type, abbreviation, abbreviation + '.']), name)
+    return rng.choice([label, label.upper(), label.lower(), label.replace(' ', '  ')]), postcode, rng.choice([commune, commune.upper()])
+
+def generate_rows(nb_rows, duplicate_rate=0.2, seed=0):
+    """
+    Génère des lignes d'adresses synthétiques
+
+    Paramètres
+    ----------
+    nb_rows: int
+        Nombre de lignes
+    duplicate_rate: float
+        Part des lignes reprenant une adresse déjà générée (0 à 1)
+    seed: int
+        Graine du générateur aléatoire, pour des jeux reproductibles
+    """
+    rng = random.Random(seed)
+    distinct = []
+    for index in range(nb_rows):
+        if distinct and rng.random() < duplicate_rate:
+            address = rng.choice(distinct)
+        else:
+            address = random_address(rng)
+            distinct.append(address)
+        label, postcode, commune = variant(rng, address)
+        yield [index + 1, label, postcode, commune, 'France']
+
+def write_addresses(path, nb_rows, duplicate_rate=0.2, seed=0):
+    """
+    Écrit un CSV d'adresses synthétiques et retourne son chemin
+
+    Paramètres
+    ----------
+    path: str
+        CSV créé
+    nb_rows: int
+        Nombre de lignes
+    duplicate_rate: float
+        Part des lignes reprenant une adresse déjà générée (0 à 1)
+    seed: int
+        Graine du générateur aléatoire
+    """
+    with open(path, 'wb') as file_obj:
+        writer = csv.writer(file_obj, delimiter=',')
+        writer.writerow(COLUMNS)
+        writer.writerows(generate_rows(nb_rows, duplicate_rate, seed))
+    return path
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Génération d'un CSV d'adresses françaises synthétiques")
+    parser.add_argument("-o", "--output", required=True, help="Chemin du CSV créé")
+    parser.add_argument("-n", "--rows", required=False, default=10000, type=int, help="Nombre de lignes (10 000 par défaut)")
+    parser.add_argument("-d", "--duplicates", required=False, default=0.2, type=float, help="Part des lignes en double, de 0 à 1 (0.2 par défaut)")
+    parser.add_argument("-s", "--seed", required=False, default=0, type=int, help="Graine du générateur aléatoire (0 par défaut)")
+    args = parser.parse_args()
+    write_addresses(args.output, args.rows, args.duplicates, args.seed)
@@ -0,0 +1,116 @@
+##!/usr/bin/python
+## -*- coding: utf-8 -*-
+## Python 2.7.X
+
+"""
+Cache persistant des résultats de géocodage
+-------------------------------------------
+Les adresses déjà géocodées lors d'une exécution précédente sont conservées dans une base SQLite locale.
+La clé est le quadruplet (adresse, code postal, commune, pays) normalisé par normalize.address_keys() ; la valeur est le résultat du service qui a géocodé l'adresse (service, score, match_type, match_addr, x, y).
+Les entrées expirent après une durée de vie (ttl) et les moins récemment utilisées sont supprimées au-delà d'un nombre maximal de lignes (max_rows).
+"""
+
+import sqlite3, hashlib, time
+
+CACHE_FIELDS = ['geoc_name', 'loc_name', 'status', 'score', 'match_type', 'match_addr', 'x', 'y']
+
+def cache_key(address_key):
+    """
+    Construit la clé de cache d'une adresse
+
+    Paramètre
+    ---------
+    address_key: str
+        Clé normalisée de l'adresse (normalize.address_keys)
+    """
+    return hashlib.sha1(address_key.encode('utf-8')).hexdigest()
+
+class GeocodingCache:
+    """
+    Cache SQLite des résultats de géocodage
+
+    Attributs
+    ---------
+    path: str
+        Chemin du fichier SQLite
+    ttl: int
+        Durée de vie d'une entrée, en secondes (0 : pas d'expiration)
+    max_rows: int
+        Nombre maximal d'entrées conservées (0 : pas de limite)
+    hits: int
+        Nombre d'adresses trouvées dans le cache
+    misses: int
+        Nombre d'adresses absentes du cache
+
+    Méthodes
+    --------
+    get_many(keys)
+        Retourne les résultats en cache pour une liste de clés
+    put_many(entries)
+        Enregistre des résultats dans le cache
+    evict()
+        Supprime les entrées expirées et les plus anciennes au-delà de max_rows
+    hit_rate()
+        Taux de réponses trouvées dans le cache, en %
+    """
+
+    def __init__(self, path, ttl=0, max_rows=0):
+        self.path = path
+        self.ttl = int(ttl or 0)
+        self.max_rows = int(max_rows or 0)
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS geocoding_cache (key TEXT PRIMARY KEY, geoc_name TEXT, loc_name TEXT, status TEXT, score REAL, match_type TEXT, match_addr TEXT, x REAL, y REAL, created REAL, last_used REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS geocoding_cache_last_used ON geocoding_cache (last_used)")
+        self.connection.commit()
+
+    def get_many(self, keys):
+        """
+        Paramètre
+        ---------
+        keys: list
+            Clés construites avec cache_key()
+        """
+        now = time.time()
+        found = {}
+        keys = list(set(keys))
+        for start in range(0, len(keys), 500): # SQLite limite le nombre de paramètres d'une requête
+            chunk = keys[start:start + 500]
+            cursor = self.connection.execute("SELECT key, {0}, created FROM geocoding_cache WHERE key IN ({1})".format(', '.join(CACHE_FIELDS), ', '.join('?' * len(chunk))), chunk)
+            for row in cursor:
+                if self.ttl and now - row[-1] > self.ttl:
+                    continue
+                found[row[0]] = dict(zip(CACHE_FIELDS, row[1:-1]))
+        if found:
+            self.connection.executemany("UPDATE geocoding_cache SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+            self.connection.commit()
+        return found
+
+    def put_many(self, entries):
+        """
+        Paramètre
+        ---------
+        entries: dict
+            Résultats indexés par clé, chaque résultat étant un dict contenant les champs CACHE_FIELDS
+        """
+        now = time.time()
+        self.connection.executemany("INSERT OR REPLACE INTO geocoding_cache (key, {0}, created, last_used) VALUES (?, {1}, ?, ?)".format(', '.join(CACHE_FIELDS), ', '.join('?' * len(CACHE_FIELDS))), [[key] + [entry.get(field) for field in CACHE_FIELDS] + [now, now] for key, entry in entries.items()])
+        self.connection.commit()
+        self.evict()
+
+    def evict(self):
+        if self.ttl:
+            self.connection.execute("DELETE FROM geocoding_cache WHERE created < ?", (time.time() - self.ttl,))
+        if self.max_rows:
+            self.connection.execute("DELETE FROM geocoding_cache WHERE key IN (SELECT key FROM geocoding_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_rows,))
+        self.connection.commit()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return (float(self.hits) / total) * 100
+
+    def close(self):
+        self.connection.close()
@@ -11,51 +11,55 @@ On crée une classe de géocodage, prenant en paramètre un dictionnaire de conf
     - géocoder avec le service interne,
     - géocoder avec le service Esri,
     - géocoder avec la BAN,
-    - transformer les coordonnées dans un le même système,
+    - transformer les coordonnées dans un le même système (au fil de l'eau, avant l'écriture dans PostgreSQL),
     - exporter les résultats,
     - chaîner l'ensemble des méthodes.
 Cette dernière méthode est celle utilisée par défaut dans l'exécuteur (main.py).
 """
 
-import os, sys, arcpy, subprocess, json, csv, requests, shutil, io
-import pandas as pd
+import os, sys, json, csv, requests, shutil, io, time, itertools, hashlib
 import re
+import pandas as pd
+from cache import GeocodingCache, cache_key
+from http_client import TokenBucket, build_session, post_with_retry, ordered_map, error_status
+from pgload import PgLoader, PgRowBudget
+from spatial_export import export_spatial
+from projection import to_lambert93, LAMBERT93
+from handoff import StageWriter, frame_to_stage, count_rows, read_ids, iter_stage_batches, stage_to_csv
+from normalize import address_keys, address_fingerprints
+from local_geocoder import LocalGeocoder
+from metrics import Metrics
+from manifest import RunManifest
+from scheduler import BatchQueue, Node, RowBudget, rebatch, run_nodes, address_priority, priority_threshold, MAX_PRIORITY
+import numpy as np
+import psycopg2
+
+ESRI_URL = 'https://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/geocodeAddresses'
+BAN_URL = 'https://api-adresse.data.gouv.fr/search/csv/'
+# Le service Esri ne permet de géocoder que 2000 lignes d'un coup à chaque appel de l'API
+ESRI_BATCH_ROWS = 1800
+# Indice du premier lot d'adresses différées du budget Esri, après tous les lots du flux d'entrée
+DEFERRED_BATCH_INDEX = 1000000
+
+# Résultats retenus pour chaque service, les autres adresses passant au service suivant
+MATCHED = {
+    'esri': lambda row: row['status'] != 'U' and row['match_type'] not in ('StreetName', 'Postal'),
+    'ban': lambda row: row['score'] is not None and round(row['score'] / 100, 1) >= 0.6,
+    # Même seuil de score que le service BAN, correspondances au numéro seulement
+    'local': lambda row: row['status'] == 'M' and row['match_type'] == 'housenumber' and round(row['score'] / 100, 1) >= 0.6
+}
 
-def split_csv(filehandler, output_path, output_name, row_limit, delimiter=',', keep_headers=True):
-    import csv
-    output_name_template='{0}_%s.csv'.format(output_name)
-    reader = csv.reader(filehandler, delimiter=delimiter)
-    current_piece = 1
-    current_out_path = os.path.join(
-        output_path,
-        output_name_template % current_piece
-    )
-    current_out_writer = csv.writer(open(current_out_path, 'wb'), delimiter=delimiter)
-    current_limit = row_limit
-    if keep_headers:
-        headers = next(reader)
-        current_out_writer.writerow(headers)
-    for i, row in enumerate(reader):
-        if i + 1 > current_limit:
-            current_piece += 1
-            current_limit = row_limit * current_piece
-            current_out_path = os.path.join(
-                output_path,
-                output_name_template % current_piece
-            )
-            current_out_writer = csv.writer(open(current_out_path, 'wb'), delimiter=delimiter)
-            if keep_headers:
-                current_out_writer.writerow(headers)
-        current_out_writer.writerow(row)
-
-def csv_to_esri_json(csvFilePath, id_adr, address, cpostal, com, country):
+# Caractères retirés des adresses envoyées au service Esri
+SPECIAL_CHARACTERS = re.compile(r'[!#$%&@\[\]_/]')
+
+def records_to_esri_json(records, id_adr, address, cpostal, com, country):
     """
-    Transforme un CSV en JSON adapté pour le service de géocodage World d'Esri
+    Transforme un lot d'adresses en JSON adapté pour le service de géocodage World d'Esri
 
     Paramètres
     ----------
-    csvFilePath: str
-        Chemin du fichier CSV
+    records: list
+        Lignes (dict) du lot d'adresses
     id_adr: str
         Colonne le l'identifiant unique de l'adresse
     address: str
@@ -67,23 +71,57 @@ def csv_to_esri_json(csvFilePath, id_adr, address, cpostal, com, country):
     country: str
         Colonne du pays
     """
-    with open(csvFilePath) as file_obj:
-        rows = csv.DictReader(file_obj, delimiter=',')
-        array = []
-        special_characters = ['!','#','$','%', '&','@','[',']',']','_', '?ï¿½', '/']
-        for index, row in enumerate(rows):
-            id_row = int(row[id_adr])
-            address_format = row[address] + " " + row[cpostal] + " " + row[com] + ", " + row[country]
-            cleanAddress = ''.join(i for i in address_format if not i in special_characters)
-            json_dict = {
-                'attributes': {
-                    'objectid': id_row,
-                    'address': cleanAddress
-                }
+    array = []
+    for row in records:
+        address_format = (row[address] or '') + " " + (row[cpostal] or '') + " " + (row[com] or '') + ", " + (row[country] or '')
+        array.append({
+            'attributes': {
+                'objectid': int(row[id_adr]),
+                'address': SPECIAL_CHARACTERS.sub('', address_format)
             }
-            array.append(json_dict)
-        esriJsonFormat = { 'records': array }
-        return json.dumps(esriJsonFormat)
+        })
+    return json.dumps({ 'records': array })
+
+def esri_status(response):
+    """
+    Statut effectif d'une réponse du service Esri, qui rend ses erreurs (jeton invalide, quota dépassé...) avec le statut HTTP 200 et un objet error
+
+    Paramètre
+    ---------
+    response: requests.Response
+        Réponse du service
+    """
+    if response.status_code != 200:
+        return response.status_code
+    try:
+        content = response.json()
+    except ValueError:
+        content = None
+    if not isinstance(content, dict):
+        return 502 # Réponse illisible (proxy, coupure), traitée comme une erreur transitoire
+    error = content.get('error')
+    if error is None:
+        return 200 if 'locations' in content else 502
+    code = error.get('code') if isinstance(error, dict) else None
+    return int(code) if str(code).isdigit() and int(code) >= 400 else 400
+
+def encode_value(value):
+    """
+    Encode en UTF-8 une valeur texte avant écriture dans un CSV
+    """
+    return value.encode('utf-8') if hasattr(value, 'encode') and not isinstance(value, str) else value
+
+def encode_row(row):
+    """
+    Encode en UTF-8 les valeurs texte d'une ligne avant écriture dans un CSV
+    """
+    return dict((key, encode_value(value)) for key, value in row.items())
+
+def id_key(value):
+    """
+    Forme comparable d'un identifiant, qu'il vienne d'un fichier Arrow, d'un service ou de PostgreSQL
+    """
+    return encode_value(value) if hasattr(value, 'encode') else str(value)
 
 class Geocoding:
     """
@@ -112,9 +150,51 @@ class Geocoding:
     config.LOCATOR: str
         Chemin vers le locator associé au géocodage interne (P:/SIG/06_RESSOURCES/Geocodage/PERSONNALISATION_BDREF/Adresses/ADRESSE_COMPOSITE)
     config.ESRI_MAX_ROWS: str
-        Nombre de lignes max. à consommer par le service payant World Esri
+        Budget d'adresses distinctes du service payant World Esri, dépensé en priorité sur les adresses les plus complètes
     config.ESRIAPIKEY: str
         Clé API Esri
+    config.ESRI_URL: str
+        Adresse du service geocodeAddresses (optionnel, service World d'Esri par défaut)
+    config.ESRI_WORKERS: str
+        Nombre de lots envoyés simultanément au service Esri (optionnel, 1 par défaut)
+    config.ESRI_RATE: str
+        Nombre max. de requêtes par seconde vers le service Esri (optionnel, 0 : pas de limite)
+    config.ESRI_RETRIES: str
+        Nombre de nouvelles tentatives d'un lot en erreur 429 ou 5xx (optionnel, 5 par défaut), y compris les erreurs rendues par Esri avec le statut HTTP 200 ; un lot en erreur non transitoire (jeton invalide, quota dépassé) est en échec sans nouvelle tentative
+    config.ESRI_OUT_SR: str
+        Système de coordonnées demandé au service Esri (optionnel, 102110 soit Lambert-93 par défaut ; 4326 et 3857 sont reprojetés localement)
+    config.BAN_URL: str
+        Adresse du service /search/csv/ (optionnel, API Adresse par défaut)
+    config.BAN_CHUNK_ROWS: str
+        Nombre de lignes par lot envoyé à la BAN (optionnel, 10000 par défaut)
+    config.BAN_WORKERS: str
+        Nombre de lots envoyés simultanément à la BAN (optionnel, 1 par défaut)
+    config.BAN_RATE: str
+        Nombre max. de requêtes par seconde vers la BAN (optionnel, 0 : pas de limite)
+    config.BAN_RETRIES: str
+        Nombre de nouvelles tentatives d'un lot en erreur 429 ou 5xx (optionnel, 5 par défaut)
+    config.LOCAL_INDEX: str
+        Dossier de l'index du géocodeur local construit avec local_geocoder.py à partir d'un export de la BAN (service 'local')
+    config.LOCAL_BATCH_ROWS: str
+        Nombre de lignes par lot géocodé localement (optionnel, 10000 par défaut)
+    config.METRICS: str
+        Fichier des mesures de l'exécution (optionnel, mesures non écrites si absent)
+    config.METRICS_FORMAT: str
+        Format des mesures : jsonl (une ligne JSON par étape et par lot HTTP) ou prometheus (fichier texte pour node_exporter) (optionnel, jsonl par défaut)
+    config.PROFILE: str
+        Fichier du profil cProfile de l'exécution (optionnel, pas de profil si absent)
+    config.RESUME: bool
+        Reprend l'exécution précédente à partir du manifeste au lieu de vider l'espace de travail (optionnel, False par défaut)
+    config.INCREMENTAL: bool
+        Ne géocode que les lignes nouvelles, modifiées ou restées sans résultat depuis l'exécution précédente et met à jour la table existante (optionnel, False par défaut)
+    config.SHARD: int
+        Numéro du lot traité par un worker d'un géocodage réparti (workqueue.py) : la table de sortie partagée est complétée, sans être recréée ni exportée (optionnel)
+    config.ESRI_BUDGET_TABLE: str
+        Table PostgreSQL du budget Esri commun aux workers d'un géocodage réparti, remplaçant le budget local config.ESRI_MAX_ROWS (optionnel)
+    config.SPATIAL_FORMATS: list
+        Formats spatiaux indexés écrits à l'export en plus du CSV : geoparquet, flatgeobuf (optionnel, les deux par défaut ; liste vide : aucun)
+    config.STREAM_MAX_WAIT: str
+        Attente maximale d'une adresse avant l'envoi de son lot, en secondes, pour le géocodage au fil de l'eau (stream.py) (optionnel, 0.05 par défaut)
     config.WORKSPACE: str
         Chemin vers l'espace de travail où les fichiers seront créés
     config.INPUT_A_GEOCODER: str
@@ -122,7 +202,7 @@ class Geocoding:
     config.GEOCODAGE_OUTPUT: str
         Nom du fichier CSV de sortie
     config.GEOCODAGE_ERROR: str
-        Nom du fichier CSV des erreurs de géocodage
+        Nom du fichier des erreurs de géocodage (fichier Arrow de chaque service, CSV des erreurs restantes à l'export)
     config.ID: str
         Colonne de l'identifiant unique des adresses à géocoder
     config.ADRESSE: str
@@ -133,27 +213,83 @@ class Geocoding:
         Colonne de la commune
     config.PAYS: str
         Colonne du pays
+    config.CACHE: str
+        Chemin de la base SQLite du cache de géocodage (optionnel, pas de cache si absent)
+    config.CACHE_TTL: str
+        Durée de vie des entrées du cache, en jours (optionnel, 0 : pas d'expiration)
+    config.CACHE_MAX_ROWS: str
+        Nombre maximal d'entrées du cache (optionnel, 0 : pas de limite)
     pathIn: str
-        Chemin d'entrée du géocodage
+        Fichier Arrow des adresses à géocoder (identifiants à reprendre dans le fichier d'entrée converti)
     pathOut: str
         Chemin de sortie du géocodage
     
     Méthodes
     --------
     clean_workspace()
-        Nettoie l'espace de travail initial
-    geocoding_interne(pathIn, pathOut)
+        Nettoie l'espace de travail initial, ou le conserve en cas de reprise (config.RESUME)
+    get_manifest()
+        Manifeste de l'exécution (étapes et lots terminés)
+    pending(records)
+        Retire d'un lot les adresses déjà présentes dans la table PostgreSQL
+    geocoding_interne(pathIn, pathOut, output)
         Géocodeur interne (basé sur config.LOCATOR)
-    geocoding_esri(pathIn, pathOut)
+    esri_request(session, limiter, records)
+        Envoie un lot d'adresses au service Esri
+    esri_budget()
+        Budget de lignes Esri restant
+    priority_counts()
+        Nombre d'adresses de l'entrée par priorité Esri
+    geocoding_esri(pathIn, pathOut, output)
         Géocodeur Esri (service payant World basé sur config.ESRIAPIKEY
-    geocoding_ban(pathIn, pathOut)
+    ban_request(session, limiter, fieldnames, records)
+        Envoie un lot d'adresses au service CSV de la BAN
+    geocoding_ban(pathIn, pathOut, output)
         Géocodeur BAN
-    geom_proj()
-        Reprojette les points en Lambert-93
+    geocoding_local(pathIn, pathOut, output)
+        Géocodeur local hors ligne (basé sur config.LOCAL_INDEX)
+    service_srid(service)
+        Système de coordonnées des points rendus par un service
+    service_request(service, session, limiter, records)
+        Géocode un lot d'adresses avec un service, hors fichiers et PostgreSQL (utilisé par stream.py)
+    prepare_input()
+        Normalise et dédoublonne le CSV d'entrée, puis le convertit au format Arrow
+    diff_snapshot(adresses)
+        Compare les empreintes des adresses à celles de l'exécution précédente et supprime les résultats obsolètes
+    store_snapshot()
+        Enregistre les empreintes des adresses de l'exécution pour la suivante
+    fan_out(rows, matched)
+        Recopie les résultats sur les lignes en double
+    stage_batches(pathIn, batch_size)
+        Lit par lots les adresses restant à géocoder
+    load_stage(rows, matched, pathOut, service)
+        Charge en flux les résultats d'un service dans PostgreSQL et écrit les erreurs au format Arrow
+    input_batches(pathIn, batch_size)
+        Lots d'adresses reçus par un service, depuis un fichier Arrow ou la file du service précédent
+    forward(output, records, pathErrors)
+        Transmet au service suivant les adresses non géocodées d'un lot
+    service_batches(service, batches, pathOut, output, start)
+        Lots d'adresses à envoyer à un service, hors lots déjà chargés
+    load_batches(results, matched, pathOut, service, srid, output)
+        Charge lot par lot les résultats d'un service, chaque lot étant validé, noté dans le manifeste et ses erreurs transmises au service suivant
+    geom_proj(rows, srid)
+        Reprojette en Lambert-93 les points produits par un service, au fil de l'eau
     export_results()
-        Exporte les résultats des géocodeurs dans un dossier final
+        Exporte les résultats des géocodeurs dans un dossier final (CSV, GeoParquet et FlatGeobuf)
+    spatial_formats()
+        Formats spatiaux écrits à l'export
+    cache_lookup()
+        Sépare les adresses déjà présentes dans le cache de celles à géocoder
+    cache_load_hits()
+        Insère les adresses trouvées dans le cache dans la table PostgreSQL
+    cache_store()
+        Enregistre dans le cache les adresses géocodées lors de l'exécution
+    replay_stage(service, output)
+        Transmet au service suivant les erreurs d'un service terminé lors d'une exécution précédente
+    run_service(service, pathIn, pathOut, output)
+        Lance le géocodeur d'un service en mesurant sa durée
     chain_geocoding()
-        Enchaîne l'ensemble des tâches
+        Enchaîne l'ensemble des tâches, les services s'exécutant en même temps sur des lots différents
     """
 
     def __init__(self, config):
@@ -164,35 +300,396 @@ class Geocoding:
             Objet de configuration
         """
 
-        if len(config["ADRESSE"]) > 10 or len(config["CODE_POSTAL"]) > 10 or len(config["COMMUNE"]) > 10 or len(config["PAYS"]) > 10:
-            sys.stdout.write("Le nom des colonnes adresse, code_postal, commune et pays ne doit pas dépasser 10 caractères.")
-            sys.stdout.flush()
-            exit()
-        else:
-            self.config = config
+        self.config = config
+        self.cache = None
+        self.cache_misses = {}
+        self.cache_hits = []
+        self.loader = None
+        self.input_stage = None
+        self.last_stage = None
+        self.duplicates = {}
+        self.local_geocoder = None
+        self.manifest = None
+        self.resuming = False
+        self.existing_ids = set()
+        self.nb_resumed = 0
+        self.metrics = Metrics(config.get("METRICS"), config.get("METRICS_FORMAT"), config.get("PROFILE"))
 
     def clean_workspace(self):
-        sys.stdout.write('Suppression des fichiers d\'export s\'ils existent déjà')
+        workspaceFolder = os.path.join(self.config["WORKSPACE"], 'geocodage')
+        with self.metrics.stage('clean_workspace'):
+            if self.config.get("RESUME") and os.path.exists(workspaceFolder):
+                if self.get_manifest().compatible():
+                    self.resuming = True
+                    sys.stdout.write('Reprise de l\'exécution précédente : espace de travail conservé')
+                    sys.stdout.flush()
+                    return
+                sys.stdout.write('Le manifeste ne correspond pas à cette exécution (fichier d\'entrée, services ou tailles de lots modifiés) : nouvelle exécution')
+                sys.stdout.flush()
+            sys.stdout.write('Suppression des fichiers d\'export s\'ils existent déjà')
+            sys.stdout.flush()
+            try:
+                if os.path.exists(workspaceFolder):
+                    shutil.rmtree(workspaceFolder)
+                os.mkdir(workspaceFolder)
+                sys.stdout.write('Espace de travail prêt')
+                sys.stdout.flush()
+            except OSError as error:
+                sys.stdout.write(str(error))
+                sys.stdout.flush()
+                pass
+            self.manifest = None
+            self.get_manifest().start()
+
+    def run_signature(self):
+        """
+        Paramètres dont dépendent les lots : une reprise n'est possible que s'ils sont inchangés
+        """
+        stat = os.stat(self.config["INPUT_A_GEOCODER"])
+        return {'input': os.path.abspath(self.config["INPUT_A_GEOCODER"]), 'size': stat.st_size, 'mtime': int(stat.st_mtime), 'services': list(self.config["GEOCODINGSERVICES"]), 'output': str(self.config["GEOCODAGE_OUTPUT"]), 'cache': bool(self.config.get("CACHE")), 'incremental': bool(self.config.get("INCREMENTAL")), 'batches': [ESRI_BATCH_ROWS, int(self.config.get("BAN_CHUNK_ROWS") or 10000), int(self.config.get("LOCAL_BATCH_ROWS") or 10000)]}
+
+    def get_manifest(self):
+        if self.manifest is None:
+            self.make_dir(os.path.join(self.config["WORKSPACE"], 'geocodage'))
+            self.manifest = RunManifest(os.path.join(self.config["WORKSPACE"], 'geocodage', 'manifest.json'), self.run_signature())
+        return self.manifest
+
+    def make_dir(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def pending(self, records):
+        """
+        Retire d'un lot les adresses déjà présentes dans la table PostgreSQL lors d'une reprise
+
+        Paramètre
+        ---------
+        records: list
+            Lignes (dict) du lot d'adresses
+        """
+        if not self.existing_ids:
+            return records
+        return [record for record in records if id_key(record[self.config["ID"]]) not in self.existing_ids]
+
+    def input_columns(self):
+        """
+        Colonnes du CSV d'entrée transmises aux services, dans l'ordre
+        """
+        return [self.config["ID"], self.config["ADRESSE"], self.config["CODE_POSTAL"], self.config["COMMUNE"], self.config["PAYS"]]
+
+    def stage_path(self, service):
+        """
+        Fichier Arrow des adresses non géocodées par un service
+        """
+        return os.path.join(self.config["WORKSPACE"], "geocodage", service, "{0}.arrow".format(str(self.config["GEOCODAGE_ERROR"]).split('.')[0]))
+
+    def prepare_input(self):
+        """
+        Normalise et dédoublonne les adresses du CSV d'entrée, puis écrit une ligne par adresse distincte au format Arrow
+
+        Les lignes en double sont rattachées à l'identifiant de la première ligne de leur groupe (self.duplicates) et reçoivent son résultat au chargement.
+        """
+        start = time.time()
+        self.input_stage = os.path.join(self.config["WORKSPACE"], "geocodage", "adresses.arrow")
+        pathDuplicates = os.path.join(self.config["WORKSPACE"], "geocodage", "doublons.json")
+        if self.resuming and self.get_manifest().stage_done('prepare_input') and os.path.exists(self.input_stage) and os.path.exists(pathDuplicates):
+            with open(pathDuplicates) as file_obj:
+                self.duplicates = dict((id_groupe, [encode_value(id_adresse) for id_adresse in ids]) for id_groupe, ids in json.load(file_obj).items())
+            sys.stdout.write('Adresses déjà normalisées et dédoublonnées lors de l\'exécution précédente')
+            sys.stdout.flush()
+            return self.input_stage
+        sys.stdout.write('Normalisation et dédoublonnage des adresses du fichier d\'entrée')
+        sys.stdout.flush()
+        adresses = pd.read_csv(self.config["INPUT_A_GEOCODER"], sep=',', dtype=str, keep_default_na=False, encoding='utf-8', usecols=self.input_columns())
+        nb_rows = len(adresses)
+        if self.config.get("INCREMENTAL"):
+            adresses = self.diff_snapshot(adresses)
+        adresses['cle_adresse'] = address_keys(adresses, self.input_columns()[1:])
+        adresses['id_groupe'] = adresses.groupby('cle_adresse', sort=False)[self.config["ID"]].transform('first')
+        doublons = adresses[adresses[self.config["ID"]] != adresses['id_groupe']]
+        self.duplicates = dict((id_groupe, [encode_value(id_adresse) for id_adresse in ids]) for id_groupe, ids in doublons.groupby('id_groupe')[self.config["ID"]].apply(list).items())
+        nb_unique = frame_to_stage(adresses[adresses[self.config["ID"]] == adresses['id_groupe']], self.input_stage, self.input_columns() + ['cle_adresse'])
+        sys.stdout.write('{0} lignes, {1} adresses distinctes à géocoder (dédoublonnage : {2:.1f} %)'.format(len(adresses), nb_unique, (1 - float(nb_unique) / max(len(adresses), 1)) * 100))
+        sys.stdout.flush()
+        with open(pathDuplicates, 'w') as file_obj:
+            json.dump(self.duplicates, file_obj)
+        self.get_manifest().mark_stage('prepare_input', 'done', rows=nb_rows, distinct=nb_unique)
+        self.metrics.record('prepare_input', None, time.time() - start, rows_in=nb_rows, rows_out=nb_unique, bytes=os.path.getsize(self.config["INPUT_A_GEOCODER"]))
+        return self.input_stage
+
+    def snapshot_table(self):
+        """
+        Table PostgreSQL des empreintes d'adresses de la dernière exécution incrémentale
+        """
+        return '{0}.{1}_empreintes'.format(self.config["PGSCHEMA"], str(self.config["GEOCODAGE_OUTPUT"]).split('.')[0])
+
+    def diff_snapshot(self, adresses):
+        """
+        Compare l'empreinte des colonnes d'adresse de chaque identifiant à celle de l'exécution précédente, supprime de la table les résultats des identifiants retirés ou modifiés
+        et retourne les lignes nouvelles, modifiées, ou inchangées mais absentes de la table (non géocodées lors d'une exécution précédente)
+
+        Les lignes inchangées restées sans résultat sont renvoyées aux services, pour profiter d'un service rétabli, d'un budget Esri plus large ou d'un nouvel index local.
+        Les empreintes de l'exécution sont écrites dans empreintes.arrow et ne remplacent celles de la base qu'une fois l'exécution terminée (store_snapshot).
+
+        Paramètre
+        ---------
+        adresses: pandas.DataFrame
+            Lignes du CSV d'entrée
+        """
+        loader = self.get_loader()
+        loader.create_table(overwrite=False)
+        adresses['empreinte'] = address_fingerprints(adresses, self.input_columns()[1:])
+        frame_to_stage(adresses, os.path.join(self.config["WORKSPACE"], "geocodage", "empreintes.arrow"), [self.config["ID"], 'empreinte'])
+        loader.execute("CREATE TABLE IF NOT EXISTS {0} ({1} text, empreinte text)".format(self.snapshot_table(), self.config["ID"]))
+        previous = dict((id_key(id_adresse), empreinte) for id_adresse, empreinte in loader.execute("SELECT {0}, empreinte FROM {1}".format(self.config["ID"], self.snapshot_table())))
+        keys = adresses[self.config["ID"]].map(id_key)
+        known = keys.isin(set(previous))
+        unchanged = keys.map(previous) == adresses['empreinte']
+        nb_new = int((~known).sum())
+        removed = set(previous).difference(keys)
+        # Les résultats des adresses modifiées sont supprimés aussi : elles n'y reviennent que si un service les géocode à nouveau
+        obsolete = list(removed) + keys[known & ~unchanged].tolist()
+        nb_deleted = loader.delete_keys(obsolete) if obsolete else 0
+        # La table ne contient que des adresses géocodées : une adresse inchangée qui n'y figure pas reste à géocoder
+        loaded = set(id_key(row[0]) for row in loader.execute("SELECT {0} FROM {1}".format(self.config["ID"], loader.table)))
+        unmatched = unchanged & ~keys.isin(loaded)
+        sys.stdout.write('Géocodage incrémental : {0} lignes inchangées (dont {1} sans résultat, renvoyées aux services), {2} nouvelles, {3} modifiées, {4} supprimées ({5} résultats retirés de la table)'.format(int(unchanged.sum()), int(unmatched.sum()), nb_new, len(obsolete) - len(removed), len(removed), nb_deleted))
         sys.stdout.flush()
+        return adresses[~unchanged | unmatched].drop(columns='empreinte')
+
+    def store_snapshot(self):
+        """
+        Remplace les empreintes de l'exécution précédente par celles de cette exécution
+        """
+        pathSnapshot = os.path.join(self.config["WORKSPACE"], "geocodage", "empreintes.arrow")
+        with self.metrics.stage('store_snapshot') as stage:
+            rows = (row for records in iter_stage_batches(pathSnapshot, pathSnapshot, self.config["ID"], 65536) for row in records)
+            stage.count(rows_out=self.get_loader().replace_rows(self.snapshot_table(), [self.config["ID"], 'empreinte'], (encode_row(row) for row in rows)))
+
+    def fan_out(self, rows, matched):
+        """
+        Recopie le résultat de chaque adresse géocodée sur les lignes en double qui lui sont rattachées
+
+        Les adresses non géocodées ne sont pas recopiées, pour que les services suivants ne reçoivent qu'une ligne par adresse distincte.
+
+        Paramètres
+        ----------
+        rows: iterable
+            Lignes (dict) produites par un service
+        matched: function
+            Fonction indiquant si une ligne est géocodée
+        """
+        for row in rows:
+            yield row
+            if self.duplicates and matched(row):
+                id_groupe = row[self.config["ID"]] if hasattr(row[self.config["ID"]], 'encode') else str(row[self.config["ID"]])
+                for id_adresse in self.duplicates.get(id_groupe, []):
+                    duplicate = dict(row)
+                    duplicate[self.config["ID"]] = id_adresse
+                    yield duplicate
+
+    def stage_batches(self, pathIn, batch_size):
+        """
+        Lit par lots les adresses restant à géocoder : identifiants dans pathIn, colonnes dans le fichier d'entrée
+
+        Paramètres
+        ----------
+        pathIn: str
+            Fichier Arrow des adresses à géocoder
+        batch_size: int
+            Nombre de lignes par lot
+        """
+        if self.input_stage is None:
+            self.input_stage = pathIn
+        return iter_stage_batches(self.input_stage, pathIn, self.config["ID"], batch_size, self.input_columns())
+
+    def output_columns(self):
+        """
+        Colonnes de la table de résultats et des CSV d'erreurs, dans l'ordre
+        """
+        return [self.config["ID"], 'geoc_name', 'loc_name', 'status', 'score', 'match_type', 'match_addr', self.config["ADRESSE"], self.config["CODE_POSTAL"], self.config["COMMUNE"], self.config["PAYS"], 'x', 'y']
+
+    def get_loader(self):
+        if self.loader is None:
+            # Une connexion par service, les services chargeant leurs lots en même temps ; en mode incrémental ou réparti, les lignes chargées remplacent celles de même identifiant (ON CONFLICT)
+            upsert = self.config.get("INCREMENTAL") or self.config.get("SHARD") is not None
+            self.loader = PgLoader(self.config, '{0}.{1}'.format(self.config["PGSCHEMA"], str(self.config["GEOCODAGE_OUTPUT"]).split('.')[0]), self.output_columns(), maxconn=len(self.config["GEOCODINGSERVICES"]) + 2, key=self.config["ID"] if upsert else None)
+        return self.loader
+
+    def load_stage(self, rows, matched, pathOut, service):
+        """
+        Insère en flux les lignes géocodées par un service dans la table PostgreSQL et écrit les autres dans le fichier Arrow des erreurs
+
+        Paramètres
+        ----------
+        rows: iterable
+            Lignes (dict) produites par le service
+        matched: function
+            Fonction indiquant si une ligne est géocodée
+        pathOut: str
+            Dossier de sortie du service
+        service: str
+            Nom du service
+        """
+        loader = self.get_loader()
+        loader.create_table(overwrite=False)
+        start = time.time()
+        try:
+            sys.stdout.write('Enregistrement des adresses géocodées par le service {0} dans une table PostgreSQL et des erreurs au format Arrow'.format(service))
+            sys.stdout.flush()
+            with StageWriter(os.path.join(pathOut, "{0}.arrow".format(str(self.config["GEOCODAGE_ERROR"]).split('.')[0])), self.output_columns()) as errors:
+                nb_matched, nb_unmatched = loader.load(self.fan_out(rows, matched), matched, errors)
+            self.last_stage = errors.path
+            # Durée du COPY, qui inclut la production des lignes par le service (chargement en flux)
+            self.metrics.record('load', service, time.time() - start, matched=nb_matched, unmatched=nb_unmatched, bytes=loader.nb_bytes)
+            self.get_manifest().mark_stage(service, 'done', matched=nb_matched, unmatched=nb_unmatched)
+            sys.stdout.write('Exporté : {0} adresses géocodées, {1} erreurs'.format(nb_matched, nb_unmatched))
+            sys.stdout.flush()
+        except psycopg2.Error as e:
+            # Erreur relevée : le service ne se termine pas en silence (file amont abandonnée par Node.run, lot de la file de travail renvoyé)
+            self.get_manifest().mark_stage(service, 'failed', error=str(e))
+            sys.stdout.write(str(e))
+            sys.stdout.flush()
+            raise
+
+    def batch_path(self, pathOut, index):
+        return os.path.join(pathOut, 'lots', '{0:06d}.arrow'.format(index))
+
+    def input_batches(self, pathIn, batch_size):
+        """
+        Lots d'adresses reçus par un service : lus dans un fichier Arrow, ou regroupés au fil de l'eau depuis la file du service précédent
+
+        Paramètres
+        ----------
+        pathIn: str ou scheduler.BatchQueue
+            Fichier Arrow des adresses à géocoder, ou file des adresses non géocodées par le service précédent
+        batch_size: int
+            Nombre de lignes par lot
+        """
+        if isinstance(pathIn, BatchQueue):
+            return rebatch(pathIn, batch_size)
+        return self.stage_batches(pathIn, batch_size)
+
+    def forward(self, output, records, pathErrors):
+        """
+        Transmet au service suivant les adresses d'un lot restées dans le fichier Arrow des erreurs de ce lot
+
+        Paramètres
+        ----------
+        output: scheduler.BatchQueue
+            File du service suivant (None pour le dernier service)
+        records: list
+            Lignes (dict) du lot, avec les colonnes d'entrée
+        pathErrors: str
+            Fichier Arrow des erreurs du lot
+        """
+        if output is None or not records:
+            return
+        ids = read_ids(pathErrors, self.config["ID"])
+        unmatched = [record for record in records if record[self.config["ID"]] in ids]
+        if unmatched:
+            output.put(unmatched)
+
+    def service_batches(self, service, batches, pathOut, output=None, start=0):
+        """
+        Lots d'adresses à envoyer à un service, sous la forme (indice, empreinte des identifiants, adresses restant à géocoder)
+
+        Les lots déjà chargés lors d'une exécution précédente (même indice, mêmes identifiants) sont ignorés, leurs erreurs étant transmises au service suivant.
+
+        Paramètres
+        ----------
+        service: str
+            Nom du service
+        batches: iterable
+            Lots d'adresses (input_batches)
+        pathOut: str
+            Dossier de sortie du service
+        output: scheduler.BatchQueue
+            File du service suivant (optionnel)
+        start: int
+            Indice du premier lot
+        """
+        for index, records in enumerate(batches, start):
+            fingerprint = hashlib.sha1(u'|'.join(record[self.config["ID"]] for record in records).encode('utf-8')).hexdigest()
+            if self.get_manifest().batch_done(service, index, fingerprint) and os.path.exists(self.batch_path(pathOut, index)):
+                self.forward(output, records, self.batch_path(pathOut, index))
+                continue
+            yield index, fingerprint, self.pending(records)
+
+    def load_batches(self, results, matched, pathOut, service, srid, output=None):
+        """
+        Charge lot par lot les résultats d'un service : chaque lot est validé dans PostgreSQL, ses erreurs écrites dans un fichier Arrow et transmises au service suivant, et son état noté dans le manifeste
+
+        Une interruption ne fait donc perdre que les lots en cours. Les adresses d'un lot en échec passent au service suivant et le lot est renvoyé à la reprise (config.RESUME).
+
+        Paramètres
+        ----------
+        results: iterable
+            Lots traités par le service : (indice, empreinte, adresses envoyées, lignes produites ou None en cas d'échec, adresses non envoyées)
+        matched: function
+            Fonction indiquant si une ligne est géocodée
+        pathOut: str
+            Dossier de sortie du service
+        service: str
+            Nom du service
+        srid: str
+            Système de coordonnées du service, reprojeté en Lambert-93
+        output: scheduler.BatchQueue
+            File du service suivant (optionnel)
+        """
+        loader = self.get_loader()
+        loader.create_table(overwrite=False)
+        self.make_dir(os.path.join(pathOut, 'lots'))
+        nb_failed = 0
         try:
-            if os.path.exists(os.path.join(self.config["WORKSPACE"], 'geocodage')):
-                shutil.rmtree(os.path.join(self.config["WORKSPACE"], 'geocodage'))
-            workspaceFolder = os.path.join(self.config["WORKSPACE"], 'geocodage')
-            os.mkdir(workspaceFolder)
-            sys.stdout.write('Espace de travail prêt')
+            sys.stdout.write('Enregistrement lot par lot des adresses géocodées par le service {0} dans une table PostgreSQL et des erreurs au format Arrow'.format(service))
             sys.stdout.flush()
-        except OSError as error:
-            sys.stdout.write(str(error))
+            for index, fingerprint, records, rows, unsent in results:
+                start = time.time()
+                with StageWriter(self.batch_path(pathOut, index), self.output_columns()) as errors:
+                    errors.writerows(unsent)
+                    if rows is None:
+                        errors.writerows(records)
+                        nb_matched, nb_unmatched = 0, len(records)
+                        nb_failed += 1
+                    else:
+                        nb_matched, nb_unmatched = loader.load(self.fan_out(self.geom_proj(rows, srid), matched), matched, errors)
+                self.forward(output, records + unsent, errors.path)
+                self.get_manifest().mark_batch(service, index, 'failed' if rows is None else 'done', ids=fingerprint, sent=len(records), matched=nb_matched, unmatched=nb_unmatched)
+                self.metrics.record('load', service, time.time() - start, matched=nb_matched, unmatched=nb_unmatched, bytes=0 if rows is None else loader.nb_bytes)
+        except psycopg2.Error as e:
+            self.get_manifest().mark_stage(service, 'failed', error=str(e))
+            sys.stdout.write(str(e))
             sys.stdout.flush()
-            pass
+            raise
+        # Erreurs de tous les lots du manifeste, y compris ceux d'une exécution précédente, réunies dans l'ordre
+        with StageWriter(self.stage_path(service), self.output_columns()) as errors:
+            for index, batch in self.get_manifest().batches(service):
+                pathBatch = self.batch_path(pathOut, index)
+                if os.path.exists(pathBatch):
+                    for records in iter_stage_batches(pathBatch, pathBatch, self.config["ID"], 65536):
+                        errors.writerows(records)
+        self.last_stage = errors.path
+        self.get_manifest().mark_stage(service, 'partial' if nb_failed else 'done', failed=nb_failed)
+        sys.stdout.write('Exporté : {0} adresses restant à géocoder, {1} lot(s) en échec'.format(errors.nb_rows, nb_failed))
+        sys.stdout.flush()
 
-    def geocoding_interne(self, pathIn, pathOut):
-        os.mkdir(pathOut)
-        input_adresse_interne = pathIn
+    def geocoding_interne(self, pathIn, pathOut, output=None):
+        import arcpy # Seul le service interne dépend d'ArcGIS : les autres services (et les benchmarks) fonctionnent sans ArcPy
+        self.make_dir(pathOut)
+        # Tables en mémoire : pas de shapefile intermédiaire ni de limite de 10 caractères sur les noms de colonnes
+        input_adresse_interne = "in_memory\\adresses_interne"
         LOCATOR_INTERNE = self.config["LOCATOR"]
-        output_adresse_interne = "{0}/{1}.shp".format(pathOut, str(self.config["GEOCODAGE_OUTPUT"]).split('.')[0])
+        output_adresse_interne = "in_memory\\geocodage_interne"
 
         try:
+            arcpy.CreateTable_management("in_memory", "adresses_interne")
+            for column in self.input_columns():
+                arcpy.AddField_management(input_adresse_interne, column, "TEXT", field_length=255)
+            with arcpy.da.InsertCursor(input_adresse_interne, self.input_columns()) as cursor:
+                for records in self.input_batches(pathIn, 10000):
+                    for record in self.pending(records):
+                        cursor.insertRow([record[column] for column in self.input_columns()])
             sys.stdout.write('Lancement du géocodage interne')
             sys.stdout.flush()
             arcpy.GeocodeAddresses_geocoding(input_adresse_interne, LOCATOR_INTERNE, "adresse {0} VISIBLE NONE;cpostal {1} VISIBLE NONE".format(self.config["ADRESSE"], self.config["CODE_POSTAL"]), output_adresse_interne, "STATIC", "", "")
@@ -201,191 +698,464 @@ class Geocoding:
             sys.stdout.write(e.args[0])
             sys.stdout.flush()
 
-        try:
-            sys.stdout.write('Enregistrement des adresses géocodées par le locator interne dans une table PostgreSQL')
-            sys.stdout.flush()
-            os.chdir(self.config["QGISBINPATH"])
-            subprocess.check_call(['ogr2ogr', '-f', 'PostgreSQL', 'PG:host={0} port={1} dbname={2} user={3} password={4}'.format(self.config["PGHOST"], self.config["PGPORT"], self.config["PGDBNAME"], self.config["PGUSER"], self.config["PGPWD"]), "{0}\{1}.shp".format(pathOut, str(self.config["GEOCODAGE_OUTPUT"]).split(".")[0]), '-overwrite', '-dialect', 'sqlite', '-sql', "SELECT {0}, 'Interne' as geoc_name, loc_name, status, score, match_type, match_addr, {1}, {2}, {3}, {4}, ST_X(geometry) as x, ST_Y(geometry) as y FROM {5} where status <> 'U'".format(self.config["ID"], self.config["ADRESSE"], self.config["CODE_POSTAL"], self.config["COMMUNE"], self.config["PAYS"], str(self.config["GEOCODAGE_OUTPUT"]).split('.')[0]), '-lco', 'OVERWRITE=yes', '-nln', '{0}.{1}'.format(self.config["PGSCHEMA"], str(self.config["GEOCODAGE_OUTPUT"]).split('.')[0])])
-            sys.stdout.write('Exporté')
-            sys.stdout.flush()
-        except subprocess.CalledProcessError as e:
-            sys.stdout.write(e.output)
-            sys.stdout.flush()
+        def rows():
+            fields = [self.config["ID"], 'Loc_name', 'Status', 'Score', 'Match_type', 'Match_addr', self.config["ADRESSE"], self.config["CODE_POSTAL"], self.config["COMMUNE"], self.config["PAYS"], 'SHAPE@X', 'SHAPE@Y']
+            with arcpy.da.SearchCursor(output_adresse_interne, fields) as cursor:
+                for row in cursor:
+                    yield encode_row(dict(zip(self.output_columns(), [row[0], 'Interne'] + list(row[1:]))))
+        self.load_stage(rows(), lambda row: row['status'] != 'U', pathOut, 'interne')
+        arcpy.Delete_management(input_adresse_interne)
+        arcpy.Delete_management(output_adresse_interne)
+        # Le géocodage interne porte sur toute la table en une fois : ses erreurs ne partent vers le service suivant qu'à la fin
+        self.replay_stage('interne', output)
 
-        try:
-            sys.stdout.write('Sélection des adresses non géocodées précédemment et export en CSV pour poursuivre le géocodage des erreurs')
-            sys.stdout.flush()
-            subprocess.check_call(['ogr2ogr', '-f', 'CSV', "{0}\{1}".format(pathOut, self.config["GEOCODAGE_ERROR"]), "{0}\{1}.shp".format(pathOut, str(self.config["GEOCODAGE_OUTPUT"]).split('.')[0]), '-sql', "SELECT {0}, 'Interne' as geoc_name, loc_name, status, score, match_type, match_addr, {1}, {2}, {3}, {4}, '' as x, '' as y FROM {5} where status = 'U'".format(self.config["ID"], self.config["ADRESSE"], self.config["CODE_POSTAL"], self.config["COMMUNE"], self.config["PAYS"], str(self.config["GEOCODAGE_OUTPUT"]).split('.')[0])])
-            sys.stdout.write('Exporté')
-            sys.stdout.flush()
-        except subprocess.CalledProcessError as e:
-            sys.stdout.write(e.output)
-            sys.stdout.flush()
-    
-    def geocoding_esri(self, pathIn, pathOut):
-        os.mkdir(pathOut)
-        input_adresse_esri = pathIn
-        esri_batch_geocoding = 1800 # Le service Esri ne permet de géocoder que 2000 lignes d'un coup à chaque appel de l'API
-        split_csv(open('{0}'.format(input_adresse_esri), 'r'), pathOut, "adresses_a_geoc_esri", esri_batch_geocoding)
-        for index, csv in enumerate(os.listdir(pathOut)):
-            if csv.startswith("adresses_a_geoc_esri") and csv.endswith(".csv"):
-                try:
-                    input_adresse_esri_to_json = csv_to_esri_json(os.path.join(pathOut, csv), self.config["ID"], self.config["ADRESSE"], self.config["CODE_POSTAL"], self.config["COMMUNE"], self.config["PAYS"])
-                    try:
-                        sys.stdout.write('Lancement du géocodage Esri (World service) des adresses non géocodées précédemment')
-                        sys.stdout.flush()
-                        headers = { 'Content-Type': 'application/x-www-form-urlencoded','charset': 'utf-8' }
-                        data = 'f=json&addresses={0}&token={1}&outSR=102110'.format(input_adresse_esri_to_json, self.config["ESRIAPIKEY"])
-                        response = requests.post('https://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/geocodeAddresses', headers=headers, data=data)
-                        outEsriGeoc = response.json()
-                        sys.stdout.write('Géocodage terminé')
-                        sys.stdout.flush()
-                        rows = []
-                        for data in [outEsriGeoc]:
-                            data_rows = data['locations']
-                            for row in data_rows:
-                                rows.append({self.config["ID"]: row['attributes']['ResultID'], 'loc_name': row['attributes']['Loc_name'], 'status': row['attributes']['Status'], 'score': row['attributes']['Score'], 'match_type': row['attributes']['Addr_type'], 'match_addr': row['attributes']['Match_addr'], self.config["ADRESSE"]: row['attributes']['Place_addr'], self.config["CODE_POSTAL"]: row['attributes']['Postal'], self.config["COMMUNE"]: row['attributes']['City'], self.config["PAYS"]: row['attributes']['CntryName'], 'x': row['attributes']['X'], 'y': row['attributes']['Y']})
-                        data = pd.DataFrame(rows)
-                        if index == 0:
-                            data.to_csv("{0}\{1}".format(pathOut, self.config["GEOCODAGE_OUTPUT"]), sep=';', index=False, encoding='utf-8')
-                        elif index > 0:
-                            data.to_csv("{0}\{1}".format(pathOut, self.config["GEOCODAGE_OUTPUT"]), sep=';', mode='a', index=False, header=False, encoding='utf-8')
-                    except requests.exceptions.HTTPError as e:
-                        sys.stdout.write(str(e))
-                        sys.stdout.flush()
-                except subprocess.CalledProcessError as e:
-                    sys.stdout.write(e.output)
-                    sys.stdout.flush()
-        try:
-            sys.stdout.write('Enregistrement des adresses géocodées par Esri dans une table PostgreSQL (insertion dans la même table que précédemment)')
-            sys.stdout.flush()
-            subprocess.check_call(['ogr2ogr', '-f', 'PostgreSQL', "PG:host={0} port={1} dbname={2} user={3} password={4}".format(self.config["PGHOST"], self.config["PGPORT"], self.config["PGDBNAME"], self.config["PGUSER"], self.config["PGPWD"]), "{0}\{1}".format(pathOut, self.config["GEOCODAGE_OUTPUT"]), '-sql', "SELECT {0}, 'Esri' as geoc_name, loc_name, status, score, match_type, match_addr, {1}, {2}, {3}, {4}, x, y FROM {5} where status <> 'U' or addr_type <> 'StreetName' or addr_type <> 'Postal'".format(self.config["ID"], self.config["ADRESSE"], self.config["CODE_POSTAL"], self.config["COMMUNE"], self.config["PAYS"], str(self.config["GEOCODAGE_OUTPUT"]).split('.')[0]), '-dialect', 'sqlite', '-nln', '{0}.{1}'.format(self.config["PGSCHEMA"], str(self.config["GEOCODAGE_OUTPUT"]).split('.')[0])])
-            sys.stdout.write('Exporté')
-            sys.stdout.flush()
-        except subprocess.CalledProcessError as e:
-            sys.stdout.write(e.output)
-            sys.stdout.flush()
+    def esri_request(self, session, limiter, records):
+        """
+        Envoie un lot d'adresses au service Esri et retourne les lignes géocodées, triées par identifiant (None en cas d'échec)
 
+        Paramètres
+        ----------
+        session: requests.Session
+            Session HTTP partagée entre les lots
+        limiter: http_client.TokenBucket
+            Limiteur de débit partagé entre les lots
+        records: list
+            Lignes (dict) du lot d'adresses
+        """
+        input_adresse_esri_to_json = records_to_esri_json(records, self.config["ID"], self.config["ADRESSE"], self.config["CODE_POSTAL"], self.config["COMMUNE"], self.config["PAYS"])
+        data = {'f': 'json', 'addresses': input_adresse_esri_to_json, 'token': self.config["ESRIAPIKEY"], 'outSR': self.config.get("ESRI_OUT_SR") or '102110'}
+        start = time.time()
         try:
-            sys.stdout.write('Sélection des adresses non géocodées par Esri précédemment et export en CSV')
-            sys.stdout.flush()
-            subprocess.check_call(['ogr2ogr', '-f', 'CSV', "{0}/{1}".format(pathOut, self.config["GEOCODAGE_ERROR"]), "{0}/{1}".format(pathOut, self.config["GEOCODAGE_OUTPUT"]), '-sql', "SELECT {0}, 'Esri' as geoc_name, loc_name, status, score, match_type, match_addr, {1}, {2}, {3}, {4}, x, y FROM {5} where status = 'U' or addr_type = 'StreetName' or addr_type = 'Postal'".format(self.config["ID"], self.config["ADRESSE"], self.config["CODE_POSTAL"], self.config["COMMUNE"], self.config["PAYS"], str(self.config["GEOCODAGE_OUTPUT"]).split('.')[0])])
-            sys.stdout.write('Exporté')
+            response = post_with_retry(session, self.config.get("ESRI_URL") or ESRI_URL, limiter, retries=int(self.config.get("ESRI_RETRIES") or 5), status=esri_status, data=data, timeout=300)
+        except requests.exceptions.RequestException as e:
+            self.metrics.observe_http('esri', time.time() - start, len(records), len(input_adresse_esri_to_json), 0, error_status(e))
+            sys.stdout.write(str(e))
             sys.stdout.flush()
-        except subprocess.CalledProcessError as e:
-            sys.stdout.write(e.output)
+            return None
+        status = esri_status(response)
+        self.metrics.observe_http('esri', time.time() - start, len(records), len(response.request.body or ''), len(response.content), status)
+        if status >= 400:
+            # Erreur rendue avec le statut HTTP 200, non transitoire ou toujours présente après les reprises : seul ce lot est en échec
+            sys.stdout.write('Erreur du service Esri ({0}) : {1}'.format(status, response.content[:500]))
             sys.stdout.flush()
-    
-    def geocoding_ban(self, pathIn, pathOut):
-        os.mkdir(pathOut)
-        try:
-            sys.stdout.write('Lancement du géocodage BAN') # Documentation : https://adresse.data.gouv.fr/api-doc/adresse
-            sys.stdout.flush()
-            subprocess.check_output(['curl', '-X', 'POST', '-F', 'data=@{0}'.format(pathIn), 'https://api-adresse.data.gouv.fr/search/csv/', '-F', 'columns={0}'.format(self.config["ADRESSE"]), '-F', 'postcode={0}'.format(self.config["CODE_POSTAL"]), '-F', 'columns={0}'.format(self.config["COMMUNE"]), '-F', 'columns={0}'.format(self.config["PAYS"]), '-o', "{0}\{1}".format(pathOut, self.config["GEOCODAGE_OUTPUT"])])
-        except subprocess.CalledProcessError as e:
-            sys.stdout.write(e.output)
+            return None
+        rows = []
+        for row in response.json()['locations']:
+            rows.append({self.config["ID"]: row['attributes']['ResultID'], 'geoc_name': 'Esri', 'loc_name': row['attributes']['Loc_name'], 'status': row['attributes']['Status'], 'score': row['attributes']['Score'], 'match_type': row['attributes']['Addr_type'], 'match_addr': row['attributes']['Match_addr'], self.config["ADRESSE"]: row['attributes']['Place_addr'], self.config["CODE_POSTAL"]: row['attributes']['Postal'], self.config["COMMUNE"]: row['attributes']['City'], self.config["PAYS"]: row['attributes']['CntryName'], 'x': row['attributes']['X'], 'y': row['attributes']['Y']})
+        return sorted(rows, key=lambda row: row[self.config["ID"]])
 
-        try:
-            sys.stdout.write('Enregistrement des adresses géocodées par la BAN dans une table PostgreSQL (insertion dans la même table que précédemment)')
-            sys.stdout.flush()
-            subprocess.check_call(['ogr2ogr', '-f', 'PostgreSQL', "PG:host={0} port={1} dbname={2} user={3} password={4}".format(self.config["PGHOST"], self.config["PGPORT"], self.config["PGDBNAME"], self.config["PGUSER"], self.config["PGPWD"]), "{0}\{1}".format(pathOut, self.config["GEOCODAGE_OUTPUT"]), '-sql', "SELECT {0}, 'BAN' as geoc_name, 'BAN' as loc_name, '' as status, result_score * 100 as score, result_type as match_type, result_label as match_addr, {1}, {2}, {3}, {4}, longitude as x, latitude as y FROM {5} where round(result_score, 1) >= 0.6".format(self.config["ID"], self.config["ADRESSE"], self.config["CODE_POSTAL"], self.config["COMMUNE"], self.config["PAYS"], str(self.config["GEOCODAGE_OUTPUT"]).split('.')[0]), '-dialect', 'sqlite', '-nln', '{0}.{1}'.format(self.config["PGSCHEMA"], str(self.config["GEOCODAGE_OUTPUT"]).split('.')[0])])
-            sys.stdout.write('Exporté')
-            sys.stdout.flush()
-        except subprocess.CalledProcessError as e:
-            sys.stdout.write(e.output)
+    def esri_budget(self):
+        """
+        Budget de lignes Esri de l'exécution (config.ESRI_MAX_ROWS), diminué des lignes envoyées par les lots déjà chargés lors d'une exécution reprise
+
+        Dans un géocodage réparti, budget commun à tous les workers tenu dans la table config.ESRI_BUDGET_TABLE.
+        """
+        if self.config.get("ESRI_BUDGET_TABLE"):
+            return PgRowBudget(self.get_loader(), self.config["ESRI_BUDGET_TABLE"], 'esri', ESRI_BATCH_ROWS)
+        spent = sum(batch.get('sent', 0) for index, batch in self.get_manifest().batches('esri') if batch.get('status') == 'done')
+        return RowBudget(int(self.config["ESRI_MAX_ROWS"]), spent)
 
+    def priority(self, record):
+        return address_priority(record[self.config["ADRESSE"]], record[self.config["CODE_POSTAL"]], record[self.config["COMMUNE"]])
+
+    def priority_counts(self):
+        """
+        Nombre d'adresses distinctes de l'entrée de la chaîne par priorité Esri (scheduler.address_priority)
+        """
+        counts = [0] * (MAX_PRIORITY + 1)
+        for records in iter_stage_batches(self.input_stage, self.input_stage, self.config["ID"], 65536, self.input_columns()):
+            for record in records:
+                counts[self.priority(record)] += 1
+        return counts
+
+    def geocoding_esri(self, pathIn, pathOut, output=None):
+        self.make_dir(pathOut)
+        self.make_dir(os.path.join(pathOut, 'differees'))
+        workers = int(self.config.get("ESRI_WORKERS") or 1)
+        session = build_session(workers)
+        limiter = TokenBucket(self.config.get("ESRI_RATE") or 0)
+        batches = self.input_batches(pathIn, ESRI_BATCH_ROWS)
+        budget = self.esri_budget()
+        threshold = priority_threshold(self.priority_counts(), budget.remaining())
+        sys.stdout.write('Lancement du géocodage Esri (World service) des adresses non géocodées précédemment : {0} lot(s) en parallèle, budget de {1} lignes, envoi immédiat des adresses de priorité {2} ou plus'.format(workers, budget.remaining(), threshold))
+        sys.stdout.flush()
+        def pathDeferred(index):
+            return os.path.join(pathOut, 'differees', '{0:06d}.arrow'.format(index))
+        # Répartition de chaque lot : adresses prioritaires envoyées tant que le budget le permet, autres adresses différées (écrites sur disque) tant qu'il reste du budget, puis transmises au service suivant
+        def routed():
+            for index, fingerprint, records in self.service_batches('esri', batches, pathOut, output):
+                sent, unsent, deferred = [], [], []
+                for record in records:
+                    priority = self.priority(record)
+                    if priority >= threshold and budget.take(1):
+                        sent.append(record)
+                    elif budget.remaining() > 0:
+                        deferred.append(dict(record, priorite=str(priority)))
+                    else:
+                        unsent.append(record)
+                with StageWriter(pathDeferred(index), self.input_columns() + ['priorite']) as writer:
+                    writer.writerows(deferred)
+                yield index, fingerprint, sent, unsent
+            # Fin du flux : le budget restant est dépensé sur les adresses différées, par priorité décroissante
+            def deferred():
+                paths = [os.path.join(pathOut, 'differees', name) for name in sorted(os.listdir(os.path.join(pathOut, 'differees')))]
+                for priority in range(MAX_PRIORITY, -1, -1):
+                    for path in paths:
+                        for records in iter_stage_batches(path, path, self.config["ID"], 65536):
+                            # Valeurs vides relues à None depuis le fichier Arrow : rétablies en texte vide pour records_to_esri_json
+                            yield [dict((column, record[column] or '') for column in self.input_columns()) for record in records if record['priorite'] == str(priority)]
+            for index, fingerprint, records in self.service_batches('esri', rebatch(deferred(), ESRI_BATCH_ROWS), pathOut, output, DEFERRED_BATCH_INDEX):
+                granted = budget.take(len(records))
+                yield index, fingerprint, records[:granted], records[granted:]
+        # Les lots sont lus au fil de l'eau et les réponses chargées dans l'ordre du flux d'entrée : seuls les lots en cours sont en mémoire
+        def send(batch):
+            index, fingerprint, records, unsent = batch
+            return index, fingerprint, records, self.esri_request(session, limiter, records) if records else [], unsent
+        def results():
+            for index, fingerprint, records, rows, unsent in ordered_map(send, routed(), workers):
+                yield index, fingerprint, records, None if rows is None else [encode_row(row) for row in rows], unsent
         try:
-            sys.stdout.write('Sélection des adresses non géocodées par BAN précédemment et export en CSV')
-            sys.stdout.flush()
-            subprocess.check_call(['ogr2ogr', '-f', 'CSV', "{0}\{1}".format(pathOut, self.config["GEOCODAGE_ERROR"]), "{0}\{1}".format(pathOut, self.config["GEOCODAGE_OUTPUT"]), '-dialect', 'sqlite', '-sql', "SELECT {0}, 'BAN' as geoc_name, 'BAN' as loc_name, '' as status, result_score * 100 as score, result_type as match_type, result_label as match_addr, {1}, {2}, {3}, {4}, longitude as x, latitude as y FROM {5} where round(result_score, 1) < 0.6".format(self.config["ID"], self.config["ADRESSE"], self.config["CODE_POSTAL"], self.config["COMMUNE"], self.config["PAYS"], str(self.config["GEOCODAGE_OUTPUT"]).split('.')[0])])
-            sys.stdout.write('Exporté')
-            sys.stdout.flush()
-        except subprocess.CalledProcessError as e:
-            sys.stdout.write(e.output)
-    
-    def geom_proj(self):
-        os.chdir(self.config["PGBINPATH"])
+            self.load_batches(results(), MATCHED['esri'], pathOut, 'esri', self.service_srid('esri'), output)
+        finally:
+            # Lignes réservées et non dépensées rendues au budget commun
+            budget.release()
+        session.close()
+        sys.stdout.write('Géocodage terminé : {0} lignes Esri dépensées sur un budget de {1}'.format(budget.spent, budget.rows))
+        sys.stdout.flush()
+
+    def ban_request(self, session, limiter, fieldnames, records):
+        """
+        Envoie un lot d'adresses au service CSV de la BAN et retourne le CSV géocodé (None en cas d'échec) et la durée de l'appel
+
+        Paramètres
+        ----------
+        session: requests.Session
+            Session HTTP partagée entre les lots
+        limiter: http_client.TokenBucket
+            Limiteur de débit partagé entre les lots
+        fieldnames: list
+            Colonnes du CSV d'entrée
+        records: list
+            Lignes (dict) du lot d'adresses
+        """
+        chunk = io.BytesIO()
+        writer = csv.DictWriter(chunk, fieldnames=fieldnames, delimiter=',')
+        writer.writeheader()
+        writer.writerows([encode_row(record) for record in records])
+        data = [('columns', self.config["ADRESSE"]), ('postcode', self.config["CODE_POSTAL"]), ('columns', self.config["COMMUNE"]), ('columns', self.config["PAYS"])]
+        start = time.time()
         try:
-            sys.stdout.write('Transformation des coordonnées issues du géocodage Esri et BAN dans le format L93')
-            sys.stdout.flush()
-            SQLUPDATECOORD = "UPDATE " + str(self.config["PGSCHEMA"]) + "." + str(self.config["GEOCODAGE_OUTPUT"]).split(".")[0] + " SET x=st_x(st_transform(ST_setsrid(cast(st_makepoint(x::numeric, y::numeric) as geometry), 4326), 2154)), y=st_y(st_transform(ST_setsrid(cast(st_makepoint(x::numeric, y::numeric) as geometry), 4326), 2154)) WHERE geoc_name in('BAN', 'Esri')"
-            subprocess.check_call(['psql', '-U', self.config["PGUSER"], '-h', self.config["PGHOST"], '-p', self.config["PGPORT"], '-d', self.config["PGDBNAME"], '-c', '{0}'.format(SQLUPDATECOORD)])
-            sys.stdout.write('Transformation terminée')
+            response = post_with_retry(session, self.config.get("BAN_URL") or BAN_URL, limiter, retries=int(self.config.get("BAN_RETRIES") or 5), data=data, files={'data': ('adresses.csv', chunk.getvalue(), 'text/csv')}, timeout=600)
+        except requests.exceptions.RequestException as e:
+            self.metrics.observe_http('ban', time.time() - start, len(records), len(chunk.getvalue()), 0, error_status(e))
+            sys.stdout.write(str(e))
             sys.stdout.flush()
-        except subprocess.CalledProcessError as e:
-            sys.stdout.write(e.output) 
+            return None, time.time() - start
+        self.metrics.observe_http('ban', time.time() - start, len(records), len(response.request.body or ''), len(response.content), response.status_code)
+        return response.content, time.time() - start
+
+    def ban_rows(self, content):
+        """
+        Transforme le CSV retourné par la BAN en lignes de la table de résultats
+
+        Paramètre
+        ---------
+        content: str
+            CSV retourné par le service /search/csv/
+        """
+        for row in csv.DictReader(io.BytesIO(content), delimiter=','):
+            score = float(row['result_score']) * 100 if row.get('result_score') else None
+            yield {self.config["ID"]: row[self.config["ID"]], 'geoc_name': 'BAN', 'loc_name': 'BAN', 'status': '', 'score': score, 'match_type': row.get('result_type'), 'match_addr': row.get('result_label'), self.config["ADRESSE"]: row[self.config["ADRESSE"]], self.config["CODE_POSTAL"]: row[self.config["CODE_POSTAL"]], self.config["COMMUNE"]: row[self.config["COMMUNE"]], self.config["PAYS"]: row[self.config["PAYS"]], 'x': row.get('longitude'), 'y': row.get('latitude')}
+
+    def geocoding_ban(self, pathIn, pathOut, output=None):
+        self.make_dir(pathOut)
+        ban_batch_geocoding = int(self.config.get("BAN_CHUNK_ROWS") or 10000) # Taille des lots envoyés pour rester sous les limites de taille et de durée du service CSV
+        workers = int(self.config.get("BAN_WORKERS") or 1)
+        session = build_session(workers)
+        limiter = TokenBucket(self.config.get("BAN_RATE") or 0)
+        fieldnames = self.input_columns()
+        sys.stdout.write('Lancement du géocodage BAN : lots de {0} lignes, {1} en parallèle'.format(ban_batch_geocoding, workers)) # Documentation : https://adresse.data.gouv.fr/api-doc/adresse
+        sys.stdout.flush()
+        # Les CSV retournés sont chargés dans l'ordre des lots, au fil de l'eau
+        def send(batch):
+            index, fingerprint, records = batch
+            content, duration = self.ban_request(session, limiter, fieldnames, records) if records else (b'', 0.0)
+            return index, fingerprint, records, content, duration
+        def results():
+            for index, fingerprint, records, content, duration in ordered_map(send, self.service_batches('ban', self.input_batches(pathIn, ban_batch_geocoding), pathOut, output), workers):
+                if content is None:
+                    sys.stdout.write('Lot {0} : échec du géocodage BAN de {1} lignes'.format(index + 1, len(records)))
+                    sys.stdout.flush()
+                    yield index, fingerprint, records, None, []
+                    continue
+                sys.stdout.write('Lot {0} : {1} lignes géocodées en {2:.1f} s ({3:.0f} lignes/s, {4} Ko reçus)'.format(index + 1, len(records), duration, len(records) / max(duration, 0.001), len(content) // 1024))
+                sys.stdout.flush()
+                yield index, fingerprint, records, list(self.ban_rows(content)), []
+        self.load_batches(results(), MATCHED['ban'], pathOut, 'ban', self.service_srid('ban'), output)
+        session.close()
+
+    def geocoding_local(self, pathIn, pathOut, output=None):
+        self.make_dir(pathOut)
+        local_batch_geocoding = int(self.config.get("LOCAL_BATCH_ROWS") or 10000)
+        if self.local_geocoder is None:
+            self.local_geocoder = LocalGeocoder(self.config["LOCAL_INDEX"]) # Index ouvert en mémoire projetée, une seule fois par exécution
+        sys.stdout.write('Lancement du géocodage local : index {0}'.format(self.config["LOCAL_INDEX"]))
+        sys.stdout.flush()
+        def results():
+            for index, fingerprint, records in self.service_batches('local', self.input_batches(pathIn, local_batch_geocoding), pathOut, output):
+                start = time.time()
+                rows = self.local_geocoder.geocode(records, self.config["ID"], self.config["ADRESSE"], self.config["CODE_POSTAL"], self.config["COMMUNE"], self.config["PAYS"])
+                duration = time.time() - start
+                sys.stdout.write('Lot {0} : {1} lignes géocodées en {2:.1f} s ({3:.0f} lignes/s)'.format(index + 1, len(records), duration, len(records) / max(duration, 0.001)))
+                sys.stdout.flush()
+                # Libellés de l'index et colonnes lues dans le fichier Arrow en unicode : encodés pour le CSV du COPY, comme les lignes Esri
+                yield index, fingerprint, records, [encode_row(row) for row in rows], []
+        self.load_batches(results(), MATCHED['local'], pathOut, 'local', self.service_srid('local'), output)
+
+    def service_srid(self, service):
+        """
+        Système de coordonnées des points rendus par un service (coordonnées de l'export BAN déjà en Lambert-93 pour le service local)
+        """
+        return {'esri': self.config.get("ESRI_OUT_SR") or '102110', 'ban': '4326', 'local': '2154'}[service]
+
+    def service_request(self, service, session, limiter, records):
+        """
+        Géocode un lot d'adresses avec un service (esri, ban ou local) et retourne les lignes de la table de résultats, avant reprojection (None en cas d'échec)
+
+        Paramètres
+        ----------
+        service: str
+            Nom du service
+        session: requests.Session
+            Session HTTP partagée entre les lots
+        limiter: http_client.TokenBucket
+            Limiteur de débit partagé entre les lots
+        records: list
+            Lignes (dict) du lot d'adresses
+        """
+        if service == 'esri':
+            return self.esri_request(session, limiter, records)
+        if service == 'ban':
+            content, duration = self.ban_request(session, limiter, self.input_columns(), records)
+            return None if content is None else list(self.ban_rows(content))
+        if service == 'local':
+            if self.local_geocoder is None:
+                self.local_geocoder = LocalGeocoder(self.config["LOCAL_INDEX"])
+            return self.local_geocoder.geocode(records, self.config["ID"], self.config["ADRESSE"], self.config["CODE_POSTAL"], self.config["COMMUNE"], self.config["PAYS"])
+        raise ValueError('Service non disponible lot par lot : {0}'.format(service))
+
+    def geom_proj(self, rows, srid, batch_size=10000):
+        """
+        Reprojette en Lambert-93, par lots vectorisés, les coordonnées des lignes produites par un service
+
+        Paramètres
+        ----------
+        rows: iterable
+            Lignes (dict) produites par le service
+        srid: str
+            Système de coordonnées du service (4326, 3857, 2154...)
+        batch_size: int
+            Nombre de lignes reprojetées à la fois
+        """
+        if str(srid) in LAMBERT93:
+            for row in rows:
+                yield row
+            return
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return
+            start = time.time()
+            x, y = to_lambert93([float(row['x']) if row['x'] not in (None, '') else np.nan for row in batch], [float(row['y']) if row['y'] not in (None, '') else np.nan for row in batch], srid)
+            for row, x_l93, y_l93 in zip(batch, x, y):
+                row['x'] = None if np.isnan(x_l93) else x_l93
+                row['y'] = None if np.isnan(y_l93) else y_l93
+            self.metrics.add('geom_proj', str(srid), time.time() - start, rows=len(batch))
+            for row in batch:
+                yield row
 
     def export_results(self):
         final_folder = os.path.join(self.config["WORKSPACE"], "geocodage", "geocodage_resultats")
-        os.mkdir(final_folder)
-        os.chdir(self.config["QGISBINPATH"])
+        self.make_dir(final_folder)
+        start = time.time()
         try:
             sys.stdout.write('Export des résultats dans le dossier final /geocodage_resultats')
             sys.stdout.flush()
-            # Copie en CSV de la table PostgreSQL contenant les adresses géocodées insérées au fil de l'eau
-            subprocess.check_call(['ogr2ogr', '-f', 'CSV', "{0}\{1}".format(final_folder, "adresses_geocodees.csv"), "PG:host={0} port={1} dbname={2} user={3} password={4}".format(self.config["PGHOST"], self.config["PGPORT"], self.config["PGDBNAME"], self.config["PGUSER"], self.config["PGPWD"]), '-sql', "SELECT * FROM {0}.{1}".format(self.config["PGSCHEMA"], str(self.config["GEOCODAGE_OUTPUT"]).split('.')[0])])
-            # Copie du CSV contenant les adresses non géocodées s'il en reste
-            pathErrors = os.path.join(self.config["WORKSPACE"], "geocodage", self.config["GEOCODINGSERVICES"][-1], self.config["GEOCODAGE_ERROR"])
-            pathResults = os.path.join(self.config["WORKSPACE"], "geocodage", "geocodage_resultats", "geocodage_erreurs_restantes.csv")
-            if os.path.exists(pathErrors):
-                shutil.copyfile(pathErrors, os.path.join(self.config["WORKSPACE"], "geocodage", "geocodage_resultats") + "/geocodage_erreurs_restantes.csv")
+            # Copie en CSV de la table PostgreSQL contenant les adresses géocodées insérées au fil de l'eau (table partagée d'un géocodage réparti : exportée par le coordinateur)
+            if self.config.get("SHARD") is None:
+                self.get_loader().export_csv(os.path.join(final_folder, "adresses_geocodees.csv"))
+                # Formats spatiaux indexés (GeoParquet, FlatGeobuf), lus en flux dans la table
+                with self.metrics.stage('export_spatial'):
+                    export_spatial(self.get_loader(), final_folder, self.spatial_formats(), self.config.get("QGISBINPATH"))
+            # Export en CSV des adresses non géocodées par le dernier service s'il en reste
+            nbRowsErrors = 0
+            if self.last_stage is not None and os.path.exists(self.last_stage):
+                nbRowsErrors = stage_to_csv(self.last_stage, os.path.join(final_folder, "geocodage_erreurs_restantes.csv"), expand=lambda row: self.fan_out([row], lambda row: True))
             sys.stdout.write('Copie terminée')
             sys.stdout.flush()
-            # Calcul ratio du nombre de lignes géocodées
-            nbRowsGeocoding = subprocess.check_output("csvstat {0}\{1} --count".format(final_folder, "adresses_geocodees.csv"), shell=True)
-            nbRowsErrors = subprocess.check_output("csvstat {0}\{1} --count".format(final_folder, "geocodage_erreurs_restantes.csv"), shell=True)
+            # Calcul ratio du nombre de lignes géocodées, à partir des lignes chargées dans la table au cours de l'exécution (et de l'exécution reprise)
+            nbRowsGeocoding = self.metrics.total('load', 'matched') + self.nb_resumed
+            self.metrics.record('export_results', None, time.time() - start, matched=nbRowsGeocoding, unmatched=nbRowsErrors)
             if nbRowsGeocoding > 0:
                 ratioGeocoding = (float(nbRowsGeocoding) / (float(nbRowsGeocoding) + float(nbRowsErrors))) * 100
                 sys.stdout.write("Performance du géocodage : {0} %".format(ratioGeocoding))
                 sys.stdout.flush()
-        except subprocess.CalledProcessError as e:
-            sys.stdout.write(e.output) 
+        except psycopg2.Error as e:
+            sys.stdout.write(str(e))
+
+    def spatial_formats(self):
+        """
+        Formats spatiaux écrits à l'export (config.SPATIAL_FORMATS, GeoParquet et FlatGeobuf par défaut)
+        """
+        formats = self.config.get("SPATIAL_FORMATS")
+        return ['geoparquet', 'flatgeobuf'] if formats is None else list(formats)
+
+    def cache_lookup(self):
+        cacheFolder = os.path.join(self.config["WORKSPACE"], "geocodage", "cache")
+        self.make_dir(cacheFolder)
+        pathMisses = os.path.join(cacheFolder, "adresses_a_geocoder.arrow")
+        sys.stdout.write('Recherche des adresses déjà géocodées dans le cache')
+        sys.stdout.flush()
+        with StageWriter(pathMisses, [self.config["ID"]]) as misses:
+            for records in iter_stage_batches(self.input_stage, self.input_stage, self.config["ID"], 50000, self.input_columns() + ['cle_adresse']):
+                keys = [cache_key(row['cle_adresse']) for row in records]
+                cached = self.cache.get_many(keys)
+                for row, key in zip(records, keys):
+                    if key in cached:
+                        self.cache.hits += 1
+                        hit = dict((column, row[column]) for column in self.input_columns())
+                        hit.update(cached[key])
+                        self.cache_hits.append(encode_row(hit))
+                    else:
+                        self.cache.misses += 1
+                        self.cache_misses[row[self.config["ID"]]] = key
+                        misses.writerow(row)
+        sys.stdout.write('{0} adresses trouvées dans le cache, {1} à géocoder'.format(self.cache.hits, self.cache.misses))
+        sys.stdout.flush()
+        return pathMisses
+
+    def cache_load_hits(self):
+        if self.cache.hits == 0 or self.get_manifest().stage_done('cache_load_hits'):
+            return
+        try:
+            sys.stdout.write('Enregistrement des adresses trouvées dans le cache dans une table PostgreSQL (insertion dans la même table que précédemment)')
+            sys.stdout.flush()
+            loader = self.get_loader()
+            loader.create_table(overwrite=False)
+            start = time.time()
+            nb_matched, nb_unmatched = loader.load(self.fan_out(self.cache_hits, lambda row: True), lambda row: True)
+            self.metrics.record('load', 'cache', time.time() - start, matched=nb_matched, unmatched=nb_unmatched, bytes=loader.nb_bytes)
+            self.get_manifest().mark_stage('cache_load_hits', 'done', matched=nb_matched)
+            sys.stdout.write('Exporté')
+            sys.stdout.flush()
+        except psycopg2.Error as e:
+            sys.stdout.write(str(e))
+            sys.stdout.flush()
+
+    def cache_store(self):
+        pathResults = os.path.join(self.config["WORKSPACE"], "geocodage", "geocodage_resultats", "adresses_geocodees.csv")
+        if not os.path.exists(pathResults):
+            return
+        entries = {}
+        with open(pathResults, 'rb') as file_obj:
+            for row in csv.DictReader(file_obj, delimiter=','):
+                key = self.cache_misses.get(row[self.config["ID"]].decode('utf-8'))
+                if key is not None:
+                    entries[key] = row
+        self.cache.put_many(entries)
+        sys.stdout.write('{0} adresses ajoutées au cache, taux de réponse du cache : {1} %'.format(len(entries), self.cache.hit_rate()))
+        sys.stdout.flush()
+
+    def replay_stage(self, service, output):
+        """
+        Transmet au service suivant, par lots, les adresses restées dans le fichier Arrow des erreurs d'un service déjà terminé
+
+        Paramètres
+        ----------
+        service: str
+            Nom du service
+        output: scheduler.BatchQueue
+            File du service suivant (None pour le dernier service)
+        """
+        if output is None or not os.path.exists(self.stage_path(service)):
+            return
+        for records in self.stage_batches(self.stage_path(service), 10000):
+            output.put(records)
+
+    def run_service(self, service, pathIn, pathOut, output=None):
+        """
+        Lance le géocodeur d'un service en mesurant sa durée et son nombre de lignes en entrée
+
+        Paramètres
+        ----------
+        service: str
+            Nom du service (interne, local, esri ou ban)
+        pathIn: str ou scheduler.BatchQueue
+            Fichier Arrow des adresses à géocoder, ou file des adresses non géocodées par le service précédent
+        pathOut: str
+            Chemin de sortie du géocodage
+        output: scheduler.BatchQueue
+            File recevant les adresses non géocodées, pour le service suivant (optionnel)
+        """
+        with self.metrics.stage('geocoding', service) as stage:
+            getattr(self, 'geocoding_{0}'.format(service))(pathIn, pathOut, output)
+            stage.count(rows_in=pathIn.nb_rows if isinstance(pathIn, BatchQueue) else count_rows(pathIn))
 
     def chain_geocoding(self):
+        self.metrics.start_profile()
         self.clean_workspace()
         GEOCODING_SERVICES = self.config["GEOCODINGSERVICES"]
         if len(GEOCODING_SERVICES) > 0:
+            inputGeocoding = self.prepare_input()
+            self.get_loader().create_table(overwrite=not self.resuming and not self.config.get("INCREMENTAL") and self.config.get("SHARD") is None)
+            if self.resuming:
+                # Adresses déjà chargées lors de l'exécution interrompue : elles ne sont plus envoyées aux services
+                self.existing_ids = set(id_key(row[0]) for row in self.loader.execute("SELECT {0} FROM {1}".format(self.config["ID"], self.loader.table)))
+                self.nb_resumed = len(self.existing_ids)
+                sys.stdout.write('{0} lignes déjà géocodées lors de l\'exécution précédente'.format(self.nb_resumed))
+                sys.stdout.flush()
+            if self.config.get("CACHE"):
+                self.cache = GeocodingCache(self.config["CACHE"], ttl=int(self.config.get("CACHE_TTL") or 0) * 86400, max_rows=self.config.get("CACHE_MAX_ROWS"))
+                inputGeocoding = self.cache_lookup()
+                if self.cache.misses == 0:
+                    GEOCODING_SERVICES = []
+                    sys.stdout.write('Toutes les adresses ont été trouvées dans le cache')
+            if self.config.get("INCREMENTAL") and count_rows(inputGeocoding) == 0:
+                GEOCODING_SERVICES = []
+                sys.stdout.write('Aucune adresse nouvelle, modifiée ou restée sans résultat depuis l\'exécution précédente')
+            # Un thread par service, reliés par des files de lots : les adresses non géocodées d'un lot partent aussitôt vers le service suivant
+            nodes = []
+            source = inputGeocoding
             for index, service in enumerate(GEOCODING_SERVICES):
-                if index == 0:
-                    pathIn = self.config["INPUT_A_GEOCODER"]
-                else:
-                    pathIn = os.path.join(self.config["WORKSPACE"], "geocodage", GEOCODING_SERVICES[index - 1], self.config["GEOCODAGE_ERROR"])
                 pathOut = os.path.join(self.config["WORKSPACE"], "geocodage", service)
-                if service == 'interne':
-                    self.geocoding_interne(pathIn, pathOut)
-                elif service == 'esri':
-                    if (os.path.exists(pathIn)):
-                        count_rows_csv = subprocess.check_output("csvstat {0} --count".format(pathIn), shell=True)
-                        if int(count_rows_csv) < int(self.config["ESRI_MAX_ROWS"]):
-                            self.geocoding_esri(pathIn, pathOut)
-                        elif int(count_rows_csv) == 0:
-                            sys.stdout.write('Toutes les lignes ont été géocodées par le service précédent : {0}'.format(GEOCODING_SERVICES[index - 1]))
-                            break
-                        else:
-                            sys.stdout.write('Seuil Esri dépassé')
-                            break
-                    else: 
-                        sys.stdout.write('Toutes les lignes ont été géocodées par le service précédent : {0}'.format(GEOCODING_SERVICES[index - 1]))
-                        break
-                elif service == 'ban':
-                    if (os.path.exists(pathIn)):
-                        count_rows_csv = subprocess.check_output("csvstat {0} --count".format(pathIn), shell=True)
-                        if int(count_rows_csv) == 0:
-                            sys.stdout.write('Toutes les lignes ont été géocodées par le service précédent : {0}'.format(GEOCODING_SERVICES[index - 1]))
-                            break
-                        else:
-                            # Si le géocodeur précédent est 'esri' et que le nombre de lignes a excédé le seuil esri, alors on prend l'entrée du géocodeur précédent esri s'il existe (si longueur de GEOCODING_SERVICES vaut 3)
-                            if GEOCODING_SERVICES[index - 1] == 'esri' and int(count_rows_csv) > int(self.config["ESRI_MAX_ROWS"]) and len(GEOCODING_SERVICES) == 3:
-                                sys.stdout.write('Seuil Esri dépassé, passage par la BAN')
-                                pathIn = os.path.join(self.config["WORKSPACE"], "geocodage", GEOCODING_SERVICES[index - 2], self.config["GEOCODAGE_ERROR"])
-                            self.geocoding_ban(pathIn, pathOut)
-                    else: 
-                        sys.stdout.write('Toutes les lignes ont été géocodées par le service précédent : {0}'.format(GEOCODING_SERVICES[index - 1]))
-                        break
-            self.geom_proj()
+                output = BatchQueue() if index < len(GEOCODING_SERVICES) - 1 else None
+                if self.resuming and self.get_manifest().stage_done(service) and os.path.exists(self.stage_path(service)):
+                    sys.stdout.write('Service {0} déjà terminé lors de l\'exécution précédente'.format(service))
+                    sys.stdout.flush()
+                    nodes.append(Node(service, lambda source, output, service=service: self.replay_stage(service, output), source, output))
+                else:
+                    # Les services suivants recevront une nouvelle entrée : leurs lots enregistrés ne sont plus valables
+                    self.get_manifest().reset(GEOCODING_SERVICES[index + 1:])
+                    nodes.append(Node(service, lambda source, output, service=service, pathOut=pathOut: self.run_service(service, source, pathOut, output), source, output))
+                source = output
+            run_nodes(nodes)
+            if GEOCODING_SERVICES:
+                self.last_stage = self.stage_path(GEOCODING_SERVICES[-1])
+            if self.cache is not None:
+                self.cache_load_hits()
             self.export_results()
+            if self.config.get("INCREMENTAL"):
+                self.store_snapshot()
+            if self.cache is not None:
+                self.cache_store()
+                self.cache.close()
+            self.loader.close()
+            self.loader = None
+            self.metrics.close()
             sys.stdout.write("Géocodage terminé")
             sys.stdout.flush()
         else:
+            self.metrics.close()
             sys.stdout.write("Aucun service de géocodage n'a été utilisé, GEOCODINGSERVICES est vide")
             exit()
\ No newline at end of file
@@ -0,0 +1,213 @@
+##!/usr/bin/python
+## -*- coding: utf-8 -*-
+## Python 2.7.X
+
+"""
+Passage des adresses d'un service de géocodage au suivant
+---------------------------------------------------------
+Le CSV d'entrée est converti une seule fois en fichier Arrow IPC typé (adresses.arrow).
+Chaque service écrit ses adresses non géocodées dans un fichier Arrow ; le service suivant n'en lit que les identifiants et reprend les colonnes d'adresse dans le fichier d'entrée.
+Les fichiers sont lus en mémoire projetée (memory map) : seules les pages réellement parcourues sont chargées.
+Le CSV n'est écrit qu'à l'export final (Geocoding.export_results).
+"""
+
+import csv
+import pyarrow as pa
+
+# Colonnes numériques des fichiers Arrow, les autres étant du texte
+NUMERIC_COLUMNS = ('score', 'x', 'y')
+
+def stage_schema(columns):
+    """
+    Paramètre
+    ---------
+    columns: list
+        Colonnes du fichier, dans l'ordre
+    """
+    return pa.schema([pa.field(column, pa.float64() if column in NUMERIC_COLUMNS else pa.string()) for column in columns])
+
+def _value(column, value):
+    if value is None or value == '':
+        return None
+    if column in NUMERIC_COLUMNS:
+        return float(value)
+    return value if hasattr(value, 'encode') else str(value)
+
+class StageWriter:
+    """
+    Écriture en flux de lignes (dict) dans un fichier Arrow IPC, par lots
+
+    Expose writerow() comme csv.DictWriter pour pouvoir recevoir les erreurs de pgload.PgLoader.load().
+
+    Attributs
+    ---------
+    path: str
+        Chemin du fichier Arrow
+    columns: list
+        Colonnes écrites, les autres clés des lignes étant ignorées
+    batch_size: int
+        Nombre de lignes par lot Arrow
+    """
+
+    def __init__(self, path, columns, batch_size=65536):
+        self.path = path
+        self.columns = columns
+        self.batch_size = batch_size
+        self.schema = stage_schema(columns)
+        self.sink = pa.OSFile(path, 'wb')
+        self.writer = pa.RecordBatchFileWriter(self.sink, self.schema)
+        self.pending = dict((column, []) for column in columns)
+        self.nb_rows = 0
+
+    def writerow(self, row):
+        for column in self.columns:
+            self.pending[column].append(_value(column, row.get(column)))
+        self.nb_rows += 1
+        if len(self.pending[self.columns[0]]) >= self.batch_size:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        if self.pending[self.columns[0]]:
+            self.writer.write_batch(pa.RecordBatch.from_arrays([pa.array(self.pending[field.name], type=field.type) for field in self.schema], schema=self.schema))
+            self.pending = dict((column, []) for column in self.columns)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        self.sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def csv_to_stage(pathCsv, pathArrow, columns, delimiter=','):
+    """
+    Convertit les colonnes utiles du CSV d'entrée en fichier Arrow, en une seule lecture
+
+    Paramètres
+    ----------
+    pathCsv: str
+        CSV d'entrée
+    pathArrow: str
+        Fichier Arrow créé
+    columns: list
+        Colonnes conservées
+    delimiter: str
+        Séparateur du CSV
+    """
+    with open(pathCsv, 'rb') as file_obj, StageWriter(pathArrow, columns) as writer:
+        writer.writerows(csv.DictReader(file_obj, delimiter=delimiter))
+        return writer.nb_rows
+
+def frame_to_stage(frame, pathArrow, columns):
+    """
+    Écrit les colonnes d'un DataFrame pandas (texte) dans un fichier Arrow
+
+    Paramètres
+    ----------
+    frame: pandas.DataFrame
+        Lignes à écrire
+    pathArrow: str
+        Fichier Arrow créé
+    columns: list
+        Colonnes conservées
+    """
+    schema = stage_schema(columns)
+    table = pa.Table.from_pandas(frame[columns], schema=schema, preserve_index=False)
+    with pa.OSFile(pathArrow, 'wb') as sink:
+        writer = pa.RecordBatchFileWriter(sink, schema)
+        for record_batch in table.to_batches(65536):
+            writer.write_batch(record_batch)
+        writer.close()
+    return table.num_rows
+
+def open_stage(path):
+    return pa.ipc.open_file(pa.memory_map(path, 'r'))
+
+def count_rows(path):
+    """
+    Nombre de lignes d'un fichier Arrow, lu dans les métadonnées des lots
+    """
+    reader = open_stage(path)
+    return sum(reader.get_batch(index).num_rows for index in range(reader.num_record_batches))
+
+def read_ids(path, id_column):
+    """
+    Identifiants contenus dans un fichier Arrow, seule la colonne id_column étant lue
+    """
+    reader = open_stage(path)
+    ids = set()
+    for index in range(reader.num_record_batches):
+        ids.update(reader.get_batch(index).column(reader.schema.get_field_index(id_column)).to_pylist())
+    return ids
+
+def iter_stage_batches(pathInput, pathIds, id_column, batch_size, columns=None):
+    """
+    Lit par lots de lignes (dict) les adresses du fichier d'entrée dont l'identifiant figure dans pathIds
+
+    Paramètres
+    ----------
+    pathInput: str
+        Fichier Arrow d'entrée (toutes les adresses)
+    pathIds: str
+        Fichier Arrow des adresses restant à géocoder (identique à pathInput pour le premier service)
+    id_column: str
+        Colonne de l'identifiant
+    batch_size: int
+        Nombre de lignes par lot rendu
+    columns: list
+        Colonnes rendues (toutes par défaut)
+    """
+    ids = None if pathIds == pathInput else read_ids(pathIds, id_column)
+    reader = open_stage(pathInput)
+    columns = columns or reader.schema.names
+    batch = []
+    for index in range(reader.num_record_batches):
+        record_batch = reader.get_batch(index)
+        id_values = record_batch.column(reader.schema.get_field_index(id_column)).to_pylist()
+        values = [record_batch.column(reader.schema.get_field_index(column)).to_pylist() for column in columns]
+        for id_value, row in zip(id_values, zip(*values)):
+            if ids is not None and id_value not in ids:
+                continue
+            batch.append(dict(zip(columns, row)))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def stage_to_csv(pathArrow, pathCsv, expand=None, delimiter=','):
+    """
+    Exporte un fichier Arrow en CSV et retourne le nombre de lignes écrites
+
+    Paramètres
+    ----------
+    pathArrow: str
+        Fichier Arrow à exporter
+    pathCsv: str
+        CSV créé
+    expand: function
+        Fonction rendant, pour une ligne (dict), les lignes à écrire (optionnel)
+    delimiter: str
+        Séparateur du CSV
+    """
+    reader = open_stage(pathArrow)
+    nb_rows = 0
+    with open(pathCsv, 'wb') as file_obj:
+        writer = csv.DictWriter(file_obj, fieldnames=reader.schema.names, delimiter=delimiter)
+        writer.writeheader()
+        for index in range(reader.num_record_batches):
+            # Lignes reconstituées colonne par colonne : RecordBatch.to_pylist n'existe qu'à partir de pyarrow 7
+            record_batch = reader.get_batch(index)
+            values = [record_batch.column(column).to_pylist() for column in range(record_batch.num_columns)]
+            for row in (dict(zip(reader.schema.names, row)) for row in zip(*values)):
+                for output in (expand(row) if expand is not None else [row]):
+                    writer.writerow(dict((key, value.encode('utf-8') if hasattr(value, 'encode') and not isinstance(value, str) else value) for key, value in output.items()))
+                    nb_rows += 1
+    return nb_rows
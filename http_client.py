@@ -0,0 +1,147 @@
+##!/usr/bin/python
+## -*- coding: utf-8 -*-
+## Python 2.7.X
+
+"""
+Outils HTTP partagés par les services de géocodage en ligne
+-----------------------------------------------------------
+    - une session requests réutilisant les connexions (keep-alive) entre les lots,
+    - un limiteur de débit (seau à jetons) partagé entre les threads,
+    - un envoi avec reprises et attente exponentielle sur les erreurs 429 et 5xx,
+    - une exécution concurrente de lots dont les résultats sont rendus dans l'ordre d'entrée.
+"""
+
+import time, threading, collections, requests
+from multiprocessing.pool import ThreadPool
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+class TokenBucket:
+    """
+    Limiteur de débit en seau à jetons
+
+    Attributs
+    ---------
+    rate: float
+        Nombre de requêtes autorisées par seconde (0 : pas de limite)
+    capacity: float
+        Nombre de requêtes pouvant partir en rafale
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate or 0)
+        self.capacity = float(capacity or max(self.rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def build_session(pool_size=1):
+    """
+    Crée une session HTTP dont les connexions sont conservées entre les requêtes
+
+    Paramètre
+    ---------
+    pool_size: int
+        Nombre de connexions simultanées vers un même hôte
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(int(pool_size), 1))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def post_with_retry(session, url, limiter=None, retries=5, backoff=1.0, status=None, **kwargs):
+    """
+    Envoie une requête POST en la répétant sur les erreurs réseau, 429 et 5xx
+
+    Paramètres
+    ----------
+    session: requests.Session
+        Session HTTP partagée
+    url: str
+        Adresse du service
+    limiter: TokenBucket
+        Limiteur de débit partagé (optionnel)
+    retries: int
+        Nombre maximal de nouvelles tentatives
+    backoff: float
+        Attente initiale en secondes, doublée à chaque tentative
+    status: function
+        Statut effectif d'une réponse, pour les services qui signalent leurs erreurs dans une réponse 200 (optionnel, statut HTTP par défaut)
+    kwargs:
+        Paramètres transmis à session.post (data, files, headers, timeout...)
+    """
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            response = session.post(url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt >= retries:
+                raise
+            wait = backoff * (2 ** attempt)
+        else:
+            if (status(response) if status is not None else response.status_code) not in RETRY_STATUS or attempt >= retries:
+                response.raise_for_status()
+                return response
+            retry_after = response.headers.get('Retry-After')
+            wait = float(retry_after) if retry_after and retry_after.isdigit() else backoff * (2 ** attempt)
+        attempt += 1
+        time.sleep(wait)
+
+def error_status(error):
+    """
+    Statut HTTP d'une erreur requests (None pour une erreur réseau)
+    """
+    response = getattr(error, 'response', None)
+    return response.status_code if response is not None else None
+
+def ordered_map(func, iterable, workers=1, max_in_flight=None):
+    """
+    Applique func à chaque élément sur plusieurs threads et rend les résultats dans l'ordre d'entrée
+
+    Au plus max_in_flight éléments sont en cours de traitement à la fois, l'itérable n'est donc consommé qu'au fur et à mesure.
+
+    Paramètres
+    ----------
+    func: function
+        Fonction appliquée à chaque élément
+    iterable: iterable
+        Éléments à traiter
+    workers: int
+        Nombre de threads
+    max_in_flight: int
+        Nombre maximal d'éléments en attente de résultat (par défaut : 2 * workers)
+    """
+    workers = max(int(workers), 1)
+    if workers == 1:
+        for item in iterable:
+            yield func(item)
+        return
+    max_in_flight = max_in_flight or 2 * workers
+    pool = ThreadPool(workers)
+    pending = collections.deque()
+    try:
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
@@ -0,0 +1,358 @@
+##!/usr/bin/python
+## -*- coding: utf-8 -*-
+## Python 2.7.X
+
+# Aide : python local_geocoder.py --help
+
+"""
+Géocodeur local hors ligne
+--------------------------
+Index construit à partir de l'export CSV national (ou départemental) de la BAN (https://adresse.data.gouv.fr/data/ban/adresses/latest/csv).
+L'index est un dossier de tableaux NumPy (.npy) ouverts en mémoire projetée, ce qui permet de le charger en quelques secondes :
+    - les adresses sont triées par code postal puis par libellé normalisé, chaque code postal formant une partition contiguë,
+    - un tableau trié d'empreintes (libellé normalisé, code postal) donne les correspondances exactes par recherche dichotomique,
+    - un index inversé de trigrammes départage les autres adresses de la partition : les trigrammes communs à toutes les adresses d'une voie
+      sont indexés une fois par voie (clés trigramme * nombre de voies + voie, triées), les autres (numéro, indice de répétition) par adresse
+      (clés trigramme * nombre d'adresses + adresse). Les plages de toutes les adresses d'un lot dans une même partition sont obtenues
+      par un seul appel à numpy.searchsorted, et leurs trigrammes communs comptés ensemble par numpy.bincount.
+Le score est le coefficient de Dice entre les trigrammes de l'adresse cherchée et ceux de l'adresse trouvée, multiplié par 100 comme result_score pour la BAN.
+Une adresse trouvée dont le numéro diffère du numéro cherché n'est qu'une correspondance à la voie (match_type street), au score diminué de moitié.
+Les coordonnées de l'export BAN étant en Lambert-93, elles sont rendues sans reprojection.
+"""
+
+import os, re, json, hashlib, argparse
+import numpy as np
+import pandas as pd
+from normalize import normalize_address, normalize_series
+
+# Alphabet des libellés normalisés : espace, lettres et chiffres
+ALPHABET = ' abcdefghijklmnopqrstuvwxyz0123456789'
+NB_SYMBOLS = len(ALPHABET)
+PAD = 255
+LABEL_WIDTH = 64
+# Nombre maximal d'octets UTF-8 des libellés rendus (match_addr)
+MATCH_ADDR_BYTES = 120
+# Facteur appliqué au score d'une adresse de la bonne voie mais d'un autre numéro
+STREET_PENALTY = 0.5
+# Nombre maximal de cases de la matrice des trigrammes communs (adresses cherchées * voies de la partition) comptée à la fois
+MATCH_CELLS = 1 << 22
+HOUSENUMBER = re.compile(r'^(\d+)')
+
+LOOKUP = np.zeros(256, dtype=np.uint8)
+for code, char in enumerate(ALPHABET):
+    LOOKUP[ord(char)] = code
+LOOKUP[0] = PAD
+
+def _hash(label, postcode):
+    return int(hashlib.md5('{0}|{1}'.format(label, postcode).encode('utf-8')).hexdigest()[:16], 16)
+
+def _postcode(value):
+    value = (value or '').strip()
+    return int(value) if value.isdigit() else 0
+
+def _housenumber(label):
+    """
+    Numéro en tête d'une adresse normalisée (0 sans numéro)
+    """
+    number = HOUSENUMBER.match(label)
+    return int(number.group(1)) if number else 0
+
+def _utf8(value, width=MATCH_ADDR_BYTES):
+    """
+    Libellé encodé en UTF-8, tronqué à width octets sans couper de caractère
+    """
+    return value.encode('utf-8')[:width].decode('utf-8', 'ignore').encode('utf-8')
+
+def encode_labels(labels, width=LABEL_WIDTH):
+    """
+    Matrice des symboles de chaque libellé normalisé, encadré d'espaces et complété par PAD
+
+    Paramètres
+    ----------
+    labels: list
+        Libellés normalisés (ASCII)
+    width: int
+        Nombre maximal de caractères conservés par libellé
+    """
+    blob = b''.join((' ' + label[:width] + ' ').encode('ascii', 'ignore').ljust(width + 2, b'\x00') for label in labels)
+    return LOOKUP[np.frombuffer(blob, dtype=np.uint8).reshape(len(labels), width + 2)]
+
+def trigrams(codes):
+    """
+    Identifiants des trigrammes de chaque ligne d'une matrice de symboles (-1 pour les trigrammes incomplets)
+    """
+    codes = codes.astype(np.int32)
+    ids = codes[:, :-2] * NB_SYMBOLS * NB_SYMBOLS + codes[:, 1:-1] * NB_SYMBOLS + codes[:, 2:]
+    ids[(codes[:, :-2] == PAD) | (codes[:, 1:-1] == PAD) | (codes[:, 2:] == PAD)] = -1
+    return ids
+
+def build_index(pathCsv, pathIndex, chunk_size=1000000):
+    """
+    Construit l'index local à partir d'un export CSV de la BAN
+
+    Paramètres
+    ----------
+    pathCsv: str
+        Export CSV de la BAN (séparateur ;)
+    pathIndex: str
+        Dossier de l'index créé
+    chunk_size: int
+        Nombre d'adresses traitées à la fois pour l'index de trigrammes (arrondi au code postal suivant)
+    """
+    if not os.path.exists(pathIndex):
+        os.makedirs(pathIndex)
+    adresses = pd.read_csv(pathCsv, sep=';', dtype=str, keep_default_na=False, encoding='utf-8', usecols=['numero', 'rep', 'nom_voie', 'code_postal', 'nom_commune', 'x', 'y'])
+    adresses['label'] = (adresses['numero'] + ' ' + adresses['rep'] + ' ' + adresses['nom_voie']).str.replace(r'\s+', ' ', regex=True).str.strip()
+    adresses['label_norm'] = normalize_series(adresses['label'])
+    adresses['voie_norm'] = normalize_series(adresses['nom_voie'])
+    adresses['postcode'] = pd.to_numeric(adresses['code_postal'], errors='coerce').fillna(0).astype(np.int32)
+    adresses = adresses.sort_values(['postcode', 'label_norm'], kind='mergesort').reset_index(drop=True)
+    nb_rows = len(adresses)
+
+    postcode = adresses['postcode'].values
+    pc_codes, pc_start = np.unique(postcode, return_index=True)
+    np.save(os.path.join(pathIndex, 'pc_codes.npy'), pc_codes.astype(np.int32))
+    np.save(os.path.join(pathIndex, 'pc_offsets.npy'), np.append(pc_start, nb_rows).astype(np.int64))
+    np.save(os.path.join(pathIndex, 'x.npy'), pd.to_numeric(adresses['x'], errors='coerce').values.astype(np.float64))
+    np.save(os.path.join(pathIndex, 'y.npy'), pd.to_numeric(adresses['y'], errors='coerce').values.astype(np.float64))
+    np.save(os.path.join(pathIndex, 'numero.npy'), pd.to_numeric(adresses['numero'], errors='coerce').fillna(0).values.astype(np.int32))
+    np.save(os.path.join(pathIndex, 'labels.npy'), (adresses['label'] + ' ' + adresses['code_postal'] + ' ' + adresses['nom_commune']).map(_utf8).values.astype('S{0}'.format(MATCH_ADDR_BYTES)))
+
+    hashes = np.array([_hash(label, code) for label, code in zip(adresses['label_norm'].values, postcode)], dtype=np.uint64)
+    order = np.argsort(hashes, kind='mergesort')
+    np.save(os.path.join(pathIndex, 'exact_hash.npy'), hashes[order])
+    np.save(os.path.join(pathIndex, 'exact_idx.npy'), order.astype(np.uint32))
+
+    # Voies (code postal, nom de voie normalisé), numérotées dans l'ordre : celles d'un code postal sont contiguës
+    street = adresses.groupby(['postcode', 'voie_norm'], sort=True).ngroup().values.astype(np.int64)
+    nb_streets = int(street.max()) + 1 if nb_rows else 0
+    street_size = np.bincount(street, minlength=nb_streets)
+    np.save(os.path.join(pathIndex, 'street.npy'), street.astype(np.int32))
+    np.save(os.path.join(pathIndex, 'pc_streets.npy'), np.append(np.minimum.reduceat(street, pc_start) if nb_rows else [], nb_streets).astype(np.int64))
+
+    # Index inversé : couples (trigramme, voie) des trigrammes communs à toutes les adresses d'une voie, et couples (trigramme, adresse)
+    # des autres trigrammes (numéro, indice de répétition), triés par trigramme puis par voie ou adresse.
+    # Les lots suivent les codes postaux, pour que chaque voie soit entière dans un lot.
+    keys, street_keys, ntri = [], [], []
+    bounds = np.append(pc_start, nb_rows)
+    start = 0
+    while start < nb_rows:
+        end = int(bounds[min(np.searchsorted(bounds, start + chunk_size), len(bounds) - 1)])
+        ids = trigrams(encode_labels(adresses['label_norm'].values[start:end]))
+        rows = np.repeat(np.arange(start, end, dtype=np.int64), ids.shape[1])
+        ids = ids.ravel().astype(np.int64)
+        pairs = np.unique(ids[ids >= 0] * nb_rows + rows[ids >= 0])
+        rows = pairs % nb_rows
+        ntri.append(np.bincount(rows - start, minlength=end - start))
+        shared, inverse, counts = np.unique(pairs // nb_rows * nb_streets + street[rows], return_inverse=True, return_counts=True)
+        common = counts == street_size[shared % nb_streets]
+        street_keys.append(shared[common])
+        keys.append(pairs[~common[inverse.ravel()]])
+        start = end
+    keys = np.sort(np.concatenate(keys)) if keys else np.array([], dtype=np.int64)
+    street_keys = np.sort(np.concatenate(street_keys)) if street_keys else np.array([], dtype=np.int64)
+    ntri = np.concatenate(ntri).astype(np.uint16) if ntri else np.array([], dtype=np.uint16)
+    np.save(os.path.join(pathIndex, 'postings.npy'), keys)
+    np.save(os.path.join(pathIndex, 'street_postings.npy'), street_keys)
+    np.save(os.path.join(pathIndex, 'ntri.npy'), ntri)
+    # Adresse de chaque voie ayant le moins de trigrammes (la première en cas d'égalité)
+    order = np.lexsort((np.arange(nb_rows), ntri, street))
+    np.save(os.path.join(pathIndex, 'street_first.npy'), order[np.r_[True, street[order][1:] != street[order][:-1]]].astype(np.int64) if nb_rows else order)
+
+    communes = adresses.assign(commune=normalize_series(adresses['nom_commune'])).groupby('commune')['postcode'].unique()
+    with open(os.path.join(pathIndex, 'communes.json'), 'w') as file_obj:
+        json.dump(dict((commune, sorted(int(code) for code in codes)) for commune, codes in communes.items()), file_obj)
+    return nb_rows
+
+class LocalGeocoder:
+    """
+    Géocodeur reposant sur un index local construit par build_index()
+
+    Attributs
+    ---------
+    pathIndex: str
+        Dossier de l'index
+
+    Méthodes
+    --------
+    match(label, postcode, commune)
+        Recherche une adresse normalisée et retourne (indice de l'adresse trouvée, score)
+    match_batch(labels, ranges)
+        Recherche des adresses normalisées dans les mêmes partitions
+    geocode(records, id_adr, address, cpostal, com, country)
+        Géocode un lot d'adresses
+    """
+
+    def __init__(self, pathIndex):
+        self.pathIndex = pathIndex
+        for name in ('pc_codes', 'pc_offsets', 'pc_streets', 'x', 'y', 'numero', 'labels', 'exact_hash', 'exact_idx', 'street', 'street_first', 'postings', 'street_postings', 'ntri'):
+            # np.asarray garde la projection mémoire sans le surcoût de la sous-classe numpy.memmap à chaque accès
+            setattr(self, name, np.asarray(np.load(os.path.join(pathIndex, name + '.npy'), mmap_mode='r')))
+        self.nb_rows = len(self.ntri)
+        self.nb_streets = len(self.street_first)
+        with open(os.path.join(pathIndex, 'communes.json')) as file_obj:
+            self.communes = json.load(file_obj)
+
+    def partitions(self, postcode, commune):
+        """
+        Plages d'adresses correspondant au code postal, ou à défaut aux codes postaux de la commune
+        """
+        codes = [postcode] if postcode else self.communes.get(normalize_address(commune), [])
+        ranges = []
+        for code in codes:
+            index = np.searchsorted(self.pc_codes, code)
+            if index < len(self.pc_codes) and self.pc_codes[index] == code:
+                ranges.append((int(self.pc_offsets[index]), int(self.pc_offsets[index + 1])))
+        if not ranges and postcode:
+            return self.partitions(0, commune)
+        return ranges
+
+    def match(self, label, postcode, commune):
+        """
+        Paramètres
+        ----------
+        label: str
+            Adresse normalisée
+        postcode: int
+            Code postal (0 si inconnu)
+        commune: str
+            Nom de commune
+        """
+        best, best_score = self.match_batch([label], self.partitions(postcode, commune))
+        return (int(best[0]) if best[0] >= 0 else None), float(best_score[0])
+
+    def hits(self, postings, keys, low, high, owner):
+        """
+        Cases (adresse cherchée * (high - low) + voie ou adresse de la plage) de chaque occurrence des trigrammes cherchés dans un index inversé
+
+        Paramètres
+        ----------
+        postings: numpy.ndarray
+            Clés triées de l'index inversé (trigramme * modulo + voie ou adresse)
+        keys: numpy.ndarray
+            Trigrammes cherchés, multipliés par le modulo de l'index
+        low, high: int
+            Plage des voies ou des adresses de la partition
+        owner: numpy.ndarray
+            Adresse cherchée de chaque trigramme
+        """
+        starts = np.searchsorted(postings, keys + low)
+        lengths = np.searchsorted(postings, keys + high) - starts
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        # clé - (trigramme * modulo + low) : rang de la voie ou de l'adresse dans la plage
+        return np.repeat(owner.astype(np.int64) * (high - low) - keys - low, lengths) + postings[positions]
+
+    def match_batch(self, labels, ranges):
+        """
+        Recherche des adresses normalisées dans les mêmes partitions et retourne (indices des adresses trouvées ou -1, scores)
+
+        Les trigrammes communs sont comptés pour tout un paquet d'adresses cherchées : par voie dans une matrice dense (adresse cherchée, voie),
+        puis par adresse pour les seuls trigrammes propres à une adresse de sa voie. Le coefficient de Dice est ainsi exact sans parcourir
+        toutes les adresses de la partition : parmi les adresses d'une voie sans trigramme propre en commun, celle qui a le moins de trigrammes
+        a le meilleur score.
+
+        Paramètres
+        ----------
+        labels: list
+            Adresses normalisées
+        ranges: list
+            Plages (début, fin) des partitions, voir partitions()
+        """
+        ids = trigrams(encode_labels(labels))
+        # Trigrammes distincts de chaque adresse : doublons remplacés par -1 après tri de chaque ligne
+        ids.sort(axis=1)
+        ids[:, 1:][(ids[:, 1:] == ids[:, :-1]) & (ids[:, 1:] >= 0)] = -1
+        nb_query = (ids >= 0).sum(axis=1)
+        best = np.full(len(labels), -1, dtype=np.int64)
+        best_score = np.zeros(len(labels))
+        for low, high in ranges:
+            partition = int(np.searchsorted(self.pc_offsets, low, side='right')) - 1
+            first_street, last_street = int(self.pc_streets[partition]), int(self.pc_streets[partition + 1])
+            street = self.street[low:high].astype(np.int64) - first_street
+            street_first = self.street_first[first_street:last_street]
+            street_ntri = self.ntri[street_first]
+            step = max(1, MATCH_CELLS // (last_street - first_street))
+            for first in range(0, len(labels), step):
+                block = ids[first:first + step]
+                nb_block = nb_query[first:first + step]
+                owner, column = np.nonzero(block >= 0)
+                keys = block[owner, column].astype(np.int64)
+                counts = np.bincount(self.hits(self.street_postings, keys * self.nb_streets, first_street, last_street, owner), minlength=len(block) * (last_street - first_street)).reshape(len(block), -1)
+                # Meilleure voie, représentée par son adresse ayant le moins de trigrammes (la première adresse en cas d'égalité)
+                dice = 2.0 * counts / np.maximum(nb_block[:, None] + street_ntri, 1)
+                score = dice.max(axis=1)
+                index = np.where(dice == score[:, None], street_first, self.nb_rows).min(axis=1)
+                # Adresses ayant des trigrammes propres en commun avec l'adresse cherchée
+                cells, own = np.unique(self.hits(self.postings, keys * self.nb_rows, low, high, owner), return_counts=True)
+                if len(cells):
+                    owners, rows = cells // (high - low), cells % (high - low)
+                    dice = 2.0 * (counts[owners, street[rows]] + own) / np.maximum(nb_block[owners] + self.ntri[low + rows], 1)
+                    # Cases triées par adresse cherchée puis par adresse : meilleure adresse de chaque adresse cherchée, la première en cas d'égalité
+                    starts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+                    top = np.repeat(np.maximum.reduceat(dice, starts), np.diff(np.append(starts, len(owners))))
+                    order = np.flatnonzero(dice == top)
+                    order = order[np.r_[True, owners[order][1:] != owners[order][:-1]]]
+                    owners, rows, dice = owners[order], low + rows[order], dice[order]
+                    take = (dice > score[owners]) | ((dice == score[owners]) & (rows < index[owners]))
+                    score[owners[take]], index[owners[take]] = dice[take], rows[take]
+                better = score > best_score[first:first + step]
+                best[first:first + step][better] = index[better]
+                best_score[first:first + step][better] = score[better]
+        return best, best_score * 100
+
+    def geocode(self, records, id_adr, address, cpostal, com, country):
+        """
+        Géocode un lot d'adresses et retourne les lignes de la table de résultats
+
+        Une adresse trouvée d'un autre numéro que celui cherché est rendue comme correspondance à la voie (match_type street), au score diminué.
+
+        Paramètres
+        ----------
+        records: list
+            Lignes (dict) du lot d'adresses
+        id_adr: str
+            Colonne le l'identifiant unique de l'adresse
+        address: str
+            Colonne de l'adresse
+        cpostal: str
+            Colonne du code postal
+        com: str
+            Colonne du nom de commune
+        country: str
+            Colonne du pays
+        """
+        labels = [normalize_address(record[address]) for record in records]
+        postcodes = [_postcode(record[cpostal]) for record in records]
+        hashes = np.array([_hash(label, code) for label, code in zip(labels, postcodes)], dtype=np.uint64)
+        positions = np.minimum(np.searchsorted(self.exact_hash, hashes), max(len(self.exact_hash) - 1, 0))
+        exact = self.exact_hash[positions] == hashes if len(self.exact_hash) else np.zeros(len(records), dtype=bool)
+        found = [int(self.exact_idx[position]) if is_exact else None for position, is_exact in zip(positions, exact)]
+        scores = [100.0 if is_exact else 0.0 for is_exact in exact]
+        # Autres adresses regroupées par partitions, puis cherchées ensemble
+        partitions, groups = {}, {}
+        for number, (record, code, is_exact) in enumerate(zip(records, postcodes, exact)):
+            if not is_exact:
+                if (code, record[com]) not in partitions:
+                    partitions[(code, record[com])] = tuple(self.partitions(code, record[com]))
+                groups.setdefault(partitions[(code, record[com])], []).append(number)
+        for ranges, numbers in groups.items():
+            best, best_score = self.match_batch([labels[number] for number in numbers], ranges)
+            for number, index, score in zip(numbers, best, best_score):
+                found[number], scores[number] = (int(index) if index >= 0 else None), float(score)
+        rows = []
+        for record, label, index, score in zip(records, labels, found, scores):
+            row = {id_adr: record[id_adr], 'geoc_name': 'Local', 'loc_name': 'BAN locale', 'status': 'U', 'score': score, 'match_type': None, 'match_addr': None, address: record[address], cpostal: record[cpostal], com: record[com], country: record[country], 'x': None, 'y': None}
+            if index is not None:
+                match_type = 'housenumber'
+                if int(self.numero[index]) != _housenumber(label):
+                    match_type, row['score'] = 'street', score * STREET_PENALTY
+                row.update({'status': 'M', 'match_type': match_type, 'match_addr': self.labels[index].decode('utf-8'), 'x': float(self.x[index]), 'y': float(self.y[index])})
+            rows.append(row)
+        return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Construction de l'index du géocodeur local à partir d'un export CSV de la BAN")
+    parser.add_argument("-b", "--ban", required=True, help="Chemin de l'export CSV de la BAN (adresses-france.csv ou adresses-XX.csv)")
+    parser.add_argument("-i", "--index", required=True, help="Dossier de l'index à créer")
+    args = parser.parse_args()
+    print("{0} adresses indexées".format(build_index(args.ban, args.index)))
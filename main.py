@@ -4,23 +4,45 @@
 
 # Aide : python main.py --help
 
-import argparse, os
+import argparse, os, sys
 from dotenv import load_dotenv
 import geocoding
 load_dotenv()
 
 parser = argparse.ArgumentParser(description='A test program.')
-parser.add_argument("-f", "--file", required=True, help="Chemin du fichier contenant les adresses à géocoder")
+parser.add_argument("-f", "--file", required=False, help="Chemin du fichier contenant les adresses à géocoder (obligatoire sauf en modes worker et serve)")
 parser.add_argument("-id", "--id", required=True, help="Clé primaire du fichier")
 parser.add_argument("-a", "--adresse", required=True, help="Colonne de l'adresse")
 parser.add_argument("-cp", "--code_postal", required=True, help="Colonne du code postal")
 parser.add_argument("-com", "--com", required=True, help="Colonne de la commune")
 parser.add_argument("-p", "--pays", required=True, help="Colonne du pays")
-parser.add_argument("-m", "--max_esri", required=False, default=100, help="Nombre de lignes max. à géocoder par le service payant World Esri (100 lignes par défaut)")
-parser.add_argument("-g", "--geocodeur", required=True, nargs='+', help="Nom du service de géocodage (interne ou esri ou ban | les trois peuvent être appelés dans l'ordre de géocodage voulu, ex. : -g interne esri ban)")
+parser.add_argument("-m", "--max_esri", required=False, default=100, help="Budget d'adresses distinctes à géocoder par le service payant World Esri, dépensé en priorité sur les adresses les plus complètes (100 par défaut)")
+parser.add_argument("-g", "--geocodeur", required=True, nargs='+', help="Nom du service de géocodage (interne, local, esri ou ban | ils peuvent être appelés dans l'ordre de géocodage voulu, ex. : -g interne local esri ban)")
 parser.add_argument("-w", "--workspace", required=True, help="Dossier de travail où seront stocker les résultats")
 parser.add_argument("-o", "--output_name", required=True, help="Nom du fichier de sortie des adresses géocodées")
+parser.add_argument("--esri_workers", required=False, default=1, help="Nombre de lots envoyés simultanément au service World Esri (1 par défaut)")
+parser.add_argument("--esri_rate", required=False, default=0, help="Nombre max. de requêtes par seconde vers le service World Esri (pas de limite par défaut)")
+parser.add_argument("--ban_chunk", required=False, default=10000, help="Nombre de lignes par lot envoyé à la BAN (10000 par défaut)")
+parser.add_argument("--ban_workers", required=False, default=1, help="Nombre de lots envoyés simultanément à la BAN (1 par défaut)")
+parser.add_argument("--local_index", required=False, default=os.getenv('LOCALINDEX'), help="Dossier de l'index du géocodeur local construit avec local_geocoder.py (variable LOCALINDEX par défaut)")
+parser.add_argument("-c", "--cache", required=False, default=None, help="Chemin de la base SQLite du cache de géocodage (pas de cache par défaut)")
+parser.add_argument("--cache_ttl", required=False, default=0, help="Durée de vie des entrées du cache, en jours (pas d'expiration par défaut)")
+parser.add_argument("--cache_max", required=False, default=0, help="Nombre maximal d'entrées du cache (pas de limite par défaut)")
+parser.add_argument("--metrics", required=False, default=None, help="Fichier des mesures de l'exécution : durée, lignes et octets par étape, latence des lots HTTP (pas de mesures par défaut)")
+parser.add_argument("--metrics_format", required=False, default='jsonl', choices=['jsonl', 'prometheus'], help="Format des mesures : jsonl ou prometheus (jsonl par défaut)")
+parser.add_argument("--profile", required=False, default=None, help="Fichier du profil cProfile de l'exécution (pas de profil par défaut)")
+parser.add_argument("--resume", required=False, action='store_true', help="Reprend l'exécution interrompue à partir du manifeste de l'espace de travail au lieu de le vider")
+parser.add_argument("--incremental", required=False, action='store_true', help="Ne géocode que les lignes nouvelles, modifiées ou restées sans résultat depuis l'exécution précédente et met à jour la table existante")
+parser.add_argument("--mode", required=False, default='local', choices=['local', 'coordinator', 'worker', 'serve'], help="local : géocodage sur cette machine ; coordinator : chargement de la file de travail PostgreSQL puis export des résultats ; worker : traitement des lots de la file ; serve : serveur HTTP de géocodage au fil de l'eau (local par défaut)")
+parser.add_argument("--shard_rows", required=False, default=50000, help="Nombre moyen de lignes par lot de la file de travail (50000 par défaut)")
+parser.add_argument("--lease", required=False, default=600, help="Durée du bail d'un lot, en secondes : le lot d'un worker silencieux pendant cette durée est repris par un autre (600 par défaut)")
+parser.add_argument("--spawn", required=False, default=0, help="Nombre de workers lancés sur cette machine par le coordinateur (aucun par défaut)")
+parser.add_argument("--spatial_formats", required=False, default=['geoparquet', 'flatgeobuf'], nargs='*', choices=['geoparquet', 'flatgeobuf'], help="Formats spatiaux indexés écrits à l'export en plus du CSV (geoparquet flatgeobuf par défaut ; aucun si l'option est vide)")
+parser.add_argument("--port", required=False, default=8900, help="Port d'écoute du serveur, en mode serve (8900 par défaut)")
+parser.add_argument("--max_wait", required=False, default=0.05, help="Attente maximale d'une adresse avant l'envoi de son lot, en secondes, en mode serve (0.05 par défaut)")
 args = parser.parse_args()
+if args.mode in ('local', 'coordinator') and not args.file:
+    parser.error("l'argument -f/--file est obligatoire sauf en modes worker et serve")
 
 config = {
     "PGHOST": os.getenv('PGHOST'),
@@ -35,6 +57,13 @@ config = {
     "LOCATOR": os.getenv('INTERNELOCATOR'),
     "ESRI_MAX_ROWS": args.max_esri,
     "ESRIAPIKEY": os.getenv('ESRIAPIKEY'),
+    "ESRI_URL": os.getenv('ESRIURL'),
+    "ESRI_WORKERS": args.esri_workers,
+    "ESRI_RATE": args.esri_rate,
+    "BAN_URL": os.getenv('BANURL'),
+    "BAN_CHUNK_ROWS": args.ban_chunk,
+    "BAN_WORKERS": args.ban_workers,
+    "LOCAL_INDEX": args.local_index,
     "WORKSPACE": args.workspace,
     "INPUT_A_GEOCODER": args.file,
     "GEOCODAGE_OUTPUT": args.output_name,
@@ -43,9 +72,31 @@ config = {
     "ADRESSE": args.adresse,
     "CODE_POSTAL": args.code_postal,
     "COMMUNE": args.com,
-    "PAYS": args.pays
+    "PAYS": args.pays,
+    "CACHE": args.cache,
+    "CACHE_TTL": args.cache_ttl,
+    "CACHE_MAX_ROWS": args.cache_max,
+    "METRICS": args.metrics,
+    "METRICS_FORMAT": args.metrics_format,
+    "PROFILE": args.profile,
+    "RESUME": args.resume,
+    "INCREMENTAL": args.incremental,
+    "SPATIAL_FORMATS": args.spatial_formats,
+    "STREAM_MAX_WAIT": args.max_wait
 }
 
-ExecGeoc = geocoding.Geocoding(config)
-ExecGeoc.chain_geocoding()
+if args.mode == 'coordinator':
+    import workqueue
+    # Workers locaux lancés avec les mêmes arguments que le coordinateur
+    argv = [arg for index, arg in enumerate(sys.argv[1:]) if arg.split('=')[0] not in ('--mode', '--spawn') and sys.argv[index] not in ('--mode', '--spawn')]
+    workqueue.run_coordinator(config, int(args.shard_rows), int(args.lease), spawn=int(args.spawn), command=[sys.executable, os.path.abspath(__file__)] + argv + ['--mode', 'worker'])
+elif args.mode == 'worker':
+    import workqueue
+    workqueue.run_worker(config, int(args.lease))
+elif args.mode == 'serve':
+    import stream
+    stream.serve(config, port=int(args.port))
+else:
+    ExecGeoc = geocoding.Geocoding(config)
+    ExecGeoc.chain_geocoding()
 
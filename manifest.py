@@ -0,0 +1,111 @@
+##!/usr/bin/python
+## -*- coding: utf-8 -*-
+## Python 2.7.X
+
+"""
+Manifeste d'exécution pour la reprise d'un géocodage interrompu
+---------------------------------------------------------------
+Le manifeste (geocodage/manifest.json) enregistre les étapes terminées et, pour les services traités par lots (local, Esri, BAN), chaque lot chargé dans PostgreSQL.
+Il est réécrit de façon atomique après chaque lot, y compris quand plusieurs services s'exécutent en même temps : une interruption ne fait perdre que les lots en cours.
+Une signature (fichier d'entrée, services, tailles de lots, table de sortie) garantit que la reprise porte sur la même exécution.
+"""
+
+import os, json, threading
+
+class RunManifest:
+    """
+    Manifeste d'exécution
+
+    Attributs
+    ---------
+    path: str
+        Chemin du fichier JSON
+    signature: dict
+        Paramètres de l'exécution, comparés à ceux du manifeste existant
+
+    Méthodes
+    --------
+    compatible()
+        Indique si le manifeste existant correspond à la même exécution
+    stage_done(name)
+        Indique si une étape est terminée
+    mark_stage(name, status, **info)
+        Enregistre l'état d'une étape (done, partial, failed)
+    batch_done(service, index, ids)
+        Indique si un lot d'un service a été chargé avec les mêmes identifiants
+    unfinished_stages()
+        Étapes enregistrées qui ne sont pas terminées
+    mark_batch(service, index, status, **info)
+        Enregistre l'état d'un lot (done, failed)
+    batches(service)
+        Lots enregistrés d'un service, dans l'ordre
+    reset(names)
+        Oublie les étapes et les lots de services dont l'entrée va changer
+    """
+
+    def __init__(self, path, signature):
+        self.path = path
+        self.signature = signature
+        self.data = {'signature': None, 'stages': {}, 'batches': {}}
+        self.lock = threading.RLock()
+        if os.path.exists(path):
+            with open(path) as file_obj:
+                self.data = json.load(file_obj)
+
+    def compatible(self):
+        return self.data.get('signature') == json.loads(json.dumps(self.signature))
+
+    def start(self):
+        """
+        Démarre un nouveau manifeste, vide
+        """
+        self.data = {'signature': self.signature, 'stages': {}, 'batches': {}}
+        self.save()
+
+    def save(self):
+        with self.lock:
+            with open(self.path + '.tmp', 'w') as file_obj:
+                json.dump(self.data, file_obj, sort_keys=True)
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(self.path + '.tmp', self.path)
+
+    def stage_done(self, name):
+        return self.data['stages'].get(name, {}).get('status') == 'done'
+
+    def unfinished_stages(self):
+        """
+        Étapes enregistrées qui ne sont pas terminées (en échec, ou partielles avec des lots en échec)
+        """
+        with self.lock:
+            return sorted(name for name, stage in self.data['stages'].items() if stage.get('status') != 'done')
+
+    def mark_stage(self, name, status, **info):
+        info['status'] = status
+        with self.lock:
+            self.data['stages'][name] = info
+            self.save()
+
+    def batch_done(self, service, index, ids=None):
+        batch = self.data['batches'].get(service, {}).get(str(index), {})
+        return batch.get('status') == 'done' and (ids is None or batch.get('ids') == ids)
+
+    def mark_batch(self, service, index, status, **info):
+        info['status'] = status
+        with self.lock:
+            self.data['batches'].setdefault(service, {})[str(index)] = info
+            self.save()
+
+    def batches(self, service):
+        """
+        Indices des lots enregistrés d'un service, dans l'ordre, avec leur état
+        """
+        with self.lock:
+            return sorted((int(index), dict(batch)) for index, batch in self.data['batches'].get(service, {}).items())
+
+    def reset(self, names):
+        with self.lock:
+            for name in names:
+                self.data['stages'].pop(name, None)
+                self.data['batches'].pop(name, None)
+            self.save()
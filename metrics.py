@@ -0,0 +1,215 @@
+##!/usr/bin/python
+## -*- coding: utf-8 -*-
+## Python 2.7.X
+
+"""
+Mesures de l'exécution d'un géocodage
+-------------------------------------
+Chaque étape de Geocoding (nettoyage, préparation, services, chargement COPY, reprojection, export) est chronométrée avec ses nombres de lignes.
+Chaque lot HTTP est mesuré (durée, octets envoyés et reçus, statut) et alimente un histogramme de latence par service.
+Les mesures sont écrites :
+    - en JSON lines (format 'jsonl') : un enregistrement par étape et par lot, puis un récapitulatif en fin d'exécution,
+    - ou dans un fichier texte Prometheus (format 'prometheus'), lisible par le collecteur textfile de node_exporter.
+Un profil cProfile de l'exécution peut être enregistré en parallèle (Metrics.start_profile / stop_profile).
+"""
+
+import os, json, time, threading, collections
+
+# Bornes (en secondes) de l'histogramme de latence des requêtes HTTP
+HTTP_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+class Stage:
+    """
+    Chronomètre d'une étape, utilisé comme gestionnaire de contexte (with metrics.stage(...) as stage)
+
+    Attributs
+    ---------
+    name: str
+        Nom de l'étape
+    service: str
+        Service de géocodage concerné (optionnel)
+    counts: dict
+        Compteurs de l'étape (rows_in, matched, unmatched, bytes...)
+    """
+
+    def __init__(self, metrics, name, service=None):
+        self.metrics = metrics
+        self.name = name
+        self.service = service
+        self.counts = {}
+        self.start = None
+
+    def count(self, **counts):
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + (value or 0)
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.counts['errors'] = self.counts.get('errors', 0) + 1
+        self.metrics.record(self.name, self.service, time.time() - self.start, **self.counts)
+        return False
+
+class Metrics:
+    """
+    Mesures d'une exécution
+
+    Attributs
+    ---------
+    path: str
+        Fichier de sortie des mesures (optionnel : mesures conservées en mémoire seulement)
+    fmt: str
+        Format de sortie, 'jsonl' ou 'prometheus'
+    profile: str
+        Fichier du profil cProfile (optionnel)
+
+    Méthodes
+    --------
+    stage(name, service)
+        Chronomètre une étape
+    record(name, service, seconds, **counts)
+        Enregistre une exécution d'étape déjà chronométrée
+    add(name, service, seconds, **counts)
+        Ajoute une durée et des compteurs aux totaux d'une étape, sans l'écrire (étapes très fréquentes)
+    observe_http(service, seconds, rows, sent, received, status)
+        Enregistre un lot HTTP
+    total(name, counter)
+        Total d'un compteur d'une étape, tous services confondus
+    close()
+        Écrit le récapitulatif (JSON lines) ou le fichier Prometheus
+    """
+
+    def __init__(self, path=None, fmt='jsonl', profile=None):
+        self.path = path
+        self.fmt = fmt or 'jsonl'
+        if self.fmt not in ('jsonl', 'prometheus'):
+            raise ValueError('Format de mesures non pris en charge : {0}'.format(self.fmt))
+        self.profile = profile
+        self.profiler = None
+        self.run = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.lock = threading.Lock()
+        self.stages = collections.OrderedDict()
+        self.http = collections.OrderedDict()
+        self.file_obj = None
+
+    def emit(self, record):
+        if not self.path or self.fmt != 'jsonl':
+            return
+        record = dict(record, run=self.run, time=round(time.time(), 3))
+        with self.lock:
+            if self.file_obj is None:
+                self.file_obj = open(self.path, 'a')
+            self.file_obj.write(json.dumps(record, sort_keys=True) + '\n')
+            self.file_obj.flush()
+
+    def stage(self, name, service=None):
+        """
+        Paramètres
+        ----------
+        name: str
+            Nom de l'étape
+        service: str
+            Service de géocodage concerné (optionnel)
+        """
+        return Stage(self, name, service)
+
+    def record(self, name, service=None, seconds=0.0, **counts):
+        self.add(name, service, seconds, **counts)
+        record = {'type': 'stage', 'stage': name, 'service': service, 'seconds': round(seconds, 6)}
+        record.update(counts)
+        self.emit(record)
+
+    def add(self, name, service=None, seconds=0.0, **counts):
+        with self.lock:
+            totals = self.stages.setdefault((name, service), {'seconds': 0.0, 'calls': 0})
+            totals['seconds'] += seconds
+            totals['calls'] += 1
+            for key, value in counts.items():
+                totals[key] = totals.get(key, 0) + (value or 0)
+
+    def total(self, name, counter):
+        with self.lock:
+            return sum(totals.get(counter, 0) for (stage, service), totals in self.stages.items() if stage == name)
+
+    def observe_http(self, service, seconds, rows, sent, received, status):
+        """
+        Paramètres
+        ----------
+        service: str
+            Nom du service
+        seconds: float
+            Durée du lot, reprises comprises
+        rows: int
+            Nombre d'adresses du lot
+        sent: int
+            Octets envoyés
+        received: int
+            Octets reçus
+        status: int
+            Statut HTTP de la dernière réponse (None en cas d'erreur réseau)
+        """
+        with self.lock:
+            http = self.http.setdefault(service, {'buckets': [0] * len(HTTP_BUCKETS), 'count': 0, 'sum': 0.0, 'rows': 0, 'sent': 0, 'received': 0, 'errors': 0})
+            for index, bound in enumerate(HTTP_BUCKETS):
+                if seconds <= bound:
+                    http['buckets'][index] += 1
+            http['count'] += 1
+            http['sum'] += seconds
+            http['rows'] += rows
+            http['sent'] += sent
+            http['received'] += received
+            if status is None or status >= 400:
+                http['errors'] += 1
+        self.emit({'type': 'http', 'service': service, 'seconds': round(seconds, 6), 'rows': rows, 'bytes_sent': sent, 'bytes_received': received, 'status': status})
+
+    def start_profile(self):
+        if self.profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop_profile(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile)
+            self.profiler = None
+
+    def prometheus(self):
+        """
+        Mesures au format texte de Prometheus
+        """
+        lines = ['# TYPE geocodage_stage_seconds counter', '# TYPE geocodage_stage_count counter']
+        for (name, service), totals in self.stages.items():
+            labels = 'stage="{0}"'.format(name) + (',service="{0}"'.format(service) if service else '')
+            lines.append('geocodage_stage_seconds{{{0}}} {1}'.format(labels, totals['seconds']))
+            for key, value in sorted(totals.items()):
+                if key not in ('seconds', 'calls'):
+                    lines.append('geocodage_stage_count{{{0},counter="{1}"}} {2}'.format(labels, key, value))
+        lines += ['# TYPE geocodage_http_request_seconds histogram', '# TYPE geocodage_http_bytes counter', '# TYPE geocodage_http_errors counter']
+        for service, http in self.http.items():
+            for bound, count in zip(HTTP_BUCKETS, http['buckets']):
+                lines.append('geocodage_http_request_seconds_bucket{{service="{0}",le="{1}"}} {2}'.format(service, bound, count))
+            lines.append('geocodage_http_request_seconds_bucket{{service="{0}",le="+Inf"}} {1}'.format(service, http['count']))
+            lines.append('geocodage_http_request_seconds_sum{{service="{0}"}} {1}'.format(service, http['sum']))
+            lines.append('geocodage_http_request_seconds_count{{service="{0}"}} {1}'.format(service, http['count']))
+            lines.append('geocodage_http_bytes{{service="{0}",direction="sent"}} {1}'.format(service, http['sent']))
+            lines.append('geocodage_http_bytes{{service="{0}",direction="received"}} {1}'.format(service, http['received']))
+            lines.append('geocodage_http_errors{{service="{0}"}} {1}'.format(service, http['errors']))
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        self.stop_profile()
+        if self.fmt == 'prometheus' and self.path:
+            # Écriture atomique : le collecteur ne lit jamais un fichier incomplet
+            with open(self.path + '.tmp', 'w') as file_obj:
+                file_obj.write(self.prometheus())
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(self.path + '.tmp', self.path)
+        elif self.file_obj is not None:
+            self.emit({'type': 'summary', 'stages': [dict(totals, stage=name, service=service) for (name, service), totals in self.stages.items()], 'http': [dict(http, service=service, bounds=list(HTTP_BUCKETS)) for service, http in self.http.items()]})
+            self.file_obj.close()
+            self.file_obj = None
@@ -0,0 +1,95 @@
+##!/usr/bin/python
+## -*- coding: utf-8 -*-
+## Python 2.7.X
+
+"""
+Normalisation des adresses avant géocodage
+------------------------------------------
+Les adresses sont ramenées à une forme canonique (minuscules, sans accents ni ponctuation, types de voie développés, espaces réduits)
+afin de regrouper les doublons et de ne géocoder qu'une fois chaque adresse distincte.
+normalize_series() travaille sur une colonne pandas entière ; normalize_address() applique les mêmes règles à une seule valeur.
+address_fingerprints() calcule l'empreinte des valeurs brutes d'une ligne, pour repérer les adresses modifiées d'une exécution à l'autre (géocodage incrémental).
+"""
+
+import hashlib, re, unicodedata
+
+# Abréviations des types de voie et des mots courants, remplacées par leur forme développée
+STREET_TYPES = {
+    'all': 'allee', 'av': 'avenue', 'ave': 'avenue', 'bd': 'boulevard', 'bld': 'boulevard', 'blvd': 'boulevard', 'bvd': 'boulevard',
+    'car': 'carrefour', 'ch': 'chemin', 'che': 'chemin', 'chem': 'chemin', 'crs': 'cours', 'ctre': 'centre',
+    'esp': 'esplanade', 'fg': 'faubourg', 'fbg': 'faubourg', 'ham': 'hameau', 'imp': 'impasse',
+    'lot': 'lotissement', 'mte': 'montee', 'pass': 'passage', 'pl': 'place', 'prom': 'promenade', 'pte': 'porte',
+    'qu': 'quai', 'qua': 'quai', 'r': 'rue', 'res': 'residence', 'rpt': 'rond point', 'rte': 'route', 'sq': 'square',
+    'st': 'saint', 'ste': 'sainte', 'sen': 'sentier', 'tra': 'traverse', 'vla': 'villa', 'vx': 'vieux'
+}
+
+# Ponctuation et caractères spéciaux (dont ceux retirés auparavant pour Esri) remplacés par un espace
+PUNCTUATION = re.compile(r"[!#$%&@\[\]_/\\,;:.'\"()\-?*+]")
+STREET_TYPES_PATTERN = re.compile(r'\b(' + '|'.join(sorted(STREET_TYPES, key=len, reverse=True)) + r')\b')
+SPACES = re.compile(r'\s+')
+
+def _strip_accents(value):
+    if not hasattr(value, 'decode') or isinstance(value, type(u'')):
+        text = value
+    else:
+        text = value.decode('utf-8')
+    return unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii')
+
+def normalize_address(value):
+    """
+    Forme canonique d'une valeur (adresse, code postal, commune ou pays)
+
+    Paramètre
+    ---------
+    value: str
+        Valeur à normaliser
+    """
+    text = PUNCTUATION.sub(' ', _strip_accents(value or u'').lower())
+    text = STREET_TYPES_PATTERN.sub(lambda match: STREET_TYPES[match.group(1)], text)
+    return SPACES.sub(' ', text).strip()
+
+def normalize_series(series):
+    """
+    Forme canonique de toutes les valeurs d'une colonne, en opérations vectorisées
+
+    Paramètre
+    ---------
+    series: pandas.Series
+        Colonne texte à normaliser
+    """
+    text = series.fillna(u'').astype(type(u'')).str.normalize('NFKD').str.encode('ascii', 'ignore').str.decode('ascii').str.lower()
+    text = text.str.replace(PUNCTUATION, ' ', regex=True)
+    text = text.str.replace(STREET_TYPES_PATTERN, lambda match: STREET_TYPES[match.group(1)], regex=True)
+    return text.str.replace(SPACES, ' ', regex=True).str.strip()
+
+def address_keys(frame, columns):
+    """
+    Clé normalisée de chaque ligne, construite à partir des colonnes d'adresse
+
+    Paramètres
+    ----------
+    frame: pandas.DataFrame
+        Adresses à géocoder
+    columns: list
+        Colonnes adresse, code postal, commune et pays
+    """
+    keys = normalize_series(frame[columns[0]])
+    for column in columns[1:]:
+        keys = keys + u'|' + normalize_series(frame[column])
+    return keys
+
+def address_fingerprints(frame, columns):
+    """
+    Empreinte SHA-1 des valeurs brutes (non normalisées) des colonnes d'adresse de chaque ligne
+
+    Paramètres
+    ----------
+    frame: pandas.DataFrame
+        Adresses à géocoder
+    columns: list
+        Colonnes adresse, code postal, commune et pays
+    """
+    values = frame[columns[0]].fillna(u'').astype(type(u''))
+    for column in columns[1:]:
+        values = values + u'\x1f' + frame[column].fillna(u'').astype(type(u''))
+    return [hashlib.sha1(value.encode('utf-8')).hexdigest() for value in values]
@@ -0,0 +1,356 @@
+##!/usr/bin/python
+## -*- coding: utf-8 -*-
+## Python 2.7.X
+
+"""
+Chargement des résultats de géocodage dans PostgreSQL
+-----------------------------------------------------
+Les lignes produites par chaque service sont envoyées en flux avec COPY ... FROM STDIN dans une table de transit, puis insérées dans la table de résultats.
+Les lignes non géocodées sont écrites dans le CSV des erreurs au cours de la même lecture.
+Une seule connexion, issue d'un pool, sert l'ensemble de l'exécution.
+Si une clé est indiquée (géocodage incrémental), l'insertion devient un upsert (INSERT ... ON CONFLICT) sur un index unique de la clé.
+"""
+
+import csv, io, threading, time
+import psycopg2, psycopg2.pool
+
+# Types des colonnes de la table de résultats autres que texte
+NUMERIC_COLUMNS = ('score', 'x', 'y')
+
+class RowStream:
+    """
+    Fichier en lecture seule alimentant COPY à partir d'un itérateur de lignes
+
+    Chaque ligne est écrite en CSV si elle est géocodée, sinon elle est transmise au CSV des erreurs.
+
+    Attributs
+    ---------
+    rows: iterable
+        Lignes (dict) produites par un service
+    columns: list
+        Colonnes de la table de résultats
+    matched: function
+        Fonction indiquant si une ligne est géocodée
+    errors: csv.DictWriter
+        CSV des erreurs (optionnel)
+    """
+
+    def __init__(self, rows, columns, matched, errors=None):
+        self.rows = iter(rows)
+        self.columns = columns
+        self.matched = matched
+        self.errors = errors
+        self.nb_matched = 0
+        self.nb_unmatched = 0
+        self.nb_bytes = 0
+        self.buffer = io.BytesIO()
+        self.writer = csv.writer(self.buffer, delimiter=',', lineterminator='\n')
+        self.pending = b''
+
+    def fill(self, size):
+        while len(self.pending) < size:
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                break
+            if self.matched(row):
+                self.writer.writerow([row.get(column) for column in self.columns])
+                self.nb_matched += 1
+            else:
+                if self.errors is not None:
+                    self.errors.writerow(row)
+                self.nb_unmatched += 1
+            if self.buffer.tell() >= 65536:
+                self.flush_buffer()
+        if len(self.pending) < size:
+            self.flush_buffer()
+
+    def flush_buffer(self):
+        self.pending += self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = float('inf')
+        self.fill(size)
+        if size == float('inf'):
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        self.nb_bytes += len(data)
+        return data
+
+    def readline(self, size=-1):
+        self.fill(65536)
+        index = self.pending.find(b'\n')
+        end = len(self.pending) if index < 0 else index + 1
+        data, self.pending = self.pending[:end], self.pending[end:]
+        self.nb_bytes += len(data)
+        return data
+
+class PgLoader:
+    """
+    Chargement en flux des résultats dans la table PostgreSQL
+
+    Attributs
+    ---------
+    config: dict
+        Objet de configuration (PGHOST, PGPORT, PGDBNAME, PGUSER, PGPWD)
+    table: str
+        Table de résultats (schema.table)
+    columns: list
+        Colonnes de la table de résultats, dans l'ordre
+    key: str
+        Colonne identifiant une ligne : les lignes chargées remplacent celles de même clé (optionnel)
+    nb_bytes: int
+        Octets envoyés par le dernier COPY
+
+    Méthodes
+    --------
+    create_table(overwrite)
+        Crée la table de résultats
+    load(rows, matched, errors)
+        Insère (ou met à jour, si une clé est indiquée) les lignes géocodées et écrit les autres dans le CSV des erreurs
+    delete_keys(keys)
+        Supprime les lignes dont la clé figure dans keys
+    replace_rows(table, columns, rows)
+        Remplace le contenu d'une table annexe par des lignes envoyées avec COPY
+    execute(sql, params)
+        Exécute une requête sur la connexion du chargeur
+    iter_rows(sql, batch_size)
+        Lit par lots le résultat d'une requête, sans le charger en mémoire
+    export_csv(path)
+        Exporte la table de résultats en CSV
+    close()
+        Ferme les connexions
+    """
+
+    def __init__(self, config, table, columns, maxconn=4, key=None):
+        self.table = table
+        self.columns = columns
+        self.key = key
+        self.staging = 'geocodage_staging'
+        self.nb_bytes = 0
+        self.pool = psycopg2.pool.ThreadedConnectionPool(1, maxconn, host=config["PGHOST"], port=config["PGPORT"], dbname=config["PGDBNAME"], user=config["PGUSER"], password=config["PGPWD"])
+
+    def execute(self, sql, params=None):
+        connection = self.pool.getconn()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                result = cursor.fetchall() if cursor.description else None
+            connection.commit()
+            return result
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            self.pool.putconn(connection)
+
+    def iter_rows(self, sql, batch_size=65536):
+        """
+        Paramètres
+        ----------
+        sql: str
+            Requête SELECT
+        batch_size: int
+            Nombre de lignes (tuples) par lot rendu
+        """
+        connection = self.pool.getconn()
+        try:
+            # Curseur nommé : les lignes restent côté serveur et sont transférées lot par lot
+            with connection.cursor(name='geocodage_lecture') as cursor:
+                cursor.itersize = batch_size
+                cursor.execute(sql)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield rows
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            self.pool.putconn(connection)
+
+    def create_table(self, overwrite=True):
+        definition = ', '.join('{0} {1}'.format(column, 'double precision' if column in NUMERIC_COLUMNS else 'text') for column in self.columns)
+        if overwrite:
+            self.execute("DROP TABLE IF EXISTS {0}".format(self.table))
+        self.execute("CREATE TABLE IF NOT EXISTS {0} ({1})".format(self.table, definition))
+        if self.key:
+            # Index unique requis par ON CONFLICT, ajouté aussi à une table créée par une exécution non incrémentale
+            self.execute("CREATE UNIQUE INDEX IF NOT EXISTS {0}_{1}_key ON {2} ({1})".format(self.table.split('.')[-1], self.key, self.table))
+
+    def load(self, rows, matched, errors=None):
+        """
+        Paramètres
+        ----------
+        rows: iterable
+            Lignes (dict) produites par un service, contenant les colonnes de la table
+        matched: function
+            Fonction indiquant si une ligne est géocodée
+        errors: csv.DictWriter
+            CSV des erreurs (optionnel)
+
+        Retourne le nombre de lignes géocodées et non géocodées
+        """
+        stream = RowStream(rows, self.columns, matched, errors)
+        connection = self.pool.getconn()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("CREATE TEMP TABLE IF NOT EXISTS {0} (LIKE {1})".format(self.staging, self.table))
+                cursor.execute("TRUNCATE {0}".format(self.staging))
+                cursor.copy_expert("COPY {0} ({1}) FROM STDIN WITH (FORMAT csv)".format(self.staging, ', '.join(self.columns)), stream)
+                if self.key:
+                    cursor.execute("INSERT INTO {0} ({1}) SELECT DISTINCT ON ({3}) {1} FROM {2} ON CONFLICT ({3}) DO UPDATE SET {4}".format(self.table, ', '.join(self.columns), self.staging, self.key, ', '.join('{0} = EXCLUDED.{0}'.format(column) for column in self.columns if column != self.key)))
+                else:
+                    cursor.execute("INSERT INTO {0} ({1}) SELECT {1} FROM {2}".format(self.table, ', '.join(self.columns), self.staging))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            self.pool.putconn(connection)
+        self.nb_bytes = stream.nb_bytes
+        return stream.nb_matched, stream.nb_unmatched
+
+    def delete_keys(self, keys):
+        """
+        Paramètre
+        ---------
+        keys: iterable
+            Valeurs de la clé des lignes à supprimer
+
+        Retourne le nombre de lignes supprimées
+        """
+        stream = RowStream(({self.key: key} for key in keys), [self.key], lambda row: True)
+        connection = self.pool.getconn()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("CREATE TEMP TABLE IF NOT EXISTS geocodage_suppressions ({0} text)".format(self.key))
+                cursor.execute("TRUNCATE geocodage_suppressions")
+                cursor.copy_expert("COPY geocodage_suppressions ({0}) FROM STDIN WITH (FORMAT csv)".format(self.key), stream)
+                cursor.execute("DELETE FROM {0} t USING geocodage_suppressions s WHERE t.{1} = s.{1}".format(self.table, self.key))
+                nb_deleted = cursor.rowcount
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            self.pool.putconn(connection)
+        return nb_deleted
+
+    def replace_rows(self, table, columns, rows):
+        """
+        Paramètres
+        ----------
+        table: str
+            Table annexe (colonnes texte), créée si besoin
+        columns: list
+            Colonnes de la table, dans l'ordre
+        rows: iterable
+            Lignes (dict) écrites à la place du contenu de la table, dans une seule transaction
+        """
+        stream = RowStream(rows, columns, lambda row: True)
+        connection = self.pool.getconn()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("CREATE TABLE IF NOT EXISTS {0} ({1})".format(table, ', '.join('{0} text'.format(column) for column in columns)))
+                cursor.execute("TRUNCATE {0}".format(table))
+                cursor.copy_expert("COPY {0} ({1}) FROM STDIN WITH (FORMAT csv)".format(table, ', '.join(columns)), stream)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            self.pool.putconn(connection)
+        return stream.nb_matched
+
+    def export_csv(self, path):
+        """
+        Paramètre
+        ---------
+        path: str
+            Chemin du CSV de sortie
+        """
+        connection = self.pool.getconn()
+        try:
+            with connection.cursor() as cursor, open(path, 'wb') as file_obj:
+                cursor.copy_expert("COPY (SELECT * FROM {0}) TO STDOUT WITH (FORMAT csv, HEADER)".format(self.table), file_obj)
+            connection.commit()
+        finally:
+            self.pool.putconn(connection)
+
+    def close(self):
+        self.pool.closeall()
+
+class PgRowBudget:
+    """
+    Budget de lignes commun à plusieurs processus, tenu dans une table PostgreSQL (service, rows_max, rows_spent)
+
+    Même interface que scheduler.RowBudget. Les lignes sont réservées dans la table par tranches de chunk_rows, sous verrou de ligne,
+    puis accordées localement : les workers ne dépassent jamais ensemble rows_max, et release() rend la part réservée non dépensée.
+
+    Attributs
+    ---------
+    loader: PgLoader
+        Chargeur dont la connexion est utilisée
+    table: str
+        Table du budget (schema.table)
+    service: str
+        Service concerné (ligne de la table)
+    chunk_rows: int
+        Nombre de lignes réservées à la fois
+    rows: int
+        Nombre total de lignes autorisées, tous processus confondus
+    spent: int
+        Lignes dépensées par ce processus
+    """
+
+    def __init__(self, loader, table, service, chunk_rows=1800):
+        self.loader = loader
+        self.table = table
+        self.service = service
+        self.chunk_rows = int(chunk_rows)
+        self.spent = 0
+        self.reserved = 0
+        self.lock = threading.Lock()
+        self.rows, self.shared_spent = self.loader.execute("SELECT rows_max, rows_spent FROM {0} WHERE service = %s".format(self.table), (self.service,))[0]
+        self.checked = time.time()
+
+    def reserve(self, nb_rows):
+        # Verrou de la ligne du service : deux processus ne peuvent pas réserver les mêmes lignes
+        self.rows, granted, self.shared_spent = self.loader.execute("WITH previous AS (SELECT rows_spent FROM {0} WHERE service = %s FOR UPDATE) UPDATE {0} b SET rows_spent = LEAST(b.rows_spent + %s, b.rows_max) FROM previous WHERE b.service = %s RETURNING b.rows_max, b.rows_spent - previous.rows_spent, b.rows_spent".format(self.table), (self.service, int(nb_rows), self.service))[0]
+        self.checked = time.time()
+        self.reserved += granted
+
+    def remaining(self):
+        with self.lock:
+            # Solde commun relu au plus une fois par seconde : remaining() est appelé pour chaque adresse
+            if time.time() - self.checked > 1:
+                self.shared_spent = self.loader.execute("SELECT rows_spent FROM {0} WHERE service = %s".format(self.table), (self.service,))[0][0]
+                self.checked = time.time()
+            return self.reserved + max(self.rows - self.shared_spent, 0)
+
+    def take(self, nb_rows):
+        """
+        Réserve jusqu'à nb_rows lignes et retourne le nombre de lignes accordées
+        """
+        with self.lock:
+            if self.reserved < nb_rows and self.shared_spent < self.rows:
+                self.reserve(max(self.chunk_rows, int(nb_rows) - self.reserved))
+            granted = max(min(int(nb_rows), self.reserved), 0)
+            self.reserved -= granted
+            self.spent += granted
+            return granted
+
+    def release(self):
+        """
+        Rend au budget commun les lignes réservées et non dépensées
+        """
+        with self.lock:
+            if self.reserved > 0:
+                self.loader.execute("UPDATE {0} SET rows_spent = rows_spent - %s WHERE service = %s".format(self.table), (self.reserved, self.service))
+                self.reserved = 0
@@ -0,0 +1,85 @@
+##!/usr/bin/python
+## -*- coding: utf-8 -*-
+## Python 2.7.X
+
+"""
+Reprojection des coordonnées en Lambert-93 (EPSG:2154)
+------------------------------------------------------
+Les coordonnées sont transformées par lots avec NumPy, sans passer par PostgreSQL.
+Systèmes pris en charge en entrée :
+    - WGS84 (EPSG:4326), longitude / latitude en degrés,
+    - Web Mercator (EPSG:3857, Esri 102100),
+    - Lambert-93 (EPSG:2154, Esri 102110), laissé tel quel.
+Le RGF93 et le WGS84 étant confondus à la précision du géocodage, aucun changement de datum n'est appliqué.
+"""
+
+import numpy as np
+
+# Ellipsoïde GRS80 et paramètres de la projection conique conforme Lambert-93
+A = 6378137.0
+E = np.sqrt(2 * (1 / 298.257222101) - (1 / 298.257222101) ** 2)
+LAT_1, LAT_2, LAT_0, LON_0 = np.radians(49.0), np.radians(44.0), np.radians(46.5), np.radians(3.0)
+X_0, Y_0 = 700000.0, 6600000.0
+
+WGS84 = ('4326',)
+WEB_MERCATOR = ('3857', '102100', '900913')
+LAMBERT93 = ('2154', '102110')
+
+def _m(lat):
+    return np.cos(lat) / np.sqrt(1 - (E * np.sin(lat)) ** 2)
+
+def _t(lat):
+    return np.tan(np.pi / 4 - lat / 2) / ((1 - E * np.sin(lat)) / (1 + E * np.sin(lat))) ** (E / 2)
+
+N = (np.log(_m(LAT_1)) - np.log(_m(LAT_2))) / (np.log(_t(LAT_1)) - np.log(_t(LAT_2)))
+F = _m(LAT_1) / (N * _t(LAT_1) ** N)
+RHO_0 = A * F * _t(LAT_0) ** N
+
+def wgs84_to_lambert93(lon, lat):
+    """
+    Paramètres
+    ----------
+    lon: numpy.ndarray
+        Longitudes en degrés
+    lat: numpy.ndarray
+        Latitudes en degrés
+    """
+    rho = A * F * _t(np.radians(lat)) ** N
+    theta = N * (np.radians(lon) - LON_0)
+    return X_0 + rho * np.sin(theta), Y_0 + RHO_0 - rho * np.cos(theta)
+
+def web_mercator_to_wgs84(x, y):
+    """
+    Paramètres
+    ----------
+    x: numpy.ndarray
+        Abscisses Web Mercator en mètres
+    y: numpy.ndarray
+        Ordonnées Web Mercator en mètres
+    """
+    return np.degrees(x / A), np.degrees(2 * np.arctan(np.exp(y / A)) - np.pi / 2)
+
+def to_lambert93(x, y, srid):
+    """
+    Reprojette des coordonnées en Lambert-93, les valeurs manquantes (NaN) étant conservées
+
+    Paramètres
+    ----------
+    x: numpy.ndarray
+        Abscisses (ou longitudes)
+    y: numpy.ndarray
+        Ordonnées (ou latitudes)
+    srid: str
+        Code du système de coordonnées en entrée (EPSG ou Esri)
+    """
+    srid = str(srid)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if srid in LAMBERT93:
+        return x, y
+    if srid in WEB_MERCATOR:
+        x, y = web_mercator_to_wgs84(x, y)
+    elif srid not in WGS84:
+        raise ValueError('Système de coordonnées non pris en charge : {0}'.format(srid))
+    with np.errstate(invalid='ignore'):
+        return wgs84_to_lambert93(x, y)
@@ -0,0 +1,215 @@
+##!/usr/bin/python
+## -*- coding: utf-8 -*-
+## Python 2.7.X
+
+"""
+Exécution concurrente de la chaîne de services de géocodage
+-----------------------------------------------------------
+Chaque service de la chaîne est un nœud exécuté dans son propre thread (Node). Les nœuds sont reliés par des files bornées de lots d'adresses (BatchQueue) :
+dès qu'un lot a été traité par un service, ses adresses non géocodées partent vers le service suivant, qui travaille donc en même temps que les précédents.
+La durée totale tend ainsi vers celle du service le plus lent plutôt que vers la somme des durées des services.
+Le budget de lignes Esri (RowBudget) est dépensé en priorité sur les adresses les plus complètes (address_priority).
+"""
+
+import re, sys, threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Numéro en tête d'adresse : seules ces adresses peuvent obtenir d'Esri un point à l'adresse (PointAddress), les correspondances à la voie ou au code postal étant rejetées
+HOUSE_NUMBER = re.compile(r'^\s*\d+')
+POSTCODE = re.compile(r'^\s*\d{5}\s*$')
+MAX_PRIORITY = 4
+
+def address_priority(address, postcode, commune):
+    """
+    Priorité d'une adresse pour le budget Esri, de 0 à MAX_PRIORITY : numéro de voie (2), code postal valide (1), commune renseignée (1)
+
+    Paramètres
+    ----------
+    address: str
+        Adresse
+    postcode: str
+        Code postal
+    commune: str
+        Commune
+    """
+    priority = 0
+    if address and HOUSE_NUMBER.match(address):
+        priority += 2
+    if postcode and POSTCODE.match(postcode):
+        priority += 1
+    if commune and commune.strip():
+        priority += 1
+    return priority
+
+def priority_threshold(counts, remaining):
+    """
+    Priorité minimale des adresses envoyées sans attendre au service Esri : la plus basse telle que toutes les adresses de priorité supérieure ou égale tiennent dans le budget restant
+
+    Les adresses de priorité inférieure sont différées jusqu'à la fin du flux, puis servies par priorité décroissante tant qu'il reste du budget.
+
+    Paramètres
+    ----------
+    counts: list
+        Nombre d'adresses de l'entrée de la chaîne par priorité (borne haute des adresses qui atteindront le service)
+    remaining: int
+        Budget restant, en lignes
+    """
+    total = 0
+    for priority in range(len(counts) - 1, -1, -1):
+        total += counts[priority]
+        if total > remaining:
+            return min(priority + 1, len(counts) - 1)
+    return 0
+
+class RowBudget:
+    """
+    Budget de lignes partagé entre les lots d'un service, dépensé au fil de l'eau
+
+    Attributs
+    ---------
+    rows: int
+        Nombre total de lignes autorisées
+    spent: int
+        Lignes déjà dépensées (lors d'une exécution reprise par exemple)
+    """
+
+    def __init__(self, rows, spent=0):
+        self.rows = int(rows)
+        self.spent = int(spent)
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        with self.lock:
+            return max(self.rows - self.spent, 0)
+
+    def take(self, nb_rows):
+        """
+        Réserve jusqu'à nb_rows lignes et retourne le nombre de lignes accordées
+        """
+        with self.lock:
+            granted = max(min(int(nb_rows), self.rows - self.spent), 0)
+            self.spent += granted
+            return granted
+
+    def release(self):
+        """
+        Sans effet : le budget local ne réserve pas de lignes à l'avance (voir pgload.PgRowBudget)
+        """
+        pass
+
+class BatchQueue:
+    """
+    File bornée de lots d'adresses (listes de dict) entre deux services, parcourue comme un itérable par le service suivant
+
+    Attributs
+    ---------
+    maxsize: int
+        Nombre maximal de lots en attente : un service trop rapide attend que le suivant ait consommé ses lots
+    nb_rows: int
+        Nombre de lignes lues par le service suivant
+    """
+
+    def __init__(self, maxsize=8):
+        self.queue = queue.Queue(maxsize)
+        self.aborted = threading.Event()
+        self.nb_rows = 0
+
+    def put(self, records):
+        # Lots abandonnés si le service suivant s'est arrêté sur une erreur, pour ne pas bloquer le service courant
+        while not self.aborted.is_set():
+            try:
+                self.queue.put(records, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def close(self):
+        self.put(None)
+
+    def abort(self):
+        self.aborted.set()
+
+    def __iter__(self):
+        while True:
+            records = self.queue.get()
+            if records is None:
+                return
+            self.nb_rows += len(records)
+            yield records
+
+def rebatch(batches, batch_size):
+    """
+    Regroupe des lots de tailles quelconques en lots de batch_size lignes (le dernier pouvant être plus petit)
+
+    Paramètres
+    ----------
+    batches: iterable
+        Lots d'adresses (listes de dict)
+    batch_size: int
+        Nombre de lignes par lot rendu
+    """
+    pending = []
+    for records in batches:
+        pending.extend(records)
+        while len(pending) >= batch_size:
+            yield pending[:batch_size]
+            pending = pending[batch_size:]
+    if pending:
+        yield pending
+
+class Node(threading.Thread):
+    """
+    Nœud de la chaîne : exécute target(source, output) dans un thread, puis abandonne sa file d'entrée et ferme sa file de sortie, même en cas d'erreur
+
+    Attributs
+    ---------
+    name: str
+        Nom du service
+    target: function
+        Fonction du service, recevant sa source (chemin Arrow ou BatchQueue) et sa file de sortie (BatchQueue ou None pour le dernier service)
+    source: str ou BatchQueue
+        Adresses à géocoder
+    output: BatchQueue
+        Adresses non géocodées transmises au service suivant (optionnel)
+    """
+
+    def __init__(self, name, target, source, output=None):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.target = target
+        self.source = source
+        self.output = output
+        self.error = None
+
+    def run(self):
+        try:
+            self.target(self.source, self.output)
+        except Exception:
+            self.error = sys.exc_info()[1]
+        finally:
+            # File amont abandonnée dès que le service s'arrête, même sans erreur : le service précédent ne reste pas bloqué sur une file pleine
+            if isinstance(self.source, BatchQueue):
+                self.source.abort()
+            if self.output is not None:
+                self.output.close()
+
+def run_nodes(nodes):
+    """
+    Lance les nœuds de la chaîne en parallèle, attend leur fin et relève la première erreur rencontrée
+
+    Paramètre
+    ---------
+    nodes: list
+        Nœuds (Node) dans l'ordre de la chaîne
+    """
+    for node in nodes:
+        node.start()
+    for node in nodes:
+        while node.is_alive():
+            node.join(0.5) # Attente par intervalles : Ctrl+C reste possible sous Python 2
+    for node in nodes:
+        if node.error is not None:
+            raise node.error
@@ -0,0 +1,156 @@
+##!/usr/bin/python
+## -*- coding: utf-8 -*-
+## Python 2.7.X
+
+"""
+Export des résultats dans des formats spatiaux indexés
+------------------------------------------------------
+En plus du CSV, les adresses géocodées sont exportées en points Lambert-93 (EPSG:2154) :
+    - GeoParquet (adresses_geocodees.parquet) : géométrie WKB et colonne bbox (couverture GeoParquet 1.1), lignes triées selon une courbe de Morton (Z-order)
+      calculée dans PostgreSQL. Chaque groupe de lignes couvre ainsi une zone compacte et ses statistiques min/max de bbox permettent à un lecteur
+      (GDAL, DuckDB, GeoPandas...) de ne lire que les groupes de lignes qui recoupent l'emprise demandée,
+    - FlatGeobuf (adresses_geocodees.fgb) : écrit par ogr2ogr (QGISBINPATH) avec un index R-tree compact trié selon la courbe de Hilbert (SPATIAL_INDEX=YES).
+Le GeoParquet est écrit par groupes de lignes, lus en flux dans la table PostgreSQL (curseur côté serveur) ; le FlatGeobuf est converti en flux depuis le CSV exporté.
+"""
+
+import os, sys, json, struct, subprocess
+import pyarrow as pa
+import pyarrow.parquet as pq
+from handoff import stage_schema
+
+# Nombre de lignes par groupe de lignes du GeoParquet : unité de lecture sélective d'après les statistiques de bbox
+ROW_GROUP_ROWS = 65536
+# Précision de la courbe de Morton (bits par axe)
+MORTON_BITS = 16
+# Définition PROJJSON de RGF93 v1 / Lambert-93, requise par les métadonnées GeoParquet
+LAMBERT93_PROJJSON = '{"base_crs":{"coordinate_system":{"axis":[{"abbreviation":"Lat","direction":"north","name":"Geodetic latitude","unit":"degree"},{"abbreviation":"Lon","direction":"east","name":"Geodetic longitude","unit":"degree"}],"subtype":"ellipsoidal"},"datum":{"ellipsoid":{"inverse_flattening":298.257222101,"name":"GRS 1980","semi_major_axis":6378137},"name":"Reseau Geodesique Francais 1993 v1","type":"GeodeticReferenceFrame"},"id":{"authority":"EPSG","code":4171},"name":"RGF93 v1"},"conversion":{"method":{"id":{"authority":"EPSG","code":9802},"name":"Lambert Conic Conformal (2SP)"},"name":"Lambert-93","parameters":[{"id":{"authority":"EPSG","code":8821},"name":"Latitude of false origin","unit":"degree","value":46.5},{"id":{"authority":"EPSG","code":8822},"name":"Longitude of false origin","unit":"degree","value":3},{"id":{"authority":"EPSG","code":8823},"name":"Latitude of 1st standard parallel","unit":"degree","value":49},{"id":{"authority":"EPSG","code":8824},"name":"Latitude of 2nd standard parallel","unit":"degree","value":44},{"id":{"authority":"EPSG","code":8826},"name":"Easting at false origin","unit":"metre","value":700000},{"id":{"authority":"EPSG","code":8827},"name":"Northing at false origin","unit":"metre","value":6600000}]},"coordinate_system":{"axis":[{"abbreviation":"X","direction":"east","name":"Easting","unit":"metre"},{"abbreviation":"Y","direction":"north","name":"Northing","unit":"metre"}],"subtype":"Cartesian"},"id":{"authority":"EPSG","code":2154},"name":"RGF93 v1 / Lambert-93","type":"ProjectedCRS"}'
+BBOX_TYPE = pa.struct([pa.field('xmin', pa.float64()), pa.field('ymin', pa.float64()), pa.field('xmax', pa.float64()), pa.field('ymax', pa.float64())])
+
+def point_wkb(x, y):
+    """
+    Point WKB (little endian) ou None si une coordonnée manque
+    """
+    if x is None or y is None:
+        return None
+    return struct.pack('<BIdd', 1, 1, x, y)
+
+def morton_sql(extent, bits=MORTON_BITS):
+    """
+    Expression SQL de la clé de Morton des colonnes x et y, quantifiées sur bits bits dans l'emprise des résultats (NULL sans coordonnées)
+
+    Paramètre
+    ---------
+    extent: tuple
+        Emprise des résultats (xmin, ymin, xmax, ymax)
+    """
+    xmin, ymin, xmax, ymax = extent
+    scale = (1 << bits) - 1
+    quantized = []
+    for axis, low, high in (('x', xmin, xmax), ('y', ymin, ymax)):
+        quantized.append('LEAST(GREATEST(floor(({0} - {1!r}) * {2!r}), 0), {3})::bigint'.format(axis, float(low), scale / max(float(high) - float(low), 1e-9), scale))
+    # Entrelacement des bits : bit i de x en position 2i, bit i de y en position 2i + 1
+    return ' + '.join('((({0} >> {1}) & 1) << {2})'.format(quantized[axis], bit, 2 * bit + axis) for bit in range(bits) for axis in (0, 1))
+
+def result_extent(loader):
+    """
+    Emprise (xmin, ymin, xmax, ymax) des résultats de la table, ou None si aucune ligne n'a de coordonnées
+
+    Paramètre
+    ---------
+    loader: pgload.PgLoader
+        Chargeur de la table de résultats
+    """
+    extent = loader.execute("SELECT min(x), min(y), max(x), max(y) FROM {0} WHERE x IS NOT NULL AND y IS NOT NULL".format(loader.table))[0]
+    return None if extent[0] is None else tuple(float(value) for value in extent)
+
+def geoparquet_metadata(extent):
+    return {'version': '1.1.0', 'primary_column': 'geometry', 'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': ['Point'], 'crs': json.loads(LAMBERT93_PROJJSON), 'bbox': list(extent), 'covering': {'bbox': {'xmin': ['bbox', 'xmin'], 'ymin': ['bbox', 'ymin'], 'xmax': ['bbox', 'xmax'], 'ymax': ['bbox', 'ymax']}}}}}
+
+def export_geoparquet(loader, path, row_group_rows=ROW_GROUP_ROWS):
+    """
+    Exporte en flux la table de résultats dans un fichier GeoParquet, trié selon la courbe de Morton
+
+    Paramètres
+    ----------
+    loader: pgload.PgLoader
+        Chargeur de la table de résultats
+    path: str
+        Fichier GeoParquet créé
+    row_group_rows: int
+        Nombre de lignes par groupe de lignes
+
+    Retourne le nombre de lignes exportées
+    """
+    extent = result_extent(loader) or (0.0, 0.0, 0.0, 0.0)
+    columns = loader.columns
+    schema = stage_schema(columns).append(pa.field('geometry', pa.binary())).append(pa.field('bbox', BBOX_TYPE))
+    schema = schema.with_metadata({b'geo': json.dumps(geoparquet_metadata(extent)).encode('utf-8')})
+    sql = "SELECT {0} FROM {1} ORDER BY {2} NULLS LAST".format(', '.join(columns), loader.table, morton_sql(extent))
+    try:
+        # Index de pages (statistiques par page, en plus de celles des groupes de lignes) si la version de pyarrow le permet
+        writer = pq.ParquetWriter(path, schema, compression='snappy', write_page_index=True)
+    except TypeError:
+        writer = pq.ParquetWriter(path, schema, compression='snappy')
+    x_index, y_index = columns.index('x'), columns.index('y')
+    nb_rows = 0
+    try:
+        for rows in loader.iter_rows(sql, row_group_rows):
+            arrays = [pa.array([row[index] for row in rows], field.type) for index, field in enumerate(schema) if index < len(columns)]
+            arrays.append(pa.array([point_wkb(row[x_index], row[y_index]) for row in rows], pa.binary()))
+            arrays.append(pa.array([None if row[x_index] is None or row[y_index] is None else {'xmin': row[x_index], 'ymin': row[y_index], 'xmax': row[x_index], 'ymax': row[y_index]} for row in rows], BBOX_TYPE))
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema), row_group_size=row_group_rows)
+            nb_rows += len(rows)
+    finally:
+        writer.close()
+    return nb_rows
+
+def export_flatgeobuf(pathCsv, path, qgis_bin=None):
+    """
+    Convertit en flux le CSV des résultats en FlatGeobuf (points Lambert-93, lignes sans coordonnées exclues), avec index spatial, par ogr2ogr
+
+    Paramètres
+    ----------
+    pathCsv: str
+        CSV des résultats (Geocoding.export_results)
+    path: str
+        Fichier FlatGeobuf créé
+    qgis_bin: str
+        Dossier des binaires QGIS contenant ogr2ogr (optionnel, ogr2ogr du PATH sinon)
+    """
+    ogr2ogr = os.path.join(qgis_bin, 'ogr2ogr') if qgis_bin else 'ogr2ogr'
+    layer = os.path.splitext(os.path.basename(pathCsv))[0]
+    if os.path.exists(path):
+        os.remove(path)
+    with open(pathCsv) as file_obj:
+        columns = file_obj.readline().strip().split(',')
+    fields = ', '.join('CAST(NULLIF({0}, \'\') AS REAL) AS {0}'.format(column) if column in ('score', 'x', 'y') else column for column in columns)
+    sql = "SELECT {0}, MakePoint(CAST(x AS REAL), CAST(y AS REAL), 2154) AS geometry FROM \"{1}\" WHERE x <> '' AND y <> ''".format(fields, layer)
+    subprocess.check_call([ogr2ogr, '-f', 'FlatGeobuf', path, pathCsv, '-dialect', 'sqlite', '-sql', sql, '-nln', layer, '-a_srs', 'EPSG:2154', '-lco', 'SPATIAL_INDEX=YES'])
+
+def export_spatial(loader, folder, formats=('geoparquet', 'flatgeobuf'), qgis_bin=None):
+    """
+    Exporte les résultats dans les formats spatiaux demandés, à côté du CSV adresses_geocodees.csv déjà exporté dans folder
+
+    Paramètres
+    ----------
+    loader: pgload.PgLoader
+        Chargeur de la table de résultats
+    folder: str
+        Dossier des résultats
+    formats: list
+        Formats à écrire : geoparquet, flatgeobuf
+    qgis_bin: str
+        Dossier des binaires QGIS contenant ogr2ogr (optionnel)
+    """
+    if 'geoparquet' in formats:
+        nb_rows = export_geoparquet(loader, os.path.join(folder, 'adresses_geocodees.parquet'))
+        sys.stdout.write('Export GeoParquet terminé : {0} lignes'.format(nb_rows))
+        sys.stdout.flush()
+    if 'flatgeobuf' in formats:
+        try:
+            export_flatgeobuf(os.path.join(folder, 'adresses_geocodees.csv'), os.path.join(folder, 'adresses_geocodees.fgb'), qgis_bin)
+            sys.stdout.write('Export FlatGeobuf terminé')
+        except (OSError, subprocess.CalledProcessError) as e:
+            # ogr2ogr absent ou sans SpatiaLite : les autres exports restent disponibles
+            sys.stdout.write('Export FlatGeobuf impossible (ogr2ogr de QGISBINPATH requis) : {0}'.format(e))
+        sys.stdout.flush()
@@ -0,0 +1,451 @@
+##!/usr/bin/python
+## -*- coding: utf-8 -*-
+## Python 2.7.X
+
+"""
+Géocodage au fil de l'eau
+-------------------------
+API Python et serveur HTTP géocodant les adresses au fur et à mesure de leur arrivée, sans fichier d'entrée ni table PostgreSQL.
+Chaque service de la chaîne (config.GEOCODINGSERVICES, dans l'ordre) dispose d'un collecteur (ServiceBatcher) qui regroupe les adresses reçues en lots
+bornés par une taille (taille des lots du service) et par une attente maximale (config.STREAM_MAX_WAIT) : un lot part dès qu'il est plein,
+ou dès que sa première adresse a attendu trop longtemps. Les adresses non géocodées d'un lot passent au collecteur du service suivant,
+comme dans Geocoding.chain_geocoding, et chaque appelant reçoit son propre résultat dès que la chaîne a statué.
+Les lots sont envoyés par Geocoding.service_request (service_srid pour la reprojection en Lambert-93), avec les mêmes critères d'acceptation (MATCHED).
+Les percentiles de latence (soumission -> résultat, et durée des lots par service) et le taux de remplissage des lots sont exposés par stats().
+
+Le service interne (ArcGIS) géocode une table complète et n'est pas disponible au fil de l'eau.
+"""
+
+import sys, json, time, threading, itertools, collections
+import numpy as np
+from multiprocessing.pool import ThreadPool
+try:
+    import Queue as queue
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    import queue
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+from geocoding import Geocoding, MATCHED, ESRI_BATCH_ROWS, id_key
+from http_client import TokenBucket, build_session
+from local_geocoder import LocalGeocoder
+from scheduler import RowBudget
+
+# Nombre de mesures de latence conservées pour le calcul des percentiles
+LATENCY_WINDOW = 100000
+PERCENTILES = (50, 90, 99)
+
+def percentiles(values):
+    """
+    Percentiles (PERCENTILES) et maximum d'une liste de durées, en secondes
+    """
+    if not values:
+        return {}
+    result = dict(('p{0}'.format(p), round(float(value), 6)) for p, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)))
+    result['max'] = round(float(max(values)), 6)
+    return result
+
+class StreamStats:
+    """
+    Mesures du géocodage au fil de l'eau : latence des adresses, durée et taux de remplissage des lots de chaque service
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.services = collections.OrderedDict()
+        self.nb_results = 0
+        self.nb_matched = 0
+
+    def observe_result(self, seconds, matched):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.nb_results += 1
+            self.nb_matched += 1 if matched else 0
+
+    def observe_batch(self, service, nb_rows, max_rows, seconds):
+        with self.lock:
+            stats = self.services.setdefault(service, {'batches': 0, 'rows': 0, 'capacity': 0, 'seconds': collections.deque(maxlen=LATENCY_WINDOW)})
+            stats['batches'] += 1
+            stats['rows'] += nb_rows
+            stats['capacity'] += max_rows
+            stats['seconds'].append(seconds)
+
+    def snapshot(self):
+        """
+        Mesures sous forme de dict (sérialisable en JSON)
+        """
+        with self.lock:
+            services = dict((service, {'batches': stats['batches'], 'rows': stats['rows'], 'fill_rate': round(float(stats['rows']) / stats['capacity'], 4) if stats['capacity'] else None, 'batch_seconds': percentiles(list(stats['seconds']))}) for service, stats in self.services.items())
+            return {'results': self.nb_results, 'matched': self.nb_matched, 'latency_seconds': percentiles(list(self.latencies)), 'services': services}
+
+class PendingResult:
+    """
+    Résultat attendu d'une adresse soumise, rendu par get() dès que la chaîne a statué
+
+    Attributs
+    ---------
+    key: str
+        Identifiant de l'adresse fourni par l'appelant
+    record: dict
+        Adresse envoyée aux services, avec un identifiant interne numérique (requis par le service Esri et unique entre appelants)
+    callback: function
+        Fonction appelée avec le résultat (optionnel)
+    """
+
+    def __init__(self, key, record, callback=None):
+        self.key = key
+        self.record = record
+        self.callback = callback
+        self.submitted = time.time()
+        self.row = None
+        self.event = threading.Event()
+
+    def set(self, row):
+        self.row = row
+        self.event.set()
+        if self.callback is not None:
+            self.callback(row)
+
+    def done(self):
+        return self.event.is_set()
+
+    def get(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise RuntimeError('Aucun résultat de géocodage après {0} s'.format(timeout))
+        return self.row
+
+class ServiceBatcher(threading.Thread):
+    """
+    Collecteur des adresses destinées à un service, envoyées en lots bornés par taille et par attente
+
+    Attributs
+    ---------
+    service: str
+        Nom du service
+    id_column: str
+        Colonne de l'identifiant des adresses
+    send: function
+        Fonction géocodant un lot d'adresses (liste de dict) et retournant les lignes de la table de résultats (None en cas d'échec)
+    project: function
+        Fonction reprojetant en Lambert-93 les lignes retenues
+    max_rows: int
+        Nombre maximal d'adresses par lot
+    max_wait: float
+        Attente maximale de la première adresse d'un lot, en secondes
+    workers: int
+        Nombre de lots envoyés simultanément : tant qu'ils sont tous occupés, le lot suivant continue de se remplir
+    route: function
+        Fonction recevant chaque adresse traitée et sa ligne retenue (None si l'adresse n'est pas géocodée par le service)
+    stats: StreamStats
+        Mesures du géocodage
+    """
+
+    def __init__(self, service, id_column, send, project, max_rows, max_wait, workers, route, stats):
+        threading.Thread.__init__(self, name='collecteur-{0}'.format(service))
+        self.daemon = True
+        self.service = service
+        self.id_column = id_column
+        self.send = send
+        self.project = project
+        self.max_rows = int(max_rows)
+        self.max_wait = float(max_wait)
+        self.route = route
+        self.stats = stats
+        self.queue = queue.Queue()
+        self.pool = ThreadPool(max(int(workers), 1))
+        self.slots = threading.BoundedSemaphore(max(int(workers), 1))
+
+    def put(self, pending):
+        self.queue.put((time.time(), pending))
+
+    def close(self):
+        """
+        Envoie le dernier lot et attend la fin des lots en cours
+        """
+        self.queue.put((time.time(), None))
+        self.join()
+
+    def run(self):
+        closed = False
+        while not closed:
+            received, pending = self.queue.get()
+            if pending is None:
+                break
+            batch = [pending]
+            # Attente comptée depuis l'arrivée de la première adresse dans le collecteur, y compris pendant l'envoi des lots précédents
+            deadline = received + self.max_wait
+            while len(batch) < self.max_rows:
+                timeout = deadline - time.time()
+                try:
+                    # Attente dépassée : le lot part avec les adresses déjà arrivées
+                    received, pending = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if pending is None:
+                    closed = True
+                    break
+                batch.append(pending)
+            self.slots.acquire()
+            self.pool.apply_async(self.process, (batch,))
+        self.pool.close()
+        self.pool.join()
+
+    def process(self, batch):
+        start = time.time()
+        try:
+            try:
+                rows = self.send([pending.record for pending in batch])
+            except Exception as e:
+                # Lot en échec : ses adresses passent au service suivant
+                sys.stdout.write('Lot {0} de {1} adresses en échec : {2}'.format(self.service, len(batch), e))
+                sys.stdout.flush()
+                rows = None
+            self.stats.observe_batch(self.service, len(batch), self.max_rows, time.time() - start)
+            try:
+                matched = dict((id_key(row[self.id_column]), row) for row in self.project([row for row in rows or [] if MATCHED[self.service](row)]))
+            except Exception as e:
+                # Ligne illisible (colonne manquante, coordonnées invalides) : lot traité comme en échec, l'erreur n'étant pas relevée par le pool
+                sys.stdout.write('Lignes du lot {0} de {1} adresses illisibles : {2}'.format(self.service, len(batch), e))
+                sys.stdout.flush()
+                matched = {}
+            for pending in batch:
+                try:
+                    self.route(pending, matched.get(id_key(pending.record[self.id_column])))
+                except Exception as e:
+                    # Chaque adresse reçoit un résultat : non géocodée par ce service, elle passe au service suivant
+                    sys.stdout.write('Adresse {0} non transmise par le service {1} : {2}'.format(pending.key, self.service, e))
+                    sys.stdout.flush()
+                    self.route(pending, None)
+        finally:
+            self.slots.release()
+
+class StreamGeocoder:
+    """
+    Géocodage au fil de l'eau, par la chaîne de services de config.GEOCODINGSERVICES (esri, ban, local)
+
+    Attributs
+    ---------
+    config: dict
+        Objet de configuration (voir Geocoding) ; config.STREAM_MAX_WAIT : attente maximale d'une adresse avant l'envoi de son lot, en secondes (optionnel, 0.05 par défaut)
+
+    Méthodes
+    --------
+    submit(record, callback)
+        Soumet une adresse et retourne son résultat attendu (PendingResult)
+    geocode(records)
+        Géocode un itérable d'adresses et rend les résultats au fil de l'eau
+    geocode_async(records, callback)
+        Géocode un itérable d'adresses dans un thread, callback étant appelé pour chaque résultat
+    stats()
+        Percentiles de latence et taux de remplissage des lots
+    close()
+        Envoie les derniers lots et ferme les sessions
+    """
+
+    def __init__(self, config):
+        if 'interne' in config["GEOCODINGSERVICES"]:
+            raise ValueError('Le service interne (ArcGIS) géocode une table complète et ne peut pas être utilisé au fil de l\'eau')
+        self.config = config
+        self.geocoder = Geocoding(config)
+        self.columns = self.geocoder.input_columns()
+        self.budget = RowBudget(int(self.config.get("ESRI_MAX_ROWS") or 0))
+        self.sequence = itertools.count(1)
+        self.lock = threading.Lock()
+        self.sessions = []
+        self.statistics = StreamStats()
+        self.batchers = []
+        max_wait = float(self.config.get("STREAM_MAX_WAIT") or 0.05)
+        for index, service in enumerate(self.config["GEOCODINGSERVICES"]):
+            max_rows = {'esri': ESRI_BATCH_ROWS, 'ban': self.config.get("BAN_CHUNK_ROWS") or 10000, 'local': self.config.get("LOCAL_BATCH_ROWS") or 10000}[service]
+            workers = int(self.config.get("{0}_WORKERS".format(service.upper())) or 1)
+            session = build_session(workers)
+            self.sessions.append(session)
+            limiter = TokenBucket(self.config.get("{0}_RATE".format(service.upper())) or 0)
+            def send(records, service=service, session=session, limiter=limiter):
+                if service == 'esri':
+                    # Budget Esri dépensé dans l'ordre d'arrivée : les adresses au-delà passent au service suivant
+                    records = records[:self.budget.take(len(records))]
+                return self.geocoder.service_request(service, session, limiter, records) if records else []
+            def project(rows, service=service):
+                return list(self.geocoder.geom_proj(rows, self.geocoder.service_srid(service)))
+            def route(pending, row, index=index):
+                if row is None and index + 1 < len(self.batchers):
+                    self.batchers[index + 1].put(pending)
+                else:
+                    self.resolve(pending, row)
+            self.batchers.append(ServiceBatcher(service, self.config["ID"], send, project, max_rows, max_wait, workers, route, self.statistics))
+        if 'local' in self.config["GEOCODINGSERVICES"]:
+            self.geocoder.local_geocoder = LocalGeocoder(self.config["LOCAL_INDEX"]) # Index ouvert une seule fois, avant l'envoi des lots en parallèle
+        for batcher in self.batchers:
+            batcher.start()
+
+    def resolve(self, pending, row):
+        result = dict((column, None) for column in self.geocoder.output_columns())
+        if row is None:
+            result.update(pending.record)
+            result['status'] = 'U'
+        else:
+            result.update(row)
+        result[self.config["ID"]] = pending.key
+        self.statistics.observe_result(time.time() - pending.submitted, row is not None)
+        pending.set(result)
+
+    def submit(self, record, callback=None):
+        """
+        Paramètres
+        ----------
+        record: dict
+            Adresse, avec les colonnes config.ADRESSE, config.CODE_POSTAL, config.COMMUNE, config.PAYS et éventuellement config.ID
+        callback: function
+            Fonction appelée avec le résultat (optionnel)
+        """
+        with self.lock:
+            internal = str(next(self.sequence))
+        values = dict((column, record.get(column) or '') for column in self.columns)
+        values[self.config["ID"]] = internal
+        pending = PendingResult(record.get(self.config["ID"]), values, callback)
+        if self.batchers:
+            self.batchers[0].put(pending)
+        else:
+            self.resolve(pending, None)
+        return pending
+
+    def geocode(self, records, max_in_flight=None):
+        """
+        Géocode un itérable d'adresses et rend les résultats (dict des colonnes de la table de résultats) dans l'ordre où ils sont obtenus
+
+        Paramètres
+        ----------
+        records: iterable
+            Adresses (dict, voir submit), lues au fur et à mesure
+        max_in_flight: int
+            Nombre maximal d'adresses soumises en attente de résultat (par défaut : deux lots du premier service)
+        """
+        max_in_flight = int(max_in_flight or 2 * (self.batchers[0].max_rows if self.batchers else 1))
+        results = queue.Queue()
+        nb_pending = 0
+        for record in records:
+            self.submit(record, results.put)
+            nb_pending += 1
+            while nb_pending >= max_in_flight or not results.empty():
+                yield results.get()
+                nb_pending -= 1
+        while nb_pending > 0:
+            yield results.get()
+            nb_pending -= 1
+
+    def geocode_async(self, records, callback, max_in_flight=None):
+        """
+        Variante non bloquante de geocode() : les adresses sont soumises depuis un thread et callback est appelé pour chaque résultat
+
+        Retourne le thread, à attendre avec join()
+        """
+        def run():
+            for row in self.geocode(records, max_in_flight):
+                callback(row)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stats(self):
+        stats = self.statistics.snapshot()
+        stats['esri_budget'] = {'rows': self.budget.rows, 'spent': self.budget.spent}
+        return stats
+
+    def close(self):
+        # Fermeture dans l'ordre de la chaîne : un service ne s'arrête qu'une fois le précédent vidé
+        for batcher in self.batchers:
+            batcher.close()
+        for session in self.sessions:
+            session.close()
+        self.geocoder.metrics.close()
+
+class GeocodingServer(ThreadingMixIn, HTTPServer):
+    """
+    Serveur HTTP multi-thread du géocodage au fil de l'eau
+
+    GET /geocode?<colonne>=<valeur>... ou POST /geocode (objet JSON) : géocode une adresse, décrite avec les noms de colonnes de la configuration
+    GET /stats : percentiles de latence et taux de remplissage des lots
+
+    Attributs
+    ---------
+    geocoder: StreamGeocoder
+        Géocodeur partagé par toutes les requêtes
+    timeout: float
+        Attente maximale d'un résultat, en secondes
+    """
+    daemon_threads = True
+
+    def __init__(self, address, geocoder, timeout=600):
+        HTTPServer.__init__(self, address, GeocodingHandler)
+        self.geocoder = geocoder
+        self.timeout_seconds = timeout
+
+class GeocodingHandler(BaseHTTPRequestHandler):
+
+    def reply(self, status, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def geocode(self, record):
+        try:
+            self.reply(200, self.server.geocoder.submit(record).get(self.server.timeout_seconds))
+        except RuntimeError as e:
+            self.reply(504, {'error': str(e)})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            self.reply(200, self.server.geocoder.stats())
+        elif url.path == '/geocode':
+            self.geocode(dict((key, values[0]) for key, values in parse_qs(url.query).items()))
+        else:
+            self.reply(404, {'error': 'Chemin inconnu : {0}'.format(url.path)})
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/geocode':
+            self.reply(404, {'error': 'Chemin inconnu : {0}'.format(self.path)})
+            return
+        try:
+            record = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8'))
+        except ValueError as e:
+            self.reply(400, {'error': str(e)})
+            return
+        self.geocode(record)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(config, host='127.0.0.1', port=8900):
+    """
+    Lance le serveur HTTP de géocodage au fil de l'eau jusqu'à son interruption (Ctrl+C)
+
+    Paramètres
+    ----------
+    config: dict
+        Objet de configuration (voir Geocoding et StreamGeocoder)
+    host: str
+        Adresse d'écoute
+    port: int
+        Port d'écoute
+    """
+    geocoder = StreamGeocoder(config)
+    server = GeocodingServer((host, int(port)), geocoder)
+    sys.stdout.write('Serveur de géocodage à l\'écoute sur http://{0}:{1}/geocode (mesures : /stats)'.format(host, port))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        geocoder.close()
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Python 2.7.X
+
+# Outils communs aux tests : chemins du dépôt, configuration PostgreSQL du fichier .env et configuration d'une chaîne de géocodage sur un espace de travail temporaire
+# Les tests qui chargent des résultats dans PostgreSQL sont ignorés si PGHOST n'est pas renseigné ou si la base ne répond pas (une instance locale suffit)
+
+import os, sys, csv, unittest
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+try:
+    from dotenv import load_dotenv
+    load_dotenv(os.path.join(ROOT, '.env'))
+except ImportError:
+    pass
+
+def pg_config():
+    """
+    Variables PostgreSQL de l'environnement (fichier .env)
+    """
+    return {
+        "PGHOST": os.getenv('PGHOST'),
+        "PGPORT": os.getenv('PGPORT') or '5432',
+        "PGDBNAME": os.getenv('PGDBNAME'),
+        "PGUSER": os.getenv('PGUSER'),
+        "PGPWD": os.getenv('PGPWD'),
+        "PGSCHEMA": os.getenv('PGSCHEMA') or 'public'
+    }
+
+def pg_available():
+    config = pg_config()
+    if not config["PGHOST"]:
+        return False
+    try:
+        import psycopg2
+        psycopg2.connect(host=config["PGHOST"], port=config["PGPORT"], dbname=config["PGDBNAME"], user=config["PGUSER"], password=config["PGPWD"], connect_timeout=3).close()
+        return True
+    except Exception:
+        return False
+
+requires_pg = unittest.skipUnless(pg_available(), 'base PostgreSQL non disponible (variables PGHOST, PGPORT, PGDBNAME, PGUSER, PGPWD)')
+
+def pg_execute(sql, params=None):
+    """
+    Exécute une requête sur la base de test et retourne ses lignes (None si elle n'en rend pas)
+    """
+    import psycopg2
+    config = pg_config()
+    connection = psycopg2.connect(host=config["PGHOST"], port=config["PGPORT"], dbname=config["PGDBNAME"], user=config["PGUSER"], password=config["PGPWD"])
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall() if cursor.description else None
+        connection.commit()
+        return rows
+    finally:
+        connection.close()
+
+def drop_tables(*tables):
+    for table in tables:
+        pg_execute('DROP TABLE IF EXISTS {0}.{1}'.format(pg_config()["PGSCHEMA"], table))
+
+def write_csv(path, columns, rows, delimiter=','):
+    """
+    Écrit un CSV UTF-8 (valeurs unicode encodées) et retourne son chemin
+    """
+    with open(path, 'wb') as file_obj:
+        writer = csv.writer(file_obj, delimiter=delimiter)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([value.encode('utf-8') if isinstance(value, type(u'')) else value for value in row])
+    return path
+
+def chain_config(workspace, pathCsv, services, output, **options):
+    """
+    Configuration d'une chaîne de géocodage sur le CSV d'entrée pathCsv, avec la table de sortie output
+
+    Paramètres
+    ----------
+    workspace: str
+        Espace de travail temporaire
+    pathCsv: str
+        CSV d'entrée (colonnes id, adresse, c_postal, l_com, pays)
+    services: list
+        Services de la chaîne, dans l'ordre
+    output: str
+        Nom de la table de sortie
+    options: dict
+        Clés de configuration ajoutées ou remplacées
+    """
+    config = pg_config()
+    config.update({
+        "GEOCODINGSERVICES": services,
+        "ESRI_MAX_ROWS": 1000000,
+        "ESRIAPIKEY": 'test',
+        "WORKSPACE": workspace,
+        "INPUT_A_GEOCODER": pathCsv,
+        "GEOCODAGE_OUTPUT": '{0}.csv'.format(output),
+        "GEOCODAGE_ERROR": 'adresses_err.csv',
+        "SPATIAL_FORMATS": [],
+        "ID": 'id',
+        "ADRESSE": 'adresse',
+        "CODE_POSTAL": 'c_postal',
+        "COMMUNE": 'l_com',
+        "PAYS": 'pays'
+    })
+    config.update(options)
+    return config
+
+def run_quietly(function, *args, **kwargs):
+    """
+    Appelle une fonction en masquant ses messages (sys.stdout)
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return function(*args, **kwargs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
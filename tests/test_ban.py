@@ -0,0 +1,52 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Python 2.7.X
+
+import os, shutil, tempfile, time, unittest
+from support import requires_pg, pg_config, pg_execute, drop_tables, chain_config, run_quietly
+import geocoding
+from handoff import iter_stage_batches
+from mock_services import MockHandler, start_mock_server, BAN_PATH
+from synthetic import write_addresses
+
+class SlowFirstChunkHandler(MockHandler):
+    """
+    Service BAN simulé dont le premier lot répond en dernier
+    """
+
+    def ban(self):
+        if self.server.nb_requests == 1:
+            time.sleep(0.5)
+        MockHandler.ban(self)
+
+@requires_pg
+class BanChainTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp(prefix='test_ban_')
+        self.server = start_mock_server(latency=0.01, unmatched_rate=0.3)
+        self.server.RequestHandlerClass = SlowFirstChunkHandler
+        drop_tables('test_ban')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workspace, ignore_errors=True)
+        drop_tables('test_ban')
+
+    def test_parallel_chunks_keep_every_row_once_in_order(self):
+        pathCsv = write_addresses(os.path.join(self.workspace, 'adresses.csv'), 250, duplicate_rate=0.0)
+        config = chain_config(self.workspace, pathCsv, ['ban'], 'test_ban', BAN_URL=self.server.url(BAN_PATH), BAN_CHUNK_ROWS=20, BAN_WORKERS=4)
+        run_quietly(geocoding.Geocoding(config).chain_geocoding)
+        self.assertEqual(self.server.nb_requests, 13)
+        matched = [int(row[0]) for row in pg_execute('SELECT id FROM {0}.test_ban ORDER BY ctid'.format(pg_config()["PGSCHEMA"]))]
+        pathErrors = os.path.join(self.workspace, 'geocodage', 'ban', 'adresses_err.arrow')
+        unmatched = [int(record['id']) for records in iter_stage_batches(pathErrors, pathErrors, 'id', 65536) for record in records]
+        self.assertTrue(matched and unmatched)
+        # Chaque ligne une seule fois, géocodée ou en erreur, et chaque sortie dans l'ordre de l'entrée
+        self.assertEqual(sorted(matched + unmatched), list(range(1, 251)))
+        self.assertEqual(matched, sorted(matched))
+        self.assertEqual(unmatched, sorted(unmatched))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Python 2.7.X
+
+import io, json, os, shutil, tempfile, threading, time, unittest
+from support import requires_pg, pg_config, pg_execute, drop_tables, write_csv, chain_config, run_quietly
+try:
+    from urlparse import parse_qs
+except ImportError:
+    from urllib.parse import parse_qs
+import geocoding
+from handoff import read_ids
+from manifest import RunManifest
+from mock_services import MockServer, MockHandler, ESRI_PATH, BAN_PATH
+
+INPUT_COLUMNS = ['id', 'adresse', 'c_postal', 'l_com', 'pays']
+
+class StubEsriHandler(MockHandler):
+    """
+    Service Esri simulé dont certains lots répondent lentement ou par une erreur rendue avec le statut 200 (server.slow, server.failing : identifiants déclenchant ce comportement)
+    """
+
+    def esri(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        ids = [record['attributes']['objectid'] for record in json.loads(parse_qs(body.decode('utf-8'))['addresses'][0])['records']]
+        with self.server.lock:
+            self.server.batches.append(ids)
+        if self.server.slow.intersection(ids):
+            time.sleep(0.3)
+        if self.server.failing.intersection(ids):
+            return self.reply(200, 'application/json', json.dumps({'error': {'code': 400, 'message': 'Unable to complete operation.', 'details': []}}).encode('utf-8'))
+        self.rfile = io.BytesIO(body)
+        MockHandler.esri(self)
+
+def start_stub_server(slow=(), failing=(), unmatched_rate=0.0):
+    server = MockServer(('127.0.0.1', 0), unmatched_rate=unmatched_rate)
+    server.RequestHandlerClass = StubEsriHandler
+    server.batches = []
+    server.slow = set(slow)
+    server.failing = set(failing)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+@requires_pg
+class EsriChainTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp(prefix='test_esri_')
+        self.batch_rows = geocoding.ESRI_BATCH_ROWS
+        geocoding.ESRI_BATCH_ROWS = 10
+        drop_tables('test_esri')
+
+    def tearDown(self):
+        geocoding.ESRI_BATCH_ROWS = self.batch_rows
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workspace, ignore_errors=True)
+        drop_tables('test_esri')
+
+    def run_chain(self, nb_rows, **options):
+        pathCsv = write_csv(os.path.join(self.workspace, 'adresses.csv'), INPUT_COLUMNS, [[str(number), '{0} rue de Rivoli'.format(number), '75001', 'Paris', 'France'] for number in range(1, nb_rows + 1)])
+        config = chain_config(self.workspace, pathCsv, ['esri'], 'test_esri', ESRI_URL=self.server.url(ESRI_PATH), **options)
+        run_quietly(geocoding.Geocoding(config).chain_geocoding)
+        return config
+
+    def loaded_ids(self):
+        return [row[0] for row in pg_execute('SELECT id FROM {0}.test_esri ORDER BY ctid'.format(pg_config()["PGSCHEMA"]))]
+
+    def test_error_in_200_fails_only_its_batch(self):
+        self.server = start_stub_server(failing=[23])
+        config = self.run_chain(50, ESRI_WORKERS=3)
+        self.assertEqual(self.loaded_ids(), [str(number) for number in list(range(1, 21)) + list(range(31, 51))])
+        # Erreur non transitoire : lot envoyé une seule fois, ses adresses restent à géocoder
+        self.assertEqual(len(self.server.batches), 5)
+        pathErrors = os.path.join(self.workspace, 'geocodage', 'esri', 'adresses_err.arrow')
+        self.assertEqual(sorted(int(value) for value in read_ids(pathErrors, 'id')), list(range(21, 31)))
+        manifest = RunManifest(os.path.join(self.workspace, 'geocodage', 'manifest.json'), None)
+        self.assertEqual([(index, batch['status']) for index, batch in manifest.batches('esri')], [(0, 'done'), (1, 'done'), (2, 'failed'), (3, 'done'), (4, 'done')])
+
+    def test_parallel_batches_loaded_in_input_order(self):
+        # Premier lot plus lent que les suivants : ses réponses arrivent en dernier mais sont chargées en premier
+        self.server = start_stub_server(slow=[1])
+        self.run_chain(60, ESRI_WORKERS=4)
+        self.assertEqual(self.loaded_ids(), [str(number) for number in range(1, 61)])
+        self.assertEqual(sorted(ids[0] for ids in self.server.batches), [1, 11, 21, 31, 41, 51])
+
+@requires_pg
+class EsriPriorityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp(prefix='test_esri_')
+        self.batch_rows = geocoding.ESRI_BATCH_ROWS
+        geocoding.ESRI_BATCH_ROWS = 10
+        drop_tables('test_esri')
+
+    def tearDown(self):
+        geocoding.ESRI_BATCH_ROWS = self.batch_rows
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workspace, ignore_errors=True)
+        drop_tables('test_esri')
+
+    def geocoder(self, rows, **options):
+        pathCsv = write_csv(os.path.join(self.workspace, 'adresses.csv'), INPUT_COLUMNS, rows)
+        return geocoding.Geocoding(chain_config(self.workspace, pathCsv, ['esri', 'ban'], 'test_esri', ESRI_URL=self.server.url(ESRI_PATH), BAN_URL=self.server.url(BAN_PATH), **options))
+
+    def test_budget_spent_by_priority(self):
+        # Priorité 4 (numéro, code postal, commune), 2 (sans numéro) et 1 (sans numéro ni commune), en alternance, toutes distinctes
+        rows = []
+        for number in range(1, 31):
+            street = 'rue ' + ''.join(chr(ord('a') + int(digit)) for digit in str(number))
+            rows.append([str(number), '{0} {1}'.format(number, street) if number % 3 == 1 else street, '75001', '' if number % 3 == 0 else 'Paris', 'France'])
+        self.server = start_stub_server()
+        geocoder = self.geocoder(rows, ESRI_MAX_ROWS=15)
+        sent_to_ban = []
+        ban_request = geocoder.ban_request
+        def recording_ban_request(session, limiter, fieldnames, records):
+            sent_to_ban.extend(records)
+            return ban_request(session, limiter, fieldnames, records)
+        geocoder.ban_request = recording_ban_request
+        run_quietly(geocoder.chain_geocoding)
+        # Adresses de priorité 4 envoyées au fil du flux, puis budget restant dépensé sur la priorité 2 ; rien en priorité 1
+        sent_to_esri = [number for ids in self.server.batches for number in ids]
+        self.assertEqual(sent_to_esri, list(range(1, 31, 3)) + [2, 5, 8, 11, 14])
+        # Adresses sans budget transmises à la BAN sans envoi à Esri, avec leurs champs vides d'origine
+        self.assertEqual(sorted(int(record['id']) for record in sent_to_ban), sorted([17, 20, 23, 26, 29] + list(range(3, 31, 3))))
+        for record in sent_to_ban:
+            self.assertEqual(record['l_com'], '' if int(record['id']) % 3 == 0 else 'Paris')
+            self.assertEqual((record['c_postal'], record['pays']), ('75001', 'France'))
+        loaded = pg_execute('SELECT geoc_name, count(*) FROM {0}.test_esri GROUP BY geoc_name ORDER BY geoc_name'.format(pg_config()["PGSCHEMA"]))
+        self.assertEqual(loaded, [('BAN', 15), ('Esri', 15)])
+
+    def test_downstream_failure_aborts_upstream(self):
+        # Toutes les adresses passent au service suivant, arrêté sur une erreur : Esri ne doit pas rester bloqué sur la file pleine
+        self.server = start_stub_server(unmatched_rate=1.0)
+        geocoder = self.geocoder([[str(number), '{0} rue de Rivoli'.format(number), '75001', 'Paris', 'France'] for number in range(1, 301)])
+        def failing_ban(pathIn, pathOut, output=None):
+            raise RuntimeError('service BAN arrêté')
+        geocoder.geocoding_ban = failing_ban
+        errors = []
+        def run():
+            try:
+                run_quietly(geocoder.chain_geocoding)
+            except RuntimeError as error:
+                errors.append(error)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(60)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([str(error) for error in errors], ['service BAN arrêté'])
+        self.assertEqual(len(self.server.batches), 30)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Python 2.7.X
+
+import json, random, time, unittest
+import requests
+import support
+import http_client
+from http_client import post_with_retry, ordered_map
+from geocoding import esri_status
+
+def response(status_code, content=b'', headers=None):
+    result = requests.Response()
+    result.status_code = status_code
+    result._content = content
+    result.headers.update(headers or {})
+    result.url = 'http://stub/geocodeAddresses'
+    return result
+
+class StubSession:
+    """
+    Session rendant les réponses (ou levant les erreurs) prévues, dans l'ordre
+    """
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.nb_calls = 0
+
+    def post(self, url, **kwargs):
+        self.nb_calls += 1
+        item = self.responses.pop(0)
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+class PostWithRetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.waits = []
+        self.sleep = http_client.time.sleep
+        http_client.time.sleep = self.waits.append
+
+    def tearDown(self):
+        http_client.time.sleep = self.sleep
+
+    def test_retries_429_and_5xx_with_backoff(self):
+        session = StubSession([response(429, headers={'Retry-After': '7'}), response(503), requests.exceptions.ConnectionError('coupure'), response(502), response(200, b'ok')])
+        result = post_with_retry(session, 'http://stub', retries=5, backoff=0.5)
+        self.assertEqual(result.content, b'ok')
+        self.assertEqual(session.nb_calls, 5)
+        # Retry-After respecté, puis attente doublée à chaque tentative
+        self.assertEqual(self.waits, [7.0, 1.0, 2.0, 4.0])
+
+    def test_gives_up_after_retries(self):
+        session = StubSession([response(503)] * 3)
+        with self.assertRaises(requests.exceptions.HTTPError):
+            post_with_retry(session, 'http://stub', retries=2, backoff=1.0)
+        self.assertEqual(session.nb_calls, 3)
+        self.assertEqual(self.waits, [1.0, 2.0])
+
+    def test_client_error_not_retried(self):
+        session = StubSession([response(400)])
+        with self.assertRaises(requests.exceptions.HTTPError):
+            post_with_retry(session, 'http://stub')
+        self.assertEqual(session.nb_calls, 1)
+        self.assertEqual(self.waits, [])
+
+    def test_esri_error_in_200_response(self):
+        # Erreur transitoire rendue avec le statut 200 : reprise ; erreur de requête : réponse rendue telle quelle, sans reprise
+        session = StubSession([response(200, json.dumps({'error': {'code': 500, 'message': 'Unable to complete operation.'}}).encode('utf-8')), response(200, json.dumps({'error': {'code': 498, 'message': 'Invalid token.'}}).encode('utf-8'))])
+        result = post_with_retry(session, 'http://stub', status=esri_status)
+        self.assertEqual(session.nb_calls, 2)
+        self.assertEqual(self.waits, [1.0])
+        self.assertEqual(esri_status(result), 498)
+
+class OrderedMapTest(unittest.TestCase):
+
+    def test_results_in_input_order(self):
+        rng = random.Random(0)
+        delays = [rng.random() / 50 for index in range(40)]
+        def work(index):
+            time.sleep(delays[index])
+            return index
+        self.assertEqual(list(ordered_map(work, range(40), workers=4)), list(range(40)))
+
+    def test_bounded_in_flight(self):
+        consumed = []
+        def items():
+            for index in range(20):
+                consumed.append(index)
+                yield index
+        for index in ordered_map(lambda item: item, items(), workers=2, max_in_flight=3):
+            self.assertLessEqual(len(consumed), index + 3)
+
+if __name__ == '__main__':
+    unittest.main()
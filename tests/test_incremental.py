@@ -0,0 +1,61 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Python 2.7.X
+
+import os, shutil, tempfile, unittest
+from support import requires_pg, pg_config, pg_execute, drop_tables, write_csv, chain_config, run_quietly
+import geocoding
+from mock_services import ESRI_PATH
+from test_esri import INPUT_COLUMNS, start_stub_server
+
+TABLES = ['test_incremental', 'test_incremental_empreintes']
+
+def address(number, street='rue de Rivoli'):
+    return [str(number), '{0} {1}'.format(number, street), '75001', 'Paris', 'France']
+
+@requires_pg
+class IncrementalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp(prefix='test_incremental_')
+        self.batch_rows = geocoding.ESRI_BATCH_ROWS
+        # Un lot par adresse : une erreur Esri ne touche que l'adresse voulue
+        geocoding.ESRI_BATCH_ROWS = 1
+        self.servers = []
+        drop_tables(*TABLES)
+
+    def tearDown(self):
+        geocoding.ESRI_BATCH_ROWS = self.batch_rows
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self.workspace, ignore_errors=True)
+        drop_tables(*TABLES)
+
+    def run_chain(self, rows, failing):
+        server = start_stub_server(failing=failing)
+        self.servers.append(server)
+        pathCsv = write_csv(os.path.join(self.workspace, 'adresses.csv'), INPUT_COLUMNS, rows)
+        run_quietly(geocoding.Geocoding(chain_config(self.workspace, pathCsv, ['esri'], 'test_incremental', ESRI_URL=server.url(ESRI_PATH), INCREMENTAL=True)).chain_geocoding)
+        return sorted(number for ids in server.batches for number in ids)
+
+    def table(self):
+        return dict((int(row[0]), row[1]) for row in pg_execute('SELECT id, match_addr FROM {0}.test_incremental'.format(pg_config()["PGSCHEMA"])))
+
+    def test_upsert_and_delete_on_change(self):
+        self.assertEqual(self.run_chain([address(number) for number in range(1, 6)], failing=[5]), [1, 2, 3, 4, 5])
+        self.assertEqual(sorted(self.table()), [1, 2, 3, 4])
+        # 1 inchangée, 2 et 4 modifiées (4 en échec cette fois), 3 supprimée, 5 inchangée mais sans résultat, 6 nouvelle
+        sent = self.run_chain([address(1), address(2, 'rue de la Paix'), address(4, 'rue de la Paix'), address(5), address(6)], failing=[4])
+        self.assertEqual(sent, [2, 4, 5, 6])
+        table = self.table()
+        self.assertEqual(sorted(table), [1, 2, 5, 6])
+        self.assertIn('rue de la Paix', table[2])
+        self.assertIn('rue de Rivoli', table[1])
+        self.assertEqual(pg_execute('SELECT count(*), count(DISTINCT id) FROM {0}.test_incremental'.format(pg_config()["PGSCHEMA"])), [(4, 4)])
+        # Rien de nouveau, mais 4 toujours sans résultat : seule cette adresse est renvoyée
+        self.assertEqual(self.run_chain([address(1), address(2, 'rue de la Paix'), address(4, 'rue de la Paix'), address(5), address(6)], failing=[]), [4])
+        self.assertEqual(sorted(self.table()), [1, 2, 4, 5, 6])
+
+if __name__ == '__main__':
+    unittest.main()
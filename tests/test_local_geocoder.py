@@ -0,0 +1,50 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Python 2.7.X
+
+import os, shutil, tempfile, unittest
+from support import requires_pg, pg_config, pg_execute, drop_tables, write_csv, chain_config, run_quietly
+import geocoding
+from local_geocoder import build_index, LocalGeocoder
+
+BAN_COLUMNS = ['numero', 'rep', 'nom_voie', 'code_postal', 'nom_commune', 'x', 'y']
+BAN_ROWS = [
+    ['3', '', u"Rue de l'Église", '35000', 'Rennes', '351000.5', '6789000.5'],
+    ['5', '', u"Rue de l'Église", '35000', 'Rennes', '351010.5', '6789010.5'],
+    ['12', 'bis', u'Avenue Émile Zola', '35000', 'Rennes', '352000.0', '6788000.0']
+]
+INPUT_COLUMNS = ['id', 'adresse', 'c_postal', 'l_com', 'pays']
+
+class LocalGeocoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp(prefix='test_local_')
+        self.index = os.path.join(self.workspace, 'index')
+        build_index(write_csv(os.path.join(self.workspace, 'ban.csv'), BAN_COLUMNS, BAN_ROWS, delimiter=';'), self.index)
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace, ignore_errors=True)
+
+    def test_accented_match(self):
+        rows = LocalGeocoder(self.index).geocode([{'id': u'1', 'adresse': u"3 rue de l'eglise", 'c_postal': u'35000', 'l_com': u'Rennes', 'pays': u'France'}], 'id', 'adresse', 'c_postal', 'l_com', 'pays')
+        self.assertEqual(rows[0]['status'], 'M')
+        self.assertEqual(rows[0]['match_type'], 'housenumber')
+        self.assertEqual(rows[0]['match_addr'], u"3 Rue de l'Église 35000 Rennes")
+
+    @requires_pg
+    def test_chain_loads_accented_match(self):
+        drop_tables('test_local')
+        pathCsv = write_csv(os.path.join(self.workspace, 'adresses.csv'), INPUT_COLUMNS, [
+            ['1', u"3 Rue de l'Église", '35000', 'Rennes', 'France'],
+            ['2', u'12 bis avenue Émile Zola', '35000', 'Rennes', 'France'],
+            ['3', u'1 place de la Mairie', '75001', 'Paris', 'France']
+        ])
+        config = chain_config(self.workspace, pathCsv, ['local'], 'test_local', LOCAL_INDEX=self.index)
+        run_quietly(geocoding.Geocoding(config).chain_geocoding)
+        rows = pg_execute('SELECT id, match_addr, x, y FROM {0}.test_local ORDER BY id'.format(pg_config()["PGSCHEMA"]))
+        self.assertEqual([(row[0], row[1].decode('utf-8')) for row in rows], [('1', u"3 Rue de l'Église 35000 Rennes"), ('2', u'12 bis Avenue Émile Zola 35000 Rennes')])
+        self.assertAlmostEqual(float(rows[0][2]), 351000.5)
+        drop_tables('test_local')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Python 2.7.X
+
+import os, shutil, tempfile, unittest
+from support import requires_pg, pg_config, pg_execute, drop_tables, write_csv, chain_config, run_quietly
+import geocoding
+from manifest import RunManifest
+from mock_services import ESRI_PATH
+from test_esri import INPUT_COLUMNS, start_stub_server
+
+class Interruption(Exception):
+    pass
+
+@requires_pg
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp(prefix='test_resume_')
+        self.batch_rows = geocoding.ESRI_BATCH_ROWS
+        geocoding.ESRI_BATCH_ROWS = 10
+        self.server = start_stub_server()
+        pathCsv = write_csv(os.path.join(self.workspace, 'adresses.csv'), INPUT_COLUMNS, [[str(number), '{0} rue de Rivoli'.format(number), '75001', 'Paris', 'France'] for number in range(1, 61)])
+        self.config = chain_config(self.workspace, pathCsv, ['esri'], 'test_resume', ESRI_URL=self.server.url(ESRI_PATH))
+        drop_tables('test_resume')
+
+    def tearDown(self):
+        geocoding.ESRI_BATCH_ROWS = self.batch_rows
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workspace, ignore_errors=True)
+        drop_tables('test_resume')
+
+    def interrupted(self, geocoder):
+        with self.assertRaises(Interruption):
+            run_quietly(geocoder.chain_geocoding)
+        sent = [ids[0] for ids in self.server.batches]
+        del self.server.batches[:]
+        return sent
+
+    def resume(self):
+        run_quietly(geocoding.Geocoding(dict(self.config, RESUME=True)).chain_geocoding)
+        self.assertEqual(pg_execute('SELECT count(*), count(DISTINCT id) FROM {0}.test_resume'.format(pg_config()["PGSCHEMA"])), [(60, 60)])
+        return [ids[0] for ids in self.server.batches]
+
+    def test_resume_after_interrupted_request(self):
+        # Interruption pendant l'envoi du 4e lot : les 3 premiers sont chargés et notés dans le manifeste
+        geocoder = geocoding.Geocoding(self.config)
+        esri_request = geocoder.esri_request
+        def interrupted_request(session, limiter, records):
+            if len(self.server.batches) == 3:
+                raise Interruption()
+            return esri_request(session, limiter, records)
+        geocoder.esri_request = interrupted_request
+        self.assertEqual(self.interrupted(geocoder), [1, 11, 21])
+        self.assertEqual(self.resume(), [31, 41, 51])
+        manifest = RunManifest(os.path.join(self.workspace, 'geocodage', 'manifest.json'), None)
+        self.assertEqual([(index, batch['status']) for index, batch in manifest.batches('esri')], [(index, 'done') for index in range(6)])
+
+    def test_resume_after_load_not_recorded(self):
+        # Interruption entre la validation du 3e lot dans PostgreSQL et son enregistrement dans le manifeste
+        mark_batch = RunManifest.mark_batch
+        def interrupted_mark_batch(manifest, service, index, status, **info):
+            if index == 2:
+                raise Interruption()
+            return mark_batch(manifest, service, index, status, **info)
+        RunManifest.mark_batch = interrupted_mark_batch
+        try:
+            self.assertEqual(self.interrupted(geocoding.Geocoding(self.config)), [1, 11, 21])
+        finally:
+            RunManifest.mark_batch = mark_batch
+        # Le 3e lot est repris, mais ses adresses déjà chargées ne sont pas renvoyées
+        self.assertEqual(self.resume(), [31, 41, 51])
+
+if __name__ == '__main__':
+    unittest.main()
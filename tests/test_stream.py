@@ -0,0 +1,58 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Python 2.7.X
+
+import unittest
+import support
+from stream import StreamGeocoder
+
+CONFIG = {
+    "GEOCODINGSERVICES": ['ban', 'esri'],
+    "ESRI_MAX_ROWS": 100,
+    "STREAM_MAX_WAIT": 0.01,
+    "ID": 'id',
+    "ADRESSE": 'adresse',
+    "CODE_POSTAL": 'c_postal',
+    "COMMUNE": 'l_com',
+    "PAYS": 'pays'
+}
+
+def service_row(service, record, **values):
+    row = {'id': record['id'], 'geoc_name': service, 'loc_name': service, 'status': 'M', 'score': 95.0, 'match_type': 'PointAddress', 'match_addr': record['adresse'], 'adresse': record['adresse'], 'c_postal': record['c_postal'], 'l_com': record['l_com'], 'pays': record['pays'], 'x': 650000.0, 'y': 6860000.0}
+    row.update(values)
+    return row
+
+class StreamGeocoderTest(unittest.TestCase):
+
+    def geocoder(self, services, requests):
+        geocoder = StreamGeocoder(dict(CONFIG, GEOCODINGSERVICES=services))
+        def service_request(service, session, limiter, records):
+            return requests[service](records)
+        geocoder.geocoder.service_request = service_request
+        return geocoder
+
+    def submit(self, geocoder, nb_records):
+        pending = [geocoder.submit({'id': 'a{0}'.format(number), 'adresse': '{0} rue de Rivoli'.format(number), 'c_postal': '75001', 'l_com': 'Paris', 'pays': 'France'}) for number in range(nb_records)]
+        return [result.get(timeout=10) for result in pending]
+
+    def test_bad_row_passes_batch_to_next_service(self):
+        # Coordonnées illisibles à la reprojection (BAN en 4326) : les adresses du lot passent au service Esri
+        geocoder = self.geocoder(['ban', 'esri'], {'ban': lambda records: [service_row('BAN', record, x='abc') for record in records], 'esri': lambda records: [service_row('Esri', record) for record in records]})
+        try:
+            results = support.run_quietly(self.submit, geocoder, 3)
+        finally:
+            geocoder.close()
+        self.assertEqual([(row['id'], row['geoc_name']) for row in results], [('a0', 'Esri'), ('a1', 'Esri'), ('a2', 'Esri')])
+
+    def test_bad_row_resolved_unmatched_by_last_service(self):
+        # Ligne sans identifiant : le lot du dernier service est rendu non géocodé au lieu de laisser les appelants en attente
+        geocoder = self.geocoder(['esri'], {'esri': lambda records: [dict((key, value) for key, value in service_row('Esri', record).items() if key != 'id') for record in records]})
+        try:
+            results = support.run_quietly(self.submit, geocoder, 2)
+        finally:
+            geocoder.close()
+        self.assertEqual([(row['id'], row['status']) for row in results], [('a0', 'U'), ('a1', 'U')])
+        self.assertEqual(results[0]['adresse'], '0 rue de Rivoli')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Python 2.7.X
+
+import os, shutil, tempfile, threading, unittest
+from support import requires_pg, drop_tables, chain_config, run_quietly
+from synthetic import write_addresses
+from workqueue import WorkQueue, MAX_ATTEMPTS, run_worker
+
+TABLES = ['test_queue', 'test_queue_lots', 'test_queue_lots_adresses', 'test_queue_budget']
+
+@requires_pg
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp(prefix='test_queue_')
+        self.config = chain_config(self.workspace, write_addresses(os.path.join(self.workspace, 'adresses.csv'), 200, duplicate_rate=0.0), ['ban'], 'test_queue')
+        self.queues = []
+        drop_tables(*TABLES)
+
+    def tearDown(self):
+        for queue in self.queues:
+            queue.close()
+        shutil.rmtree(self.workspace, ignore_errors=True)
+        drop_tables(*TABLES)
+
+    def queue(self, lease=600):
+        queue = WorkQueue(self.config, lease)
+        self.queues.append(queue)
+        return queue
+
+    def create(self, shard_rows):
+        run_quietly(self.queue().create, shard_rows)
+        return sorted(row[0] for row in self.queues[0].execute("SELECT shard FROM {shards}"))
+
+    def expire(self, shard):
+        self.queues[0].execute("UPDATE {shards} SET lease_until = now() - interval '1 second' WHERE shard = %s", (shard,))
+
+    def test_workers_never_claim_the_same_shard(self):
+        shards = self.create(10)
+        queues = [self.queue() for index in range(4)]
+        claims = dict((index, []) for index in range(len(queues)))
+        start = threading.Event()
+        def claim_all(index):
+            start.wait()
+            while True:
+                shard = queues[index].claim('worker-{0}'.format(index))
+                if shard is None:
+                    return
+                claims[index].append(shard)
+        threads = [threading.Thread(target=claim_all, args=(index,)) for index in range(len(queues))]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        claimed = [shard for index in claims for shard in claims[index]]
+        self.assertEqual(sorted(claimed), shards)
+        self.assertGreater(len([index for index in claims if claims[index]]), 1)
+
+    def test_expired_lease_is_reclaimed(self):
+        shards = self.create(1000)
+        first, second = self.queue(), self.queue()
+        shard = first.claim('worker-1')
+        self.assertEqual(shard, shards[0])
+        # Bail en cours : le lot n'est pas repris
+        self.assertIsNone(second.claim('worker-2'))
+        self.expire(shard)
+        self.assertEqual(second.claim('worker-2'), shard)
+        # Le premier worker a perdu le lot : ni prolongation, ni fin enregistrée à son nom
+        self.assertFalse(first.renew(shard, 'worker-1'))
+        first.complete(shard, 'worker-1', matched=1)
+        self.assertEqual(first.execute("SELECT status, worker, attempts FROM {shards} WHERE shard = %s", (shard,)), [('running', 'worker-2', 2)])
+        self.assertTrue(second.renew(shard, 'worker-2'))
+        second.complete(shard, 'worker-2', matched=1)
+        self.assertEqual(second.progress(), {'done': 1})
+
+    def test_shard_abandoned_after_max_attempts(self):
+        shards = self.create(1000)
+        queue = self.queue()
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            shard = queue.claim('worker-1')
+            self.assertEqual(shard, shards[0])
+            queue.fail(shard, 'worker-1', 'échec {0}'.format(attempt))
+            # Lot renvoyé dans la file tant qu'il reste des tentatives
+            self.assertEqual(queue.progress(), {'pending': 1} if attempt < MAX_ATTEMPTS else {'failed': 1})
+        self.assertIsNone(queue.claim('worker-1'))
+        self.assertEqual(queue.execute("SELECT attempts, error FROM {shards}"), [(MAX_ATTEMPTS, 'échec {0}'.format(MAX_ATTEMPTS))])
+
+    def test_expired_lease_abandoned_after_max_attempts(self):
+        shards = self.create(1000)
+        queue = self.queue()
+        for attempt in range(MAX_ATTEMPTS):
+            self.assertEqual(queue.claim('worker-{0}'.format(attempt)), shards[0])
+            self.expire(shards[0])
+        self.assertIsNone(queue.claim('worker-{0}'.format(MAX_ATTEMPTS)))
+        self.assertEqual(queue.execute("SELECT status, attempts, error FROM {shards}"), [('failed', MAX_ATTEMPTS, 'bail expiré')])
+
+    def test_unfinished_shard_sent_back(self):
+        # Service BAN injoignable : la chaîne se termine avec des lots en échec, le lot est renvoyé puis abandonné après MAX_ATTEMPTS tentatives
+        self.create(1000)
+        run_quietly(run_worker, dict(self.config, BAN_URL='http://127.0.0.1:1/search/csv/', BAN_RETRIES='0'))
+        self.assertEqual(self.queues[0].progress(), {'failed': 1})
+        attempts, error = self.queues[0].execute("SELECT attempts, error FROM {shards}")[0]
+        self.assertEqual(attempts, MAX_ATTEMPTS)
+        self.assertIn('ban', error)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,280 @@
+##!/usr/bin/python
+## -*- coding: utf-8 -*-
+## Python 2.7.X
+
+"""
+File de travail PostgreSQL pour répartir un géocodage sur plusieurs machines
+----------------------------------------------------------------------------
+Le coordinateur charge le CSV d'entrée dans une table de file du schéma PGSCHEMA, découpée en lots (shards). Les adresses identiques après normalisation
+tombent dans le même lot, pour que le dédoublonnage de chaque lot reste complet.
+Chaque worker réserve un lot avec FOR UPDATE SKIP LOCKED, exécute la chaîne de services de Geocoding sur ce lot, écrit ses résultats dans la table de sortie
+partagée (upsert sur l'identifiant) et marque le lot terminé. Le bail d'un lot est prolongé tant que le worker est en vie : le lot d'un worker arrêté
+est repris par un autre à l'expiration du bail.
+Le budget Esri (ESRI_MAX_ROWS) est tenu dans une table commune à tous les workers (pgload.PgRowBudget).
+
+Tables créées dans PGSCHEMA, à partir du nom de sortie (-o) :
+    - <sortie>_lots : état de chaque lot (pending, running, done, failed), worker, fin du bail, nombre de tentatives
+    - <sortie>_lots_adresses : adresses à géocoder, avec leur numéro de lot
+    - <sortie>_budget : lignes autorisées et dépensées par service payant
+"""
+
+import os, sys, time, socket, threading, subprocess
+import pandas as pd
+from geocoding import Geocoding, encode_row
+from normalize import address_keys
+from pgload import PgLoader, RowStream
+from spatial_export import export_spatial
+
+# Nombre de tentatives d'un lot avant de le déclarer en échec
+MAX_ATTEMPTS = 3
+
+class WorkQueue:
+    """
+    File des lots d'un géocodage réparti
+
+    Attributs
+    ---------
+    config: dict
+        Objet de configuration (voir Geocoding)
+    lease: int
+        Durée du bail d'un lot, en secondes : sans nouvelle du worker pendant cette durée, le lot est repris par un autre
+
+    Méthodes
+    --------
+    create(shard_rows)
+        Charge le CSV d'entrée dans la file et initialise le budget Esri (coordinateur)
+    claim(worker)
+        Réserve le prochain lot disponible
+    renew(shard, worker)
+        Prolonge le bail d'un lot
+    complete(shard, worker, **counts)
+        Marque un lot terminé
+    fail(shard, worker, error)
+        Remet un lot dans la file, ou le déclare en échec après MAX_ATTEMPTS tentatives
+    export_shard(shard, path)
+        Écrit les adresses d'un lot dans un CSV
+    progress()
+        Nombre de lots par état
+    export_results(folder)
+        Exporte la table de sortie (CSV et formats spatiaux) et les adresses restées sans résultat (coordinateur)
+    """
+
+    def __init__(self, config, lease=600):
+        self.config = config
+        self.lease = int(lease)
+        name = '{0}.{1}'.format(config["PGSCHEMA"], str(config["GEOCODAGE_OUTPUT"]).split('.')[0])
+        self.shards = name + '_lots'
+        self.addresses = name + '_lots_adresses'
+        self.budget = name + '_budget'
+        self.geocoder = Geocoding(config)
+        self.loader = PgLoader(config, name, self.geocoder.output_columns(), maxconn=2)
+
+    def execute(self, sql, params=None):
+        return self.loader.execute(sql.format(shards=self.shards, addresses=self.addresses, budget=self.budget), params)
+
+    def input_columns(self):
+        return [self.config["ID"], self.config["ADRESSE"], self.config["CODE_POSTAL"], self.config["COMMUNE"], self.config["PAYS"]]
+
+    def create(self, shard_rows):
+        """
+        Paramètre
+        ---------
+        shard_rows: int
+            Nombre moyen de lignes par lot
+        """
+        with open(self.config["INPUT_A_GEOCODER"]) as file_obj:
+            nb_rows = max(sum(1 for line in file_obj) - 1, 0)
+        nb_shards = max((nb_rows + int(shard_rows) - 1) // int(shard_rows), 1)
+        columns = self.input_columns()
+        self.execute("DROP TABLE IF EXISTS {shards}, {addresses}, {budget}")
+        self.execute("CREATE TABLE {{addresses}} (shard integer, {0})".format(', '.join('{0} text'.format(column) for column in columns)))
+        self.execute("CREATE TABLE {shards} (shard integer PRIMARY KEY, status text NOT NULL DEFAULT 'pending', worker text, lease_until timestamptz, attempts integer NOT NULL DEFAULT 0, nb_rows integer, matched bigint, error text, started_at timestamptz, finished_at timestamptz)")
+        self.execute("CREATE TABLE {budget} (service text PRIMARY KEY, rows_max bigint NOT NULL, rows_spent bigint NOT NULL DEFAULT 0)")
+        self.execute("INSERT INTO {budget} (service, rows_max) VALUES ('esri', %s)", (int(self.config.get("ESRI_MAX_ROWS") or 0),))
+        sys.stdout.write('Chargement de {0} lignes dans la file de travail : {1} lots'.format(nb_rows, nb_shards))
+        sys.stdout.flush()
+        def rows():
+            for chunk in pd.read_csv(self.config["INPUT_A_GEOCODER"], sep=',', dtype=str, keep_default_na=False, encoding='utf-8', usecols=columns, chunksize=100000):
+                # Lot choisi par hachage de l'adresse normalisée : les doublons d'une adresse sont géocodés par le même worker
+                chunk['shard'] = (pd.util.hash_pandas_object(address_keys(chunk, columns[1:]), index=False).values % nb_shards).astype('int64')
+                for row in chunk.to_dict('records'):
+                    yield encode_row(row)
+        connection = self.loader.pool.getconn()
+        try:
+            with connection.cursor() as cursor:
+                cursor.copy_expert("COPY {0} ({1}) FROM STDIN WITH (FORMAT csv)".format(self.addresses, ', '.join(['shard'] + columns)), RowStream(rows(), ['shard'] + columns, lambda row: True))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            self.loader.pool.putconn(connection)
+        self.execute("CREATE INDEX ON {addresses} (shard)")
+        self.execute("INSERT INTO {shards} (shard, nb_rows) SELECT shard, count(*) FROM {addresses} GROUP BY shard")
+        return nb_shards
+
+    def claim(self, worker):
+        """
+        Paramètre
+        ---------
+        worker: str
+            Nom du worker (machine:processus)
+
+        Retourne le numéro du lot réservé, ou None si aucun lot n'est disponible
+        """
+        # Lots dont le bail a expiré trop souvent : déclarés en échec plutôt que repris indéfiniment
+        self.execute("UPDATE {shards} SET status = 'failed', error = 'bail expiré' WHERE status = 'running' AND lease_until < now() AND attempts >= %s", (MAX_ATTEMPTS,))
+        result = self.execute("UPDATE {shards} SET status = 'running', worker = %s, lease_until = now() + %s * interval '1 second', attempts = attempts + 1, started_at = now() WHERE shard = (SELECT shard FROM {shards} WHERE status = 'pending' OR (status = 'running' AND lease_until < now()) ORDER BY shard LIMIT 1 FOR UPDATE SKIP LOCKED) RETURNING shard", (worker, self.lease))
+        return result[0][0] if result else None
+
+    def renew(self, shard, worker):
+        result = self.execute("UPDATE {shards} SET lease_until = now() + %s * interval '1 second' WHERE shard = %s AND worker = %s AND status = 'running' RETURNING shard", (self.lease, shard, worker))
+        return bool(result)
+
+    def complete(self, shard, worker, matched=0):
+        self.execute("UPDATE {shards} SET status = 'done', lease_until = NULL, finished_at = now(), matched = %s, error = NULL WHERE shard = %s AND worker = %s", (matched, shard, worker))
+
+    def fail(self, shard, worker, error):
+        self.execute("UPDATE {shards} SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END, lease_until = NULL, error = %s WHERE shard = %s AND worker = %s", (MAX_ATTEMPTS, str(error)[:1000], shard, worker))
+
+    def export_shard(self, shard, path):
+        """
+        Paramètres
+        ----------
+        shard: int
+            Numéro du lot
+        path: str
+            CSV créé, avec les colonnes d'entrée
+        """
+        connection = self.loader.pool.getconn()
+        try:
+            with connection.cursor() as cursor, open(path, 'wb') as file_obj:
+                cursor.copy_expert("COPY (SELECT {0} FROM {1} WHERE shard = {2}) TO STDOUT WITH (FORMAT csv, HEADER)".format(', '.join(self.input_columns()), self.addresses, int(shard)), file_obj)
+            connection.commit()
+        finally:
+            self.loader.pool.putconn(connection)
+
+    def progress(self):
+        return dict(self.execute("SELECT status, count(*) FROM {shards} GROUP BY status"))
+
+    def export_results(self, folder):
+        """
+        Paramètre
+        ---------
+        folder: str
+            Dossier de sortie
+        """
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.loader.export_csv(os.path.join(folder, "adresses_geocodees.csv"))
+        export_spatial(self.loader, folder, self.geocoder.spatial_formats(), self.config.get("QGISBINPATH"))
+        connection = self.loader.pool.getconn()
+        try:
+            with connection.cursor() as cursor, open(os.path.join(folder, "geocodage_erreurs_restantes.csv"), 'wb') as file_obj:
+                cursor.copy_expert("COPY (SELECT {0} FROM {1} a WHERE NOT EXISTS (SELECT 1 FROM {2} r WHERE r.{3} = a.{3})) TO STDOUT WITH (FORMAT csv, HEADER)".format(', '.join('a.' + column for column in self.input_columns()), self.addresses, self.loader.table, self.config["ID"]), file_obj)
+            connection.commit()
+        finally:
+            self.loader.pool.putconn(connection)
+
+    def close(self):
+        self.loader.close()
+
+def run_coordinator(config, shard_rows=50000, lease=600, spawn=0, command=None):
+    """
+    Prépare la file de travail, puis suit l'avancement des workers et exporte les résultats une fois tous les lots traités
+
+    Paramètres
+    ----------
+    config: dict
+        Objet de configuration (voir Geocoding)
+    shard_rows: int
+        Nombre moyen de lignes par lot
+    lease: int
+        Durée du bail d'un lot, en secondes
+    spawn: int
+        Nombre de workers lancés sur cette machine une fois la file chargée
+    command: list
+        Commande de lancement d'un worker (main.py --mode worker et les arguments du coordinateur), requise si spawn > 0
+    """
+    queue = WorkQueue(config, lease)
+    # Table de sortie commune, avec l'index unique requis par l'upsert des workers
+    output = PgLoader(config, queue.loader.table, queue.loader.columns, maxconn=1, key=config["ID"])
+    output.create_table(overwrite=True)
+    output.close()
+    queue.create(shard_rows)
+    workers = [subprocess.Popen(command) for index in range(int(spawn))]
+    while True:
+        progress = queue.progress()
+        sys.stdout.write('Lots : {0} en attente, {1} en cours, {2} terminés, {3} en échec'.format(progress.get('pending', 0), progress.get('running', 0), progress.get('done', 0), progress.get('failed', 0)))
+        sys.stdout.flush()
+        if progress.get('pending', 0) + progress.get('running', 0) == 0:
+            spent = queue.execute("SELECT rows_spent, rows_max FROM {budget} WHERE service = 'esri'")
+            sys.stdout.write('Budget Esri : {0} lignes dépensées sur {1}'.format(spent[0][0], spent[0][1]))
+            sys.stdout.flush()
+            queue.export_results(os.path.join(config["WORKSPACE"], "geocodage", "geocodage_resultats"))
+            sys.stdout.write('Résultats exportés dans le dossier /geocodage/geocodage_resultats')
+            sys.stdout.flush()
+            break
+        time.sleep(10)
+    for worker in workers:
+        worker.wait()
+    queue.close()
+
+def run_worker(config, lease=600):
+    """
+    Traite les lots de la file jusqu'à ce qu'il n'en reste plus aucun en attente ou en cours
+
+    Chaque lot est géocodé dans son propre espace de travail (WORKSPACE/lot_<numéro>) par la chaîne de services de Geocoding, avec la table de sortie partagée
+    et le budget Esri commun.
+
+    Paramètres
+    ----------
+    config: dict
+        Objet de configuration (voir Geocoding)
+    lease: int
+        Durée du bail d'un lot, en secondes
+    """
+    queue = WorkQueue(config, lease)
+    worker = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+    while True:
+        shard = queue.claim(worker)
+        if shard is None:
+            progress = queue.progress()
+            if progress.get('pending', 0) + progress.get('running', 0) == 0:
+                break
+            # Lots en cours chez d'autres workers : attente d'un éventuel bail expiré
+            time.sleep(min(queue.lease / 4.0, 30))
+            continue
+        sys.stdout.write('Worker {0} : lot {1}'.format(worker, shard))
+        sys.stdout.flush()
+        workspace = os.path.join(config["WORKSPACE"], 'lot_{0:06d}'.format(shard))
+        if not os.path.exists(workspace):
+            os.makedirs(workspace)
+        pathCsv = os.path.join(workspace, 'adresses_a_geocoder.csv')
+        stop = threading.Event()
+        def heartbeat(shard=shard):
+            while not stop.wait(queue.lease / 3.0):
+                if not queue.renew(shard, worker):
+                    sys.stdout.write('Worker {0} : bail du lot {1} perdu, le lot a été repris par un autre worker'.format(worker, shard))
+                    sys.stdout.flush()
+                    return
+        thread = threading.Thread(target=heartbeat)
+        thread.daemon = True
+        thread.start()
+        try:
+            queue.export_shard(shard, pathCsv)
+            geocoder = Geocoding(dict(config, INPUT_A_GEOCODER=pathCsv, WORKSPACE=workspace, SHARD=shard, ESRI_BUDGET_TABLE=queue.budget, METRICS=config.get("METRICS") and '{0}.{1:06d}'.format(config["METRICS"], shard)))
+            geocoder.chain_geocoding()
+            # Lot terminé seulement si toutes les étapes sont allées au bout : un lot partiellement géocodé est renvoyé
+            unfinished = geocoder.get_manifest().unfinished_stages()
+            if unfinished:
+                raise RuntimeError('étape(s) non terminée(s) : {0}'.format(', '.join(unfinished)))
+            queue.complete(shard, worker, matched=geocoder.metrics.total('load', 'matched'))
+        except (Exception, SystemExit) as error:
+            queue.fail(shard, worker, error)
+            sys.stdout.write('Worker {0} : échec du lot {1} : {2}'.format(worker, shard, error))
+            sys.stdout.flush()
+        finally:
+            stop.set()
+            thread.join()
+    queue.close()